@@ -0,0 +1,93 @@
+"""Repeated services list jobs against a fleet, with and without the result cache
+
+Every host is a simulator on its own loopback address. The same services list is asked for
+--jobs times in a row, each time by a new fleet as a separate job would. With the cache only
+the first job reaches the hosts until the results are older than --cache-ttl. A services
+restart on one host is then run, which has to drop that host's result, and a last job with
+--no-cache goes to every host again.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+from bench_transport import build_args, get_logger, start_fleet
+
+import constants as c
+from fleet import Fleet
+from command_builder import CommandBuilder
+
+
+def scenario(logger, simulators, option, extra):
+    """Run one job against every simulator, returns the figures"""
+    hosts = [s.host for s in simulators]
+    args = build_args(",".join(hosts), simulators[0].port, extra)
+    args.option = option
+
+    if option == "restart":
+        args.task_options = {"-Name": "Spooler"}
+
+    command_detail = CommandBuilder(logger, args).get_command()
+
+    for simulator in simulators:
+        simulator.reset_stats()
+
+    fleet = Fleet(logger, args, args.pwd, hosts)
+    _start = time.perf_counter()
+    fleet.run(command_detail)
+    elapsed = time.perf_counter() - _start
+
+    return {
+        "wall_ms": elapsed * 1000,
+        "ok": fleet.counts[c.HOST_SUCCESS],
+        "cached": fleet.cached,
+        "requests": sum(s.stats["requests"] for s in simulators)
+    }
+
+def main():
+    """Run the jobs each way and show the figures"""
+    parser = argparse.ArgumentParser(description="Result cache benchmark")
+    parser.add_argument("--hosts", help="simulated hosts", type=int, default=20)
+    parser.add_argument("--jobs", help="services list jobs in a row", type=int, default=10)
+    parser.add_argument("--latency", help="seconds added to each request", type=float,
+                        default=0.005)
+    parser.add_argument("-d", help="show debug logging", action="store_true", dest="debug")
+    args = parser.parse_args()
+
+    os.environ["no_proxy"] = "*"
+    logger = get_logger(args.debug)
+    simulators = start_fleet(args.hosts, 0, {"latency": args.latency, "lines": 200})
+    cache = os.path.join(tempfile.mkdtemp(prefix="bench_cache"), "results.db")
+    results = []
+
+    try:
+        for name, extra in (("no cache", []), ("cache", ["--result-cache", cache])):
+            jobs = [scenario(logger, simulators, "list", extra) for _ in range(args.jobs)]
+            results.append(("%s, first job" % name, jobs[0]))
+            results.append(("%s, later jobs" % name, {
+                k: sum(j[k] for j in jobs[1:]) / float(len(jobs) - 1) for k in jobs[0]
+            }))
+
+        # The restart runs on the first host only, the rest keep their results
+        restart = scenario(logger, simulators[:1], "restart", extra)
+        results.append(("restart one host", restart))
+        results.append(("list after restart", scenario(logger, simulators, "list", extra)))
+        results.append(("list, --no-cache",
+                        scenario(logger, simulators, "list", extra + ["--no-cache"])))
+    finally:
+        for simulator in simulators:
+            simulator.stop()
+
+    print("%-22s %10s %10s %10s %10s" % ("scenario", "wall ms", "hosts ok", "cached",
+                                         "requests"))
+    for name, result in results:
+        print("%-22s %10.1f %10.0f %10.0f %10.0f" % (
+            name, result["wall_ms"], result["ok"], result["cached"], result["requests"]
+        ))
+
+    after_restart = dict(results)["list after restart"]
+    return 0 if after_restart["cached"] == args.hosts - 1 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Bytes sent back by a fleet polling the same command, with and without the digest store
+
+Every host is a simulator on its own loopback address giving --lines lines of output, the
+digest script is run in Python so each host hashes its output like a Windows host would. The
+fleet is run once without the store, then twice with it: the first run fills the store and
+between the two a --changed fraction of the hosts change their output. Unchanged hosts should
+only send back the marker line with the digest.
+"""
+import os
+import re
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+
+from bench_transport import build_args, get_logger
+from winrm_simulator import WinRMSimulator
+
+import constants as c
+from fleet import Fleet
+
+COMMAND = "Get-Service"
+
+
+class HostOutput:
+    """The output of a host, which changes when version goes up"""
+
+    def __init__(self, host, lines, line_size):
+        self.host = host
+        self.lines = lines
+        self.line_size = line_size
+        self.version = 1
+
+    def output(self):
+        return [
+            ("%s %s %s " % (self.host, self.version, i)).ljust(self.line_size, "x")
+            for i in range(self.lines)
+        ]
+
+    def handler(self, _command):
+        """A plain pipeline"""
+        return self.output()
+
+    def __call__(self, script, _parameters):
+        """The digest script"""
+        known = re.search(r"\$digest -eq '([0-9A-Fa-f]*)'", script).group(1)
+        marker = re.search(r"Write-Output \('(\S+) %s '" % c.DIGEST_SAME, script).group(1)
+        output = self.output()
+        digest = hashlib.sha256("\n".join(output).encode("utf-8")).hexdigest().upper()
+
+        if digest == known:
+            return ["%s %s %s" % (marker, c.DIGEST_SAME, digest)]
+
+        return ["%s %s %s" % (marker, c.DIGEST_CHANGED, digest)] + output
+
+
+def scenario(logger, simulators, extra):
+    """Run the command on every host, returns the figures"""
+    hosts = [s.host for s in simulators]
+    args = build_args(",".join(hosts), simulators[0].port, extra)
+
+    for simulator in simulators:
+        simulator.reset_stats()
+
+    fleet = Fleet(logger, args, args.pwd, hosts)
+    _start = time.perf_counter()
+    fleet.run({"command": COMMAND, "command_type_raw": False, "cacheable": True})
+    elapsed = time.perf_counter() - _start
+
+    return {
+        "wall_s": elapsed,
+        "ok": fleet.counts[c.HOST_SUCCESS],
+        "unchanged": fleet.unchanged,
+        "kb_out": sum(s.stats["bytes_out"] for s in simulators) / 1024.0
+    }
+
+def main():
+    """Run the fleet each way and show the figures"""
+    parser = argparse.ArgumentParser(description="Digest store benchmark")
+    parser.add_argument("--hosts", help="simulated hosts", type=int, default=50)
+    parser.add_argument("--lines", help="lines of output per host", type=int, default=2000)
+    parser.add_argument("--line-size", help="characters per line", type=int, default=100)
+    parser.add_argument("--changed", help="fraction of hosts whose output changes", type=float,
+                        default=0.1)
+    parser.add_argument("--latency", help="seconds added to each request", type=float,
+                        default=0.002)
+    parser.add_argument("-d", help="show debug logging", action="store_true", dest="debug")
+    args = parser.parse_args()
+
+    os.environ["no_proxy"] = "*"
+    logger = get_logger(args.debug)
+    outputs = [HostOutput("127.0.0.%s" % (i + 2), args.lines, args.line_size)
+               for i in range(args.hosts)]
+    simulators = []
+    port = 0
+
+    for output in outputs:
+        simulators.append(WinRMSimulator(
+            output.host, port, latency=args.latency, handler=output.handler,
+            script_handler=output, max_envelope_kb=c.MAX_ENVELOPE_KB
+        ).start())
+        port = simulators[0].port
+
+    store = os.path.join(tempfile.mkdtemp(prefix="bench_digest"), "digests.db")
+    extra = ["--concurrency", "20"]
+    results = []
+
+    try:
+        results.append(("no store", scenario(logger, simulators, extra)))
+        extra += ["--digest-store", store]
+        results.append(("store, first run", scenario(logger, simulators, extra)))
+
+        for output in outputs[:int(len(outputs) * args.changed)]:
+            output.version += 1
+
+        results.append(("store, next run", scenario(logger, simulators, extra)))
+    finally:
+        for simulator in simulators:
+            simulator.stop()
+
+    print("%-18s %10s %10s %10s %12s" % ("scenario", "wall s", "hosts ok", "unchanged",
+                                         "KB sent"))
+    for name, result in results:
+        print("%-18s %10.2f %10s %10s %12.0f" % (
+            name, result["wall_s"], result["ok"], result["unchanged"], result["kb_out"]
+        ))
+
+    expected = args.hosts - int(args.hosts * args.changed)
+    return 0 if results[-1][1]["unchanged"] == expected else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""Round trips and latency for large outputs, with and without envelope size negotiation
+
+The simulator is set up like a server with MaxEnvelopeSizekb raised to --server-envelope-kb.
+Each output size is run with negotiation off (--max-envelope-kb 0, pypsrp's default envelope)
+and on (the default ceiling, with --pool-envelope for PowerShell), for PowerShell and for raw
+commands, so the count of Receive requests and the latency can be compared. A last run shows
+the fallback when the server won't give its config.
+"""
+import os
+import sys
+import time
+import argparse
+
+from bench_transport import build_args, get_logger, run_once, summarise
+from winrm_simulator import WinRMSimulator
+
+LINE_SIZE = 100
+
+def scenario(logger, size_mb, is_raw, negotiate, iterations, latency, server_kb,
+             deny_config=False):
+    """Run a command returning size_mb of output, returns the figures"""
+    options = {
+        "latency": latency, "lines": int(size_mb * 1024 * 1024 / LINE_SIZE),
+        "line_size": LINE_SIZE, "max_envelope_kb": server_kb, "deny_config": deny_config
+    }
+
+    with WinRMSimulator(**options) as simulator:
+        # Negotiated runs use the default ceiling of --max-envelope-kb
+        args = build_args(simulator.host, simulator.port,
+                          ["--pool-envelope"] if negotiate else ["--max-envelope-kb", "0"])
+        command = "dir" if is_raw else "Get-Service"
+
+        # Warm up - opens the session and asks for the envelope size
+        run_once(logger, args, command, is_raw)
+        simulator.reset_stats()
+        timings = []
+
+        for _ in range(iterations):
+            _start = time.perf_counter()
+            if not run_once(logger, args, command, is_raw):
+                raise RuntimeError("Command failed against the simulator")
+            timings.append(time.perf_counter() - _start)
+
+        result = summarise(timings, simulator.stats["requests"])
+        result["receives"] = simulator.stats["Receive"] / float(iterations)
+
+    return result
+
+def main():
+    """Run each size with and without negotiation"""
+    parser = argparse.ArgumentParser(description="Envelope size negotiation benchmark")
+    parser.add_argument("--sizes", help="output sizes in MB", type=float, nargs="+",
+                        default=[1, 4])
+    parser.add_argument("--iterations", help="runs of each scenario", type=int, default=3)
+    parser.add_argument("--latency", help="seconds added to each request", type=float,
+                        default=0.005)
+    parser.add_argument("--server-envelope-kb", help="MaxEnvelopeSizekb of the server",
+                        type=int, default=8192)
+    args = parser.parse_args()
+
+    for name in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
+        os.environ.pop(name, None)
+    os.environ["no_proxy"] = "*"
+
+    logger = get_logger()
+    print("%-28s %10s %10s %10s" % ("scenario", "receives", "requests", "p50 ms"))
+
+    runs = []
+    for size_mb in args.sizes:
+        for is_raw in (False, True):
+            for negotiate in (False, True):
+                name = "%sMB %s %s" % (
+                    size_mb, "raw" if is_raw else "ps", "negotiated" if negotiate else "default"
+                )
+                runs.append((name, size_mb, is_raw, negotiate, False))
+
+    runs.append(("%sMB ps config denied" % args.sizes[0], args.sizes[0], False, True, True))
+
+    for name, size_mb, is_raw, negotiate, deny_config in runs:
+        result = scenario(
+            logger, size_mb, is_raw, negotiate, args.iterations, args.latency,
+            args.server_envelope_kb, deny_config
+        )
+        print("%-28s %10.1f %10.1f %10.1f" % (
+            name, result["receives"], result["requests"], result["p50_ms"]
+        ))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
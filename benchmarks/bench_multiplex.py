@@ -0,0 +1,116 @@
+"""Thread per host against the multiplexed engine, for commands that take a while to run
+
+Every host is a simulator on its own loopback address whose pipelines run for --run-time
+seconds, so a thread waiting on ps.invoke() is held for that long. The same fleet is run with
+--concurrency threads, with a thread for every host, and multiplexed with every host in flight
+on --io-threads threads. The client threads are counted while each run goes (the simulators'
+own threads are left out).
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+from bench_transport import build_args, get_logger, start_fleet
+
+import constants as c
+from fleet import Fleet
+
+COMMAND = "Get-Service"
+
+
+class ThreadCounter:
+    """The most fleet threads seen alive at once"""
+
+    def __init__(self):
+        self.peak = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self.stopping.wait(0.05):
+            count = len([t for t in threading.enumerate()
+                         if t.name.startswith("ThreadPoolExecutor")])
+            self.peak = max(self.peak, count)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopping.set()
+        self.thread.join()
+
+
+def scenario(logger, simulators, extra):
+    """One command on every simulator, returns the figures"""
+    hosts = [s.host for s in simulators]
+    args = build_args(",".join(hosts), simulators[0].port, extra)
+
+    for simulator in simulators:
+        simulator.reset_stats()
+
+    fleet = Fleet(logger, args, args.pwd, hosts)
+
+    with ThreadCounter() as counter:
+        _start = time.perf_counter()
+        fleet.run({"command": COMMAND, "command_type_raw": False})
+        elapsed = time.perf_counter() - _start
+
+    return {
+        "wall_s": elapsed,
+        "ok": fleet.counts[c.HOST_SUCCESS],
+        "threads": counter.peak,
+        "requests": sum(s.stats["requests"] for s in simulators)
+    }
+
+def main():
+    """Run the fleet each way and show the figures"""
+    parser = argparse.ArgumentParser(description="Multiplexed fleet benchmark")
+    parser.add_argument("--hosts", help="simulated hosts", type=int, default=200)
+    parser.add_argument("--run-time", help="seconds each command runs", type=float,
+                        default=3.0)
+    parser.add_argument("--latency", help="seconds added to each request", type=float,
+                        default=0.002)
+    parser.add_argument("--concurrency", help="threads for the thread per host run",
+                        type=int, default=16)
+    parser.add_argument("--io-threads", help="I/O threads of the multiplexed run", type=int,
+                        default=16)
+    parser.add_argument("-d", help="show debug logging", action="store_true", dest="debug")
+    args = parser.parse_args()
+
+    for name in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
+        os.environ.pop(name, None)
+    os.environ["no_proxy"] = "*"
+
+    logger = get_logger(args.debug)
+    simulators = start_fleet(args.hosts, 0, {"latency": args.latency, "run_time": args.run_time})
+    hosts = str(args.hosts)
+    runs = [
+        ("threads x%s" % args.concurrency, ["--concurrency", str(args.concurrency)]),
+        ("threads x%s" % min(args.hosts, c.MAX_CONCURRENCY), ["--concurrency", hosts]),
+        ("multiplex /%s" % args.io_threads, [
+            "--multiplex", "--concurrency", hosts, "--io-threads", str(args.io_threads)
+        ]),
+    ]
+    results = []
+
+    try:
+        for name, extra in runs:
+            results.append((name, scenario(logger, simulators, extra)))
+    finally:
+        for simulator in simulators:
+            simulator.stop()
+
+    print("%-18s %10s %10s %10s %10s" % ("scenario", "wall s", "hosts ok", "threads",
+                                         "requests"))
+    for name, result in results:
+        print("%-18s %10.1f %10s %10s %10s" % (
+            name, result["wall_s"], result["ok"], result["threads"], result["requests"]
+        ))
+
+    return 0 if all(r["ok"] == args.hosts for _n, r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
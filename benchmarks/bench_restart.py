@@ -0,0 +1,156 @@
+"""Rolling restart of a fleet of simulated hosts
+
+Each host is a simulator on its own loopback address. A shutdown command makes it stop
+listening, then come back after a reboot time picked at random between --reboot-min and
+--reboot-max, with WinRM taking --ready-delay seconds longer to accept sessions. The rolling
+restart is compared with what fixed sleeps would need, a sleep long enough for the slowest
+reboot after each wave, and the most hosts seen down at once is checked against
+--max-unavailable. --fast-reboots hosts come back too quickly for the port checks to see them
+down, so only their new boot time shows they restarted.
+"""
+import sys
+import time
+import random
+import argparse
+import threading
+
+from bench_transport import build_args, get_logger
+from winrm_simulator import WinRMSimulator, default_handler
+
+import constants as c
+from command_builder import CommandBuilder
+from rolling import RollingRestart, wave_size
+
+
+class RebootingHost:
+    """A simulator that goes away for a while when told to shut down"""
+
+    def __init__(self, host, port, reboot_time, ready_delay, fleet_state):
+        self.host = host
+        self.port = port
+        self.reboot_time = reboot_time
+        self.ready_delay = ready_delay
+        self.fleet_state = fleet_state
+        self.output = default_handler(1, 10)
+        self.boot_time = time.time()
+        self.simulator = self._start()
+        # Come back on the same port
+        self.port = self.simulator.port
+
+    def _start(self, refusing=False):
+        """Listen on the port, refusing sessions (a failed pipeline) while WinRM starts"""
+        return WinRMSimulator(
+            host=self.host, port=self.port, handler=self.handler,
+            failure_rate=1.0 if refusing else 0.0
+        ).start()
+
+    def handler(self, command):
+        if "shutdown" in command:
+            threading.Thread(target=self._reboot, daemon=True).start()
+
+        if "LastBootUpTime" in command:
+            return [time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.boot_time))]
+
+        return self.output(command)
+
+    def _reboot(self):
+        """Go down once the command has been answered, come back after the reboot time"""
+        time.sleep(0.2)
+        self.simulator.stop()
+        self.fleet_state.down(self.host)
+        time.sleep(self.reboot_time)
+        self.boot_time = time.time()
+        self.simulator = self._start(refusing=self.ready_delay > 0)
+        time.sleep(self.ready_delay)
+        self.simulator.failure_rate = 0.0
+        self.fleet_state.up(self.host)
+
+    def stop(self):
+        self.simulator.stop()
+
+
+class FleetState:
+    """Which hosts are down, and the most seen down at once"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.unavailable = set()
+        self.max_unavailable = 0
+
+    def down(self, host):
+        with self.lock:
+            self.unavailable.add(host)
+            self.max_unavailable = max(self.max_unavailable, len(self.unavailable))
+
+    def up(self, host):
+        with self.lock:
+            self.unavailable.discard(host)
+
+
+def main():
+    """Restart the simulated fleet and show how long it took"""
+    parser = argparse.ArgumentParser(description="Rolling restart benchmark")
+    parser.add_argument("--hosts", help="simulated hosts", type=int, default=8)
+    parser.add_argument("--max-unavailable", help="hosts (or %%) down at once", type=str,
+                        default="25%")
+    parser.add_argument("--reboot-min", help="shortest reboot, seconds", type=float,
+                        default=2.0)
+    parser.add_argument("--reboot-max", help="longest reboot, seconds", type=float,
+                        default=6.0)
+    parser.add_argument("--ready-delay", help="seconds WinRM refuses sessions after the port "
+                        "is back", type=float, default=1.0)
+    parser.add_argument("--fast-reboots", help="hosts back before a port check sees them down",
+                        type=int, default=1)
+    parser.add_argument("-d", help="show debug logging", action="store_true", dest="debug")
+    args = parser.parse_args()
+
+    logger = get_logger(args.debug)
+    rng = random.Random(1)
+    state = FleetState()
+    names = ["127.0.0.%s" % (i + 2) for i in range(args.hosts)]
+    first = RebootingHost(names[0], 0, rng.uniform(args.reboot_min, args.reboot_max),
+                          args.ready_delay, state)
+    hosts = [first] + [
+        RebootingHost(name, first.simulator.port, rng.uniform(args.reboot_min, args.reboot_max),
+                      args.ready_delay, state)
+        for name in names[1:]
+    ]
+
+    for host in hosts[-args.fast_reboots:] if args.fast_reboots > 0 else []:
+        host.reboot_time = 0.05
+        host.ready_delay = 0.0
+
+    run_args = build_args(",".join(names), first.simulator.port, [
+        "--max-unavailable", args.max_unavailable, "--restart-timeout", "120"
+    ])
+    run_args.task, run_args.option = "shutdown", "restart-now"
+    command_detail = CommandBuilder(logger, run_args).get_command()
+
+    try:
+        _start = time.monotonic()
+        fleet = RollingRestart(logger, run_args, "bench", names)
+        all_ok = fleet.run(command_detail)
+        elapsed = time.monotonic() - _start
+    finally:
+        for host in hosts:
+            host.stop()
+
+    size = wave_size(args.max_unavailable, args.hosts)
+    waves = [hosts[i:i + size] for i in range(0, len(hosts), size)]
+    # A fixed sleep has to cover the slowest host there could be, not the one in the wave
+    fixed = len(waves) * (args.reboot_max + args.ready_delay + c.RESTART_POLL_INTERVAL)
+    ready = [r["timings"].get(c.STAGE_READY, 0.0) for r in fleet.results.values()]
+
+    print("hosts restarted:      %s of %s (%s)" % (
+        fleet.counts[c.HOST_SUCCESS], args.hosts, "ok" if all_ok else "failed"
+    ))
+    print("waves:                %s of up to %s" % (len(waves), size))
+    print("most down at once:    %s" % state.max_unavailable)
+    print("rolling restart:      %.1f seconds" % elapsed)
+    print("fixed sleeps:         %.1f seconds" % fixed)
+    print("slowest ready check:  %.1f seconds" % max(ready))
+
+    return 0 if all_ok and state.max_unavailable <= size else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
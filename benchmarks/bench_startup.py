@@ -0,0 +1,143 @@
+"""Startup benchmark for manage_device.py
+
+Measures the import time of the modules, the wall time of the fast exits (--help, an invalid
+option) and the wall time until the first byte reaches a local listener standing in for
+the Windows host. Each figure is the median of --repeat runs, use the --max-* options to fail
+(exit code 1) when a figure goes over a threshold.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+
+WIN_MGT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "win_mgt")
+SCRIPT = "manage_device.py"
+MODULES = ["manage_device", "transport_pypsrp"]
+
+_IMPORT_CODE = (
+    "import time; _t = time.perf_counter(); import %s; "
+    "print(time.perf_counter() - _t)"
+)
+
+def _run(cmd, timeout=60):
+    """Run a command from the win_mgt directory, returns the wall time"""
+    _start = time.perf_counter()
+    subprocess.run(
+        cmd, cwd=WIN_MGT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        stdin=subprocess.DEVNULL, timeout=timeout, check=False
+    )
+    return time.perf_counter() - _start
+
+def import_time(module):
+    """Time to import a module in a new interpreter"""
+    result = subprocess.run(
+        [sys.executable, "-c", _IMPORT_CODE % module], cwd=WIN_MGT_DIR,
+        capture_output=True, text=True, timeout=60, check=False
+    )
+
+    if result.returncode != 0:
+        return None
+
+    return float(result.stdout.strip())
+
+def help_time():
+    """Wall time of --help"""
+    return _run([sys.executable, SCRIPT, "--help"])
+
+def invalid_option_time():
+    """Wall time of an invalid task option, this should exit before any connection work"""
+    return _run([sys.executable, SCRIPT, "localhost", "services", "bogus", "-user", "u",
+                 "-pwd", "p"])
+
+def first_byte_time(timeout=30):
+    """Wall time from starting the script until the first byte of the WinRM request arrives"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    listener.settimeout(timeout)
+    port = listener.getsockname()[1]
+
+    # A local user means basic auth, so there is no kinit. -n skips the ping, so the first
+    # connection is the WinRM request itself
+    cmd = [
+        sys.executable, SCRIPT, "127.0.0.1", "services", "list", "-user", "u", "-pwd", "p",
+        "-port", str(port), "-n", "--connection-timeout", "11"
+    ]
+    _start = time.perf_counter()
+    ph = subprocess.Popen(
+        cmd, cwd=WIN_MGT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        stdin=subprocess.DEVNULL
+    )
+    elapsed = None
+
+    try:
+        conn, _addr = listener.accept()
+        conn.settimeout(timeout)
+
+        if len(conn.recv(1)) > 0:
+            elapsed = time.perf_counter() - _start
+
+        conn.close()
+    except socket.timeout:
+        pass
+    finally:
+        listener.close()
+        ph.kill()
+        ph.wait()
+
+    return elapsed
+
+def median(func, repeat):
+    """Median of several runs, None if any run failed"""
+    values = [func() for _ in range(repeat)]
+
+    if any(v is None for v in values):
+        return None
+
+    return statistics.median(values)
+
+def main():
+    """Run the benchmarks and check the thresholds"""
+    parser = argparse.ArgumentParser(description="manage_device.py startup benchmark")
+    parser.add_argument("--repeat", help="runs of each benchmark", type=int, default=5)
+    parser.add_argument("--max-help-ms", help="threshold for --help", type=float)
+    parser.add_argument("--max-invalid-ms", help="threshold for an invalid option", type=float)
+    parser.add_argument("--max-first-byte-ms", help="threshold for the first byte", type=float)
+    args = parser.parse_args()
+
+    results = {}
+    for module in MODULES:
+        results["import %s" % module] = median(lambda m=module: import_time(m), args.repeat)
+
+    results["--help"] = median(help_time, args.repeat)
+    results["invalid option"] = median(invalid_option_time, args.repeat)
+    results["first network byte"] = median(first_byte_time, args.repeat)
+
+    thresholds = {
+        "--help": args.max_help_ms,
+        "invalid option": args.max_invalid_ms,
+        "first network byte": args.max_first_byte_ms
+    }
+    failed = False
+
+    for name, value in results.items():
+        if value is None:
+            print("%-30s %10s" % (name, "failed"))
+            continue
+
+        line = "%-30s %8.1fms" % (name, value * 1000)
+        threshold = thresholds.get(name, None)
+
+        if threshold is not None and value * 1000 > threshold:
+            line += "  over threshold of %.1fms" % threshold
+            failed = True
+
+        print(line)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
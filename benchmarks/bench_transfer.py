@@ -0,0 +1,226 @@
+"""Throughput of filesystem push / pull against the simulator over a link of limited bandwidth
+
+The simulator keeps the "remote" files under a temporary folder and holds each request for
+the time it would take on a link of --bandwidth-mb. Each direction is run with one chunk in
+flight and with --streams, and the figures show the payload rate next to how busy the link
+was. PSRP sends the chunks base64 encoded inside base64 encoded envelopes, so the payload rate
+is a little over half of a fully used link. A last run interrupts a push part way and runs it
+again, which should only send what is missing.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import threading
+
+from bench_transport import build_args, get_logger
+from winrm_simulator import WinRMSimulator
+
+import transfer
+from transport_pypsrp import Transport
+
+
+class RemoteFiles:
+    """Stands in for the host's file system, the transfer scripts are run in Python"""
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.chunks_written = 0
+        # Called after each chunk is written, to interrupt a transfer part way
+        self.on_chunk = None
+
+    def path(self, remote_path):
+        """Where a Windows path is kept under root"""
+        relative = remote_path.replace(":", "").replace("\\", "/").lstrip("/")
+        return os.path.join(self.root, relative)
+
+    def _write(self, path, offset, data):
+        with open(path, "r+b" if os.path.exists(path) else "w+b") as fh:
+            fh.seek(offset)
+            fh.write(data)
+
+    def _verify(self, path, ranges):
+        """Offsets of the ranges the file still has"""
+        if not os.path.exists(path):
+            return []
+
+        verified = []
+        with open(path, "rb") as fh:
+            for chunk in ranges:
+                fh.seek(int(chunk["o"]))
+
+                if transfer.checksum(fh.read(chunk["l"])) == chunk["h"]:
+                    verified.append(chunk["o"])
+
+        return verified
+
+    def __call__(self, script, parameters):
+        with self.lock:
+            if script == transfer.PUSH_PREPARE_SCRIPT:
+                destination = parameters["Path"]
+
+                if os.path.isdir(self.path(destination)):
+                    destination = "%s\\%s" % (destination, parameters["Name"])
+
+                part = self.path(destination + parameters["Suffix"])
+                os.makedirs(os.path.dirname(part), exist_ok=True)
+                return [destination] + self._verify(part, json.loads(parameters["Ranges"]))
+
+            if script == transfer.PUSH_CHUNK_SCRIPT:
+                if transfer.checksum(parameters["Data"]) != parameters["Hash"]:
+                    raise ValueError("Checksum mismatch")
+
+                self._write(self.path(parameters["Part"]), int(parameters["Offset"]),
+                            parameters["Data"])
+                self.chunks_written += 1
+
+                if self.on_chunk is not None:
+                    self.on_chunk(self.chunks_written)
+                return []
+
+            if script == transfer.PUSH_FINISH_SCRIPT:
+                if os.path.isdir(self.path(parameters["Path"])):
+                    raise ValueError("%s is a folder" % parameters["Path"])
+
+                part = self.path(parameters["Part"])
+                self._write(part, 0, b"")
+                os.truncate(part, int(parameters["Length"]))
+                os.replace(part, self.path(parameters["Path"]))
+                return []
+
+            if script == transfer.PULL_PREPARE_SCRIPT:
+                stat = os.stat(self.path(parameters["Path"]))
+                return [str(stat.st_size), str(int(stat.st_mtime * 10000000))]
+
+            if script == transfer.PULL_CHUNK_SCRIPT:
+                with open(self.path(parameters["Path"]), "rb") as fh:
+                    fh.seek(int(parameters["Offset"]))
+                    data = fh.read(parameters["Length"])
+
+                return [transfer.checksum(data), data]
+
+        raise ValueError("Unknown script")
+
+
+def run_transfer(logger, args, direction, source, destination):
+    """connect / transfer / disconnect, returns the transport"""
+    transport = Transport(logger, args, args.pwd)
+    transport.connect()
+
+    try:
+        transport.run_transfer({
+            "direction": direction, "source": source, "destination": destination
+        })
+    finally:
+        transport.disconnect()
+
+    return transport
+
+def scenario(logger, simulator, direction, source, destination, streams, bandwidth):
+    """One transfer, returns the figures"""
+    args = build_args(simulator.host, simulator.port, ["--transfer-streams", str(streams)])
+    simulator.reset_stats()
+    transport = run_transfer(logger, args, direction, source, destination)
+
+    if transport.result_dict["is_error"]:
+        raise RuntimeError(transport.result_dict["stderr"])
+
+    elapsed = transport.timer.timings["run"]
+    size = os.path.getsize(destination if direction == "pull" else source)
+
+    return {
+        "mb_per_second": size / elapsed / 1048576,
+        "link_used": (simulator.stats["bytes_in"] + simulator.stats["bytes_out"]) /
+                     elapsed / bandwidth,
+        "requests": simulator.stats["requests"],
+        "summary": transport.result_dict["stdout"]
+    }
+
+def scenario_resume(logger, simulator, remote, source, streams):
+    """A push that loses the connection part way, then is run again"""
+    args = build_args(simulator.host, simulator.port, ["--transfer-streams", str(streams)])
+
+    def interrupt(chunks_written):
+        """Fail every request from here on, like a dropped link"""
+        if chunks_written == 8:
+            simulator.failure_rate = 1.0
+
+    remote.chunks_written = 0
+    remote.on_chunk = interrupt
+    first = run_transfer(logger, args, "push", source, "C:\\Resume\\payload.bin")
+    remote.on_chunk = None
+    simulator.failure_rate = 0.0
+
+    simulator.reset_stats()
+    second = run_transfer(logger, args, "push", source, "C:\\Resume\\payload.bin")
+
+    return first.result_dict["stderr"], second.result_dict["stdout"] or \
+        second.result_dict["stderr"]
+
+def main():
+    """Push and pull a payload with and without pipelining"""
+    parser = argparse.ArgumentParser(description="File transfer benchmark")
+    parser.add_argument("--size-mb", help="payload size in MB", type=int, default=64)
+    parser.add_argument("--bandwidth-mb", help="link bandwidth in MB/s", type=float,
+                        default=20.0)
+    parser.add_argument("--latency", help="seconds added to each request", type=float,
+                        default=0.005)
+    parser.add_argument("--streams", help="chunks in flight", type=int, default=4)
+    parser.add_argument("-d", help="show debug logging", action="store_true", dest="debug")
+    args = parser.parse_args()
+
+    for name in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
+        os.environ.pop(name, None)
+    os.environ["no_proxy"] = "*"
+
+    logger = get_logger(args.debug)
+    bandwidth = int(args.bandwidth_mb * 1048576)
+    work_dir = tempfile.mkdtemp(prefix="bench_transfer")
+    remote = RemoteFiles(os.path.join(work_dir, "remote"))
+    source = os.path.join(work_dir, "payload.bin")
+
+    with open(source, "wb") as fh:
+        for _ in range(args.size_mb):
+            fh.write(os.urandom(1048576))
+
+    try:
+        with WinRMSimulator(latency=args.latency, max_envelope_kb=8192, bandwidth=bandwidth,
+                            script_handler=remote) as simulator:
+            print("%-18s %10s %10s %10s" % ("scenario", "MB/s", "link used", "requests"))
+
+            for streams in sorted(set([1, args.streams])):
+                for direction in ("push", "pull"):
+                    local_path = source if direction == "push" else \
+                        os.path.join(work_dir, "pulled.bin")
+                    remote_path = "C:\\Payload\\payload.bin"
+                    result = scenario(
+                        logger, simulator, direction,
+                        local_path if direction == "push" else remote_path,
+                        remote_path if direction == "push" else local_path,
+                        streams, bandwidth
+                    )
+                    print("%-18s %10.1f %9.0f%% %10s" % (
+                        "%s x%s" % (direction, streams), result["mb_per_second"],
+                        result["link_used"] * 100, result["requests"]
+                    ))
+
+            interrupted, resumed = scenario_resume(logger, simulator, remote, source,
+                                                   args.streams)
+            print("\nInterrupted: %s\nRun again: %s" % (interrupted, resumed))
+
+            # An existing folder given without a trailing slash keeps the name of the file
+            os.makedirs(remote.path("C:\\Folder"))
+            folder = scenario(logger, simulator, "push", source, "C:\\Folder", args.streams,
+                              bandwidth)
+            print("To a folder: %s" % folder["summary"])
+            folder_ok = os.path.isfile(remote.path("C:\\Folder\\payload.bin"))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return 0 if folder_ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""End to end benchmarks of Transport and Fleet against the local WinRM simulator
+
+Each scenario drives the real code paths (pypsrp, session reuse, batching, the fleet) over
+HTTP to winrm_simulator.py, so round trips, latency and throughput can be compared between
+changes without a Windows host. The simulator adds --latency to every request, which stands
+in for the network.
+
+Figures are printed as a table, --json writes them to a file and --thresholds reads a JSON file
+of limits such as {"single reuse": {"p95_ms": 50, "requests": 4}} - going over any limit
+gives exit code 1.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+
+WIN_MGT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "win_mgt")
+sys.path.insert(0, os.path.abspath(WIN_MGT_DIR))
+
+import argument_defs
+from transport_pypsrp import Transport
+from fleet import Fleet
+from timing import percentile
+from winrm_simulator import WinRMSimulator
+
+COMMAND = "Get-Service"
+RAW_COMMAND = "dir"
+BATCH_SIZE = 10
+
+def build_args(server, port, extra=None):
+    """The inputs manage_device.py would have for a run against the simulator"""
+    parser = argparse.ArgumentParser()
+    argument_defs.args_positional(parser)
+    argument_defs.args_credentials(parser)
+    argument_defs.args_connect(parser)
+    argument_defs.args_session(parser)
+    argument_defs.args_kerberos(parser)
+    argument_defs.args_optional(parser)
+    argument_defs.args_results(parser)
+    argument_defs.args_fleet(parser)
+    argument_defs.args_transfer(parser)
+    argument_defs.args_command(parser)
+
+    # A local user over HTTP means basic auth and no message encryption
+    argv = [
+        server, "services", "list", "-user", "bench", "-pwd", "bench", "-protocol", "HTTP",
+        "-port", str(port), "--msg-encryption", "never", "-n"
+    ]
+    return parser.parse_args(argv + (extra or []))
+
+def get_logger(debug=False):
+    """Logger for the code under test, quiet unless debugging"""
+    logger = logging.Logger("bench_transport")
+    logger.level = logging.DEBUG if debug else logging.CRITICAL
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    return logger
+
+def summarise(timings, requests, count=1):
+    """Figures for a scenario, timings are seconds per iteration"""
+    return {
+        "iterations": len(timings),
+        "p50_ms": statistics.median(timings) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "max_ms": max(timings) * 1000,
+        "requests": requests / float(len(timings)),
+        "per_second": count * len(timings) / sum(timings)
+    }
+
+def run_once(logger, args, command, is_raw=False, close=False):
+    """connect / run / read / disconnect, returns True if the command worked"""
+    transport = Transport(logger, args, args.pwd)
+    transport.connect(is_raw)
+
+    try:
+        return transport.run_command(command) and transport.get_results()
+    finally:
+        transport.disconnect(close)
+
+def scenario_single(logger, simulator, iterations, close):
+    """One command per connection, with the session reused or closed each time"""
+    args = build_args(simulator.host, simulator.port)
+    # Warm up - the first run opens the session that later runs reuse
+    run_once(logger, args, COMMAND, close=close)
+    simulator.reset_stats()
+    timings = []
+
+    for _ in range(iterations):
+        _start = time.perf_counter()
+        if not run_once(logger, args, COMMAND, close=close):
+            raise RuntimeError("Command failed against the simulator")
+        timings.append(time.perf_counter() - _start)
+
+    return summarise(timings, simulator.stats["requests"])
+
+def scenario_raw(logger, simulator, iterations, close=False, expire=False):
+    """A non-PowerShell command per connection, with the cmd shell reused or closed each time.
+    With expire the simulator drops its shells before each command, as WinRM does with idle
+    ones, so each reused shell has to be replaced"""
+    args = build_args(simulator.host, simulator.port)
+    # Warm up - the first run opens the shell that later runs reuse
+    run_once(logger, args, RAW_COMMAND, is_raw=True, close=close)
+    simulator.reset_stats()
+    timings = []
+
+    for _ in range(iterations):
+        if expire:
+            simulator.expire_shells()
+
+        _start = time.perf_counter()
+        if not run_once(logger, args, RAW_COMMAND, is_raw=True, close=close):
+            raise RuntimeError("Command failed against the simulator")
+        timings.append(time.perf_counter() - _start)
+
+    return summarise(timings, simulator.stats["requests"])
+
+def scenario_sequential(logger, simulator, iterations):
+    """BATCH_SIZE commands run one after another on the same connection"""
+    args = build_args(simulator.host, simulator.port)
+    run_once(logger, args, COMMAND)
+    simulator.reset_stats()
+    timings = []
+
+    for _ in range(iterations):
+        _start = time.perf_counter()
+        transport = Transport(logger, args, args.pwd)
+        transport.connect()
+
+        for i in range(BATCH_SIZE):
+            transport.run_command("%s %s" % (COMMAND, i))
+            transport.get_results()
+
+        transport.disconnect()
+        timings.append(time.perf_counter() - _start)
+
+    return summarise(timings, simulator.stats["requests"], BATCH_SIZE)
+
+def scenario_batch(logger, simulator, iterations):
+    """BATCH_SIZE commands sent as one batch"""
+    args = build_args(simulator.host, simulator.port)
+    run_once(logger, args, COMMAND)
+    simulator.reset_stats()
+    commands = ["%s %s" % (COMMAND, i) for i in range(BATCH_SIZE)]
+    timings = []
+
+    for _ in range(iterations):
+        _start = time.perf_counter()
+        transport = Transport(logger, args, args.pwd)
+        transport.connect()
+        transport.run_commands(commands)
+        transport.get_results()
+        transport.disconnect()
+        timings.append(time.perf_counter() - _start)
+
+    return summarise(timings, simulator.stats["requests"], BATCH_SIZE)
+
+def scenario_fleet(logger, simulators, concurrency, processes=1):
+    """One command against every simulator, concurrency hosts at a time across processes"""
+    hosts = [s.host for s in simulators]
+    args = build_args(",".join(hosts), simulators[0].port, [
+        "--concurrency", str(concurrency), "--processes", str(processes)
+    ])
+    for simulator in simulators:
+        simulator.reset_stats()
+
+    fleet = Fleet(logger, args, args.pwd, hosts)
+    _start = time.perf_counter()
+    fleet.run({"command": COMMAND, "command_type_raw": False})
+    elapsed = time.perf_counter() - _start
+
+    if fleet.counts["success"] != len(hosts):
+        raise RuntimeError("%s hosts failed" % (len(hosts) - fleet.counts["success"]))
+
+    durations = [r["duration"] for r in fleet.results.values()]
+    result = summarise(durations, sum(s.stats["requests"] for s in simulators))
+    result["wall_ms"] = elapsed * 1000
+    result["per_second"] = len(hosts) / elapsed
+
+    return result
+
+def start_fleet(count, port, options):
+    """A simulator per loopback address (127.0.0.2 onwards), all on the same port"""
+    simulators = [WinRMSimulator("127.0.0.2", port, **options).start()]
+
+    for i in range(1, count):
+        simulators.append(WinRMSimulator("127.0.0.%s" % (i + 2), simulators[0].port,
+                                         **options).start())
+
+    return simulators
+
+def check_thresholds(results, thresholds):
+    """Names of the figures over their limit"""
+    failed = []
+
+    for name, limits in thresholds.items():
+        for key, limit in limits.items():
+            value = results.get(name, {}).get(key, None)
+
+            if value is None or value > limit:
+                failed.append("%s %s: %s (limit %s)" % (name, key, value, limit))
+
+    return failed
+
+def main():
+    """Run the scenarios, show the figures and check the thresholds"""
+    parser = argparse.ArgumentParser(description="Transport benchmarks against a simulator")
+    parser.add_argument("--iterations", help="runs of each scenario", type=int, default=20)
+    parser.add_argument("--latency", help="seconds added to each request", type=float,
+                        default=0.002)
+    parser.add_argument("--lines", help="output lines per command", type=int, default=100)
+    parser.add_argument("--line-size", help="characters per output line", type=int, default=80)
+    parser.add_argument("--hosts", help="hosts in the fleet scenario", type=int, default=20)
+    parser.add_argument("--concurrency", help="fleet concurrency", type=int, default=10)
+    parser.add_argument("--processes", help="fleet worker processes", type=int, default=1)
+    parser.add_argument("--json", help="write the figures to this file", type=str)
+    parser.add_argument("--thresholds", help="JSON file of limits per scenario", type=str)
+    parser.add_argument("-d", help="show debug logging", action="store_true", dest="debug")
+    args = parser.parse_args()
+
+    # Connections go straight to the loopback simulators
+    for name in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
+        os.environ.pop(name, None)
+    os.environ["no_proxy"] = "*"
+
+    logger = get_logger(args.debug)
+    options = {"latency": args.latency, "lines": args.lines, "line_size": args.line_size}
+    results = {}
+
+    with WinRMSimulator(**options) as simulator:
+        results["single reuse"] = scenario_single(logger, simulator, args.iterations, False)
+        results["single close"] = scenario_single(logger, simulator, args.iterations, True)
+        results["raw reuse"] = scenario_raw(logger, simulator, args.iterations)
+        results["raw close"] = scenario_raw(logger, simulator, args.iterations, close=True)
+        results["raw expired"] = scenario_raw(logger, simulator, args.iterations, expire=True)
+        results["sequential x%s" % BATCH_SIZE] = scenario_sequential(
+            logger, simulator, args.iterations
+        )
+        results["batch x%s" % BATCH_SIZE] = scenario_batch(logger, simulator, args.iterations)
+
+    simulators = start_fleet(args.hosts, 0, options)
+    try:
+        results["fleet x%s" % args.hosts] = scenario_fleet(
+            logger, simulators, args.concurrency
+        )
+
+        if args.processes > 1:
+            results["fleet x%s /%s" % (args.hosts, args.processes)] = scenario_fleet(
+                logger, simulators, args.concurrency, args.processes
+            )
+    finally:
+        for simulator in simulators:
+            simulator.stop()
+
+    print("%-18s %10s %10s %10s %10s %12s" % (
+        "scenario", "p50 ms", "p95 ms", "max ms", "requests", "per second"
+    ))
+    for name, result in results.items():
+        print("%-18s %10.1f %10.1f %10.1f %10.1f %12.1f" % (
+            name, result["p50_ms"], result["p95_ms"], result["max_ms"], result["requests"],
+            result["per_second"]
+        ))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.thresholds:
+        with open(args.thresholds, "r", encoding="utf-8") as fh:
+            failed = check_thresholds(results, json.load(fh))
+
+        for line in failed:
+            print("Over threshold: %s" % line)
+
+        return 1 if len(failed) > 0 else 0
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
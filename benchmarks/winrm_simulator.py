@@ -0,0 +1,724 @@
+"""A local stand-in for a Windows host's WinRM endpoint
+
+Speaks enough WSMan (HTTP, basic auth, no message encryption) and PSRP for pypsrp's
+RunspacePool / PowerShell.invoke and Client.execute_cmd, so Transport can be measured without
+a Windows host. Every request can be delayed (latency), held to the time it would take on a
+link of a given bandwidth or failed (failure_rate), output size is set with lines/line_size
+(or a handler), and Receive responses are split to fit the MaxEnvelopeSize the client asks
+for, like WinRM does. Scripts with parameters can be handed to
+a script_handler instead, which is how file transfers are simulated. Pipelines can be made to
+run for a while (run_time), a Receive then waits for them up to the client's OperationTimeout
+and answers with a TimedOut fault if they are still running, like WinRM does.
+
+Can be run on its own to serve until interrupted:
+
+    python winrm_simulator.py --port 5985 --latency 0.005 --lines 1000
+"""
+import re
+import sys
+import time
+import uuid
+import base64
+import random
+import struct
+import argparse
+import threading
+import collections
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NS = {
+    "s": "http://www.w3.org/2003/05/soap-envelope",
+    "wsa": "http://schemas.xmlsoap.org/ws/2004/08/addressing",
+    "wst": "http://schemas.xmlsoap.org/ws/2004/09/transfer",
+    "wsman": "http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd",
+    "rsp": "http://schemas.microsoft.com/wbem/wsman/1/windows/shell",
+    "cfg": "http://schemas.microsoft.com/wbem/wsman/1/config",
+    "pwsh": "http://schemas.microsoft.com/powershell",
+}
+ACTION_BASE = {
+    "transfer": "http://schemas.xmlsoap.org/ws/2004/09/transfer/",
+    "shell": "http://schemas.microsoft.com/wbem/wsman/1/windows/shell/",
+}
+PSRP_URI = "http://schemas.microsoft.com/powershell/"
+DEFAULT_MAX_ENVELOPE_KB = 500
+
+# PSRP message types and states used by the simulator
+MSG_SESSION_CAPABILITY = 0x00010002
+MSG_SET_MAX_RUNSPACES = 0x00021002
+MSG_RUNSPACE_AVAILABILITY = 0x00021004
+MSG_RUNSPACEPOOL_STATE = 0x00021005
+MSG_APPLICATION_PRIVATE_DATA = 0x00021009
+MSG_PIPELINE_OUTPUT = 0x00041004
+MSG_PIPELINE_STATE = 0x00041006
+DESTINATION_CLIENT = 1
+RUNSPACEPOOL_OPENED = 2
+PIPELINE_COMPLETED = 4
+PIPELINE_FAILED = 5
+# WSMan fault for a Receive that had nothing to give within the OperationTimeout
+FAULT_TIMED_OUT = 2150858793
+
+FRAGMENT_HEADER_SIZE = 21
+# Room left for the SOAP envelope around the streams of a Receive response
+ENVELOPE_OVERHEAD = 2048
+# cmd output is sent in blocks as the process writes it, rather than line by line
+RAW_CHUNK_SIZE = 4096
+
+_CLIXML_ESCAPE = re.compile(r"_x([0-9A-Fa-f]{4})_")
+# A batch script writes a marker line before and after each command, which runs in a try block
+BATCH_MARKER_LINE = re.compile(r"^Write-Output '(\S+ (?:BEGIN|END) \d+)'$")
+BATCH_COMMAND_LINE = "try { Invoke-Expression"
+
+def _clixml_unescape(value):
+    """Strings in CLIXML escape control characters as _xHHHH_"""
+    return _CLIXML_ESCAPE.sub(lambda m: chr(int(m.group(1), 16)), value or "")
+
+def _clixml_string(value):
+    """A string as a CLIXML element"""
+    return "<S>%s</S>" % escape(value)
+
+def _pack_message(message_type, rpid, pid, body):
+    """A PSRP message to the client, body is the CLIXML"""
+    empty = uuid.UUID(int=0)
+    data = struct.pack("<I", DESTINATION_CLIENT) + struct.pack("<I", message_type)
+    data += (rpid or empty).bytes_le + (pid or empty).bytes_le
+    return data + b"\xef\xbb\xbf" + body.encode("utf-8")
+
+def _session_capability(rpid):
+    """SESSION_CAPABILITY message"""
+    body = (
+        '<Obj RefId="0"><MS><Version N="protocolversion">2.3</Version>'
+        '<Version N="PSVersion">2.0</Version>'
+        '<Version N="SerializationVersion">1.1.0.1</Version></MS></Obj>'
+    )
+    return _pack_message(MSG_SESSION_CAPABILITY, rpid, None, body)
+
+def _application_private_data(rpid):
+    """APPLICATION_PRIVATE_DATA message with an empty dictionary"""
+    body = (
+        '<Obj RefId="0"><MS><Obj N="ApplicationPrivateData" RefId="1">'
+        '<TN RefId="0"><T>System.Management.Automation.PSPrimitiveDictionary</T>'
+        '<T>System.Collections.Hashtable</T><T>System.Object</T></TN><DCT /></Obj></MS></Obj>'
+    )
+    return _pack_message(MSG_APPLICATION_PRIVATE_DATA, rpid, None, body)
+
+def _runspacepool_state(rpid, state):
+    """RUNSPACEPOOL_STATE message"""
+    body = '<Obj RefId="0"><MS><I32 N="RunspaceState">%d</I32></MS></Obj>' % state
+    return _pack_message(MSG_RUNSPACEPOOL_STATE, rpid, None, body)
+
+def _clixml_value(value):
+    """A string, byte array or number as a CLIXML element"""
+    if isinstance(value, bytes):
+        return "<BA>%s</BA>" % base64.b64encode(value).decode()
+
+    if isinstance(value, int):
+        return "<I64>%d</I64>" % value
+
+    return _clixml_string(value)
+
+def _pipeline_output(rpid, pid, value):
+    """PIPELINE_OUTPUT message holding one object"""
+    return _pack_message(MSG_PIPELINE_OUTPUT, rpid, pid, _clixml_value(value))
+
+def _runspace_availability(rpid, ci):
+    """RUNSPACE_AVAILABILITY message, the answer to SET_MAX_RUNSPACES"""
+    body = (
+        '<Obj RefId="0"><MS><B N="SetMinMaxRunspacesResponse">true</B>'
+        '<I64 N="ci">%d</I64></MS></Obj>' % ci
+    )
+    return _pack_message(MSG_RUNSPACE_AVAILABILITY, rpid, None, body)
+
+def _pipeline_state(rpid, pid, state):
+    """PIPELINE_STATE message"""
+    body = '<Obj RefId="0"><MS><I32 N="PipelineState">%d</I32></MS></Obj>' % state
+    return _pack_message(MSG_PIPELINE_STATE, rpid, pid, body)
+
+def _unpack_fragments(data):
+    """Split PSRP fragments - returns a list of (object_id, fragment_id, start, end, data)"""
+    fragments = []
+
+    while len(data) >= FRAGMENT_HEADER_SIZE:
+        object_id, fragment_id, flags, length = struct.unpack(">QQBI", data[:21])
+        fragments.append((object_id, fragment_id, flags & 1 == 1, flags & 2 == 2,
+                          data[21:21 + length]))
+        data = data[21 + length:]
+
+    return fragments
+
+def _message_ids(message):
+    """The runspace pool and pipeline ids of a PSRP message from the client"""
+    return uuid.UUID(bytes_le=message[8:24]), uuid.UUID(bytes_le=message[24:40])
+
+def _message_xml(message):
+    """The CLIXML of a PSRP message from the client, None if it can't be read"""
+    body = message[40:]
+
+    if body.startswith(b"\xef\xbb\xbf"):
+        body = body[3:]
+
+    try:
+        return ET.fromstring(body.decode("utf-8"))
+    except ET.ParseError:
+        return None
+
+def _clixml_decode(element):
+    """The Python value of a CLIXML element"""
+    if element.tag == "BA":
+        return base64.b64decode(element.text or "")
+
+    if element.tag in ("I32", "I64"):
+        return int(element.text)
+
+    if element.tag == "B":
+        return element.text == "true"
+
+    return _clixml_unescape(element.text)
+
+def _pipeline_script(message):
+    """The script and the named parameters of a CREATE_PIPELINE message, (None, {}) if the
+    pipeline is not a script"""
+    root = _message_xml(message)
+
+    if root is None:
+        return None, {}
+
+    script = None
+    parameters = {}
+
+    for command in root.iter("MS"):
+        if command.find("B[@N='IsScript']") is None:
+            continue
+
+        if command.findtext("B[@N='IsScript']") == "true":
+            script = _clixml_unescape(command.findtext("S[@N='Cmd']"))
+
+        for argument in command.iter("MS"):
+            name = argument.find("S[@N='N']")
+            value = argument.find("*[@N='V']")
+
+            if name is not None and value is not None:
+                parameters[name.text] = _clixml_decode(value)
+
+        break
+
+    return script, parameters
+
+def _pipeline_command(message):
+    """The command text of a CREATE_PIPELINE message (commands, scripts and argument values)"""
+    root = _message_xml(message)
+
+    if root is None:
+        return ""
+
+    parts = [
+        _clixml_unescape(e.text) for e in root.iter()
+        if e.attrib.get("N") in ("Cmd", "V") and e.text is not None
+    ]
+    return " ".join(parts)
+
+def default_handler(lines, line_size):
+    """A handler returning the same output for every command, each command of a batch gets it
+    between the marker lines the batch script writes (see batch.py)"""
+    line = "x" * line_size
+
+    def handler(command):
+        """Output lines for a command"""
+        output = []
+
+        for script_line in command.splitlines():
+            match = BATCH_MARKER_LINE.match(script_line)
+
+            if match is not None:
+                output.append(match.group(1))
+            elif script_line.startswith(BATCH_COMMAND_LINE):
+                output.extend([line] * lines)
+
+        return output or [line] * lines
+
+    return handler
+
+
+class _Shell:
+    """A WinRS shell - PSRP (runspace pool) or cmd"""
+
+    def __init__(self, resource_uri):
+        self.id = str(uuid.uuid4()).upper()
+        self.resource_uri = resource_uri
+        self.is_psrp = resource_uri.startswith(PSRP_URI)
+        self.rpid = None
+        self.object_id = 0
+        self.pending = collections.deque()
+        self.commands = {}
+        self.incoming = {}
+
+    def fragment(self, message, max_size):
+        """Split a message into fragments and queue them"""
+        self.object_id += 1
+        chunks = [message[i:i + max_size] for i in range(0, len(message), max_size)] or [b""]
+
+        fragments = []
+        for i, chunk in enumerate(chunks):
+            flags = (1 if i == 0 else 0) | (2 if i == len(chunks) - 1 else 0)
+            fragments.append(struct.pack(">QQBI", self.object_id, i, flags, len(chunk)) + chunk)
+
+        return fragments
+
+
+class _Command:
+    """A pipeline or cmd process running in a shell"""
+
+    def __init__(self, command_id):
+        self.id = command_id
+        self.pid = None
+        self.messages = None
+        self.fragments = collections.deque()
+        self.stdout = collections.deque()
+        self.done = False
+        self.received = b""
+        # When the pipeline's output is ready (time.monotonic)
+        self.ready_at = 0.0
+
+
+class WinRMSimulator:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, lines=10, line_size=80,
+                 failure_rate=0.0, max_envelope_kb=DEFAULT_MAX_ENVELOPE_KB, handler=None,
+                 seed=None, deny_config=False, script_handler=None, bandwidth=0, run_time=0.0):
+        self.host = host
+        self.latency = latency
+        # Seconds each pipeline runs before its output is ready
+        self.run_time = run_time
+        # Bytes per second of the simulated link, 0 for no limit
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.max_envelope_kb = max_envelope_kb
+        # Reading the WinRM config needs admin rights, this acts as a non-admin user
+        self.deny_config = deny_config
+        self.handler = handler or default_handler(lines, line_size)
+        # script_handler(script, parameters) gives the output objects of a script pipeline,
+        # raising an exception fails the pipeline
+        self.script_handler = script_handler
+        self.random = random.Random(seed)
+        self.shells = {}
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def _handler_class(self):
+        """Request handler bound to this simulator"""
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out separately, with Nagle on each response waits on an ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", "0"))
+                request = self.rfile.read(length) if length > 0 else b""
+                status, response = simulator.handle(request)
+
+                if simulator.bandwidth > 0:
+                    time.sleep((len(request) + len(response)) / float(simulator.bandwidth))
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/soap+xml;charset=UTF-8")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                return
+
+        return Handler
+
+    def start(self):
+        """Serve on a background thread"""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def expire_shells(self):
+        """Forget every shell, as WinRM does when they have been idle too long"""
+        with self.lock:
+            self.shells.clear()
+
+    def reset_stats(self):
+        """Clear the request counters"""
+        with self.lock:
+            self.stats.clear()
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def _envelope(self, action, relates_to, body):
+        """Wrap a response body in a SOAP envelope"""
+        return (
+            '<s:Envelope xmlns:s="%s" xmlns:wsa="%s" xmlns:wst="%s" xmlns:wsman="%s" '
+            'xmlns:rsp="%s" xmlns:cfg="%s"><s:Header><wsa:Action>%s</wsa:Action>'
+            '<wsa:MessageID>uuid:%s</wsa:MessageID><wsa:RelatesTo>%s</wsa:RelatesTo>'
+            '</s:Header><s:Body>%s</s:Body></s:Envelope>'
+            % (NS["s"], NS["wsa"], NS["wst"], NS["wsman"], NS["rsp"], NS["cfg"], action,
+               str(uuid.uuid4()).upper(), relates_to, body)
+        ).encode("utf-8")
+
+    def _fault(self, relates_to, code, reason):
+        """A WSMan fault, sent with HTTP 500"""
+        body = (
+            '<s:Fault><s:Code><s:Value>s:Receiver</s:Value></s:Code><s:Reason>'
+            '<s:Text xml:lang="en-US">%s</s:Text></s:Reason><s:Detail>'
+            '<f:WSManFault xmlns:f="http://schemas.microsoft.com/wbem/wsman/1/wsmanfault" '
+            'Code="%d" Machine="simulator"><f:Message>%s</f:Message></f:WSManFault>'
+            '</s:Detail></s:Fault>' % (escape(reason), code, escape(reason))
+        )
+        return 500, self._envelope(
+            "http://schemas.dmtf.org/wbem/wsman/1/wsman/fault", relates_to, body
+        )
+
+    def handle(self, request):
+        """Handle one WSMan request, returns the HTTP status and response body"""
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        self._count("requests")
+        self._count("bytes_in", len(request))
+
+        try:
+            envelope = ET.fromstring(request)
+        except ET.ParseError:
+            return 400, b""
+
+        header = envelope.find("s:Header", NS)
+        body = envelope.find("s:Body", NS)
+        action = header.findtext("wsa:Action", "", NS)
+        message_id = header.findtext("wsa:MessageID", "", NS)
+        resource_uri = header.findtext("wsman:ResourceURI", "", NS)
+        max_envelope = int(header.findtext("wsman:MaxEnvelopeSize", "153600", NS))
+        shell_id = None
+
+        for selector in header.iter("{%s}Selector" % NS["wsman"]):
+            if selector.attrib.get("Name") == "ShellId":
+                shell_id = selector.text
+
+        name = action.rsplit("/", 1)[-1]
+        self._count(name)
+
+        if self.failure_rate > 0 and self.random.random() < self.failure_rate:
+            self._count("injected_failures")
+            return self._fault(message_id, 2150858843, "Injected failure")
+
+        with self.lock:
+            shell = self.shells.get(shell_id, None) if shell_id else None
+
+        if shell_id and shell is None and name != "Get":
+            return self._fault(message_id, 2150858843, "The shell was not found")
+
+        if max_envelope > self.max_envelope_kb * 1024:
+            self._count("envelope_rejected")
+            return self._fault(
+                message_id, 2150858817, "MaxEnvelopeSize is larger than MaxEnvelopeSizekb"
+            )
+
+        if name == "Get" and self.deny_config:
+            return self._fault(message_id, 5, "Access is denied.")
+
+        if name == "Receive" and not self._wait_ready(shell, body, header):
+            self._count("timed_out")
+            return self._fault(message_id, FAULT_TIMED_OUT, "The operation timed out")
+
+        handlers = {
+            "Create": lambda: self._create(resource_uri, body, max_envelope),
+            "Command": lambda: self._command(shell, body, max_envelope),
+            "Send": lambda: self._send(shell, body, max_envelope),
+            "Receive": lambda: self._receive(shell, body, max_envelope),
+            "Signal": lambda: self._signal(shell, body),
+            "Delete": lambda: self._delete(shell),
+            "Get": lambda: self._get(resource_uri),
+        }
+
+        if name not in handlers:
+            return self._fault(message_id, 2150858817, "Unsupported action %s" % action)
+
+        response_body = handlers[name]()
+        response = self._envelope(action + "Response", message_id, response_body)
+        self._count("bytes_out", len(response))
+
+        return 200, response
+
+    def _create(self, resource_uri, body, max_envelope):
+        """Create a shell, for PSRP this also opens the runspace pool"""
+        shell = _Shell(resource_uri)
+        creation = body.find(".//pwsh:creationXml", NS)
+
+        if shell.is_psrp and creation is not None:
+            for _o, _f, _s, _e, message in _unpack_fragments(base64.b64decode(creation.text)):
+                shell.rpid, _pid = _message_ids(message)
+                break
+
+            max_size = self._fragment_size(max_envelope)
+            for message in (_session_capability(shell.rpid),
+                            _application_private_data(shell.rpid),
+                            _runspacepool_state(shell.rpid, RUNSPACEPOOL_OPENED)):
+                shell.pending.extend(shell.fragment(message, max_size))
+
+        with self.lock:
+            self.shells[shell.id] = shell
+
+        return (
+            '<wst:ResourceCreated><wsa:Address>http://simulator/wsman</wsa:Address>'
+            '<wsa:ReferenceParameters><wsman:ResourceURI>%s</wsman:ResourceURI>'
+            '<wsman:SelectorSet><wsman:Selector Name="ShellId">%s</wsman:Selector>'
+            '</wsman:SelectorSet></wsa:ReferenceParameters></wst:ResourceCreated>'
+            '<rsp:Shell><rsp:ShellId>%s</rsp:ShellId><rsp:ResourceUri>%s</rsp:ResourceUri>'
+            '</rsp:Shell>' % (resource_uri, shell.id, shell.id, resource_uri)
+        )
+
+    def _fragment_size(self, max_envelope):
+        """Largest fragment that fits a Receive response once base64 encoded"""
+        return max(256, int((max_envelope - ENVELOPE_OVERHEAD) / 4 * 3) - FRAGMENT_HEADER_SIZE)
+
+    def _wait_ready(self, shell, body, header):
+        """Hold a Receive until the pipeline has finished running, at most the client's
+        OperationTimeout. Returns False if it is still running"""
+        desired = body.find("rsp:Receive/rsp:DesiredStream", NS)
+        command_id = desired.attrib.get("CommandId", None) if desired is not None else None
+        command = shell.commands.get(command_id, None) if shell and command_id else None
+
+        if command is None:
+            return True
+
+        remaining = command.ready_at - time.monotonic()
+
+        if remaining <= 0:
+            return True
+
+        timeout = re.match(r"PT([0-9.]+)S", header.findtext("wsman:OperationTimeout", "", NS))
+        time.sleep(min(remaining, float(timeout.group(1)) if timeout else remaining))
+
+        return command.ready_at <= time.monotonic()
+
+    def _start_pipeline(self, shell, command, max_envelope):
+        """The whole CREATE_PIPELINE message has arrived, queue up the output"""
+        command.ready_at = time.monotonic() + self.run_time
+        messages = [f[4] for f in _unpack_fragments(command.received)]
+        message = b"".join(messages)
+        _rpid, command.pid = _message_ids(message)
+        max_size = self._fragment_size(max_envelope)
+        script, parameters = _pipeline_script(message) if self.script_handler else (None, {})
+        state = PIPELINE_COMPLETED
+
+        if script is not None:
+            try:
+                output = self.script_handler(script, parameters)
+            except Exception:
+                output = []
+                state = PIPELINE_FAILED
+        else:
+            output = self.handler(_pipeline_command(message))
+
+        for value in output:
+            command.fragments.extend(shell.fragment(
+                _pipeline_output(shell.rpid, command.pid, value), max_size
+            ))
+
+        command.fragments.extend(shell.fragment(
+            _pipeline_state(shell.rpid, command.pid, state), max_size
+        ))
+
+    def _command(self, shell, body, max_envelope):
+        """Start a pipeline (PSRP) or a process (cmd)"""
+        command_line = body.find("rsp:CommandLine", NS)
+        command_id = command_line.attrib.get("CommandId", str(uuid.uuid4()).upper())
+        command = _Command(command_id)
+
+        if shell.is_psrp:
+            arguments = command_line.findtext("rsp:Arguments", "", NS)
+            command.received = base64.b64decode(arguments)
+            fragments = _unpack_fragments(command.received)
+
+            if len(fragments) > 0 and fragments[-1][3]:
+                self._start_pipeline(shell, command, max_envelope)
+        else:
+            text = " ".join(
+                [command_line.findtext("rsp:Command", "", NS)] +
+                [a.text or "" for a in command_line.findall("rsp:Arguments", NS)]
+            )
+            stdout = "".join("%s\r\n" % line for line in self.handler(text)).encode("utf-8")
+            command.stdout.extend(
+                stdout[i:i + RAW_CHUNK_SIZE] for i in range(0, len(stdout), RAW_CHUNK_SIZE)
+            )
+
+        with self.lock:
+            shell.commands[command_id] = command
+
+        return (
+            '<rsp:CommandResponse><rsp:CommandId>%s</rsp:CommandId></rsp:CommandResponse>'
+            % command_id
+        )
+
+    def _send(self, shell, body, max_envelope):
+        """More fragments of a large CREATE_PIPELINE (or pipeline input)"""
+        for stream in body.findall("rsp:Send/rsp:Stream", NS):
+            if shell.is_psrp and "CommandId" not in stream.attrib:
+                self._pool_message(shell, base64.b64decode(stream.text or ""), max_envelope)
+                continue
+
+            command = shell.commands.get(stream.attrib.get("CommandId", ""), None)
+
+            if command is None or command.pid is not None:
+                continue
+
+            command.received += base64.b64decode(stream.text or "")
+            fragments = _unpack_fragments(command.received)
+
+            if len(fragments) > 0 and fragments[-1][3]:
+                self._start_pipeline(shell, command, max_envelope)
+
+        return "<rsp:SendResponse />"
+
+    def _pool_message(self, shell, data, max_envelope):
+        """A message to the runspace pool, only SET_MAX_RUNSPACES is answered"""
+        for _o, _f, _s, _e, message in _unpack_fragments(data):
+            if struct.unpack("<I", message[4:8])[0] != MSG_SET_MAX_RUNSPACES:
+                continue
+
+            root = _message_xml(message)
+            ci = int(root.findtext(".//I64[@N='CI']") or 0) if root is not None else 0
+            shell.pending.extend(shell.fragment(
+                _runspace_availability(shell.rpid, ci), self._fragment_size(max_envelope)
+            ))
+
+    def _take(self, queue, budget):
+        """Take items from a queue up to a byte budget (always at least one)"""
+        taken = []
+        size = 0
+
+        while len(queue) > 0 and (len(taken) == 0 or size + len(queue[0]) <= budget):
+            item = queue.popleft()
+            taken.append(item)
+            size += len(item)
+
+        return taken
+
+    def _receive(self, shell, body, max_envelope):
+        """Return as much output as fits the client's MaxEnvelopeSize"""
+        desired = body.find("rsp:Receive/rsp:DesiredStream", NS)
+        command_id = desired.attrib.get("CommandId", None) if desired is not None else None
+        budget = int((max_envelope - ENVELOPE_OVERHEAD) / 4 * 3)
+        streams = []
+        state = ""
+
+        if command_id is None:
+            # Runspace pool level messages
+            for fragment in self._take(shell.pending, budget):
+                streams.append(("stdout", None, fragment))
+        else:
+            command = shell.commands.get(command_id, None)
+
+            if command is None:
+                return ""
+
+            queue = command.fragments if shell.is_psrp else command.stdout
+            for data in self._take(queue, budget):
+                streams.append(("stdout", command_id, data))
+
+            if len(queue) == 0:
+                command.done = True
+                exit_code = "" if shell.is_psrp else "<rsp:ExitCode>0</rsp:ExitCode>"
+                state = (
+                    '<rsp:CommandState CommandId="%s" State="http://schemas.microsoft.com/wbem/'
+                    'wsman/1/windows/shell/CommandState/Done">%s</rsp:CommandState>'
+                    % (command_id, exit_code)
+                )
+
+        self._count("bytes_payload", sum(len(s[2]) for s in streams))
+        xml_streams = "".join(
+            '<rsp:Stream Name="%s"%s>%s</rsp:Stream>' % (
+                name, ' CommandId="%s"' % cid if cid else "", base64.b64encode(data).decode()
+            ) for name, cid, data in streams
+        )
+
+        return "<rsp:ReceiveResponse>%s%s</rsp:ReceiveResponse>" % (xml_streams, state)
+
+    def _signal(self, shell, body):
+        """Signal (terminate) a command"""
+        signal = body.find("rsp:Signal", NS)
+        command_id = signal.attrib.get("CommandId", "") if signal is not None else ""
+
+        with self.lock:
+            shell.commands.pop(command_id.upper(), None)
+            shell.commands.pop(command_id, None)
+
+        return "<rsp:SignalResponse />"
+
+    def _delete(self, shell):
+        """Delete (close) a shell"""
+        with self.lock:
+            self.shells.pop(shell.id, None)
+
+        return ""
+
+    def _get(self, resource_uri):
+        """Server configuration - only MaxEnvelopeSizekb is given"""
+        if not resource_uri.endswith("/config"):
+            return ""
+
+        return "<cfg:Config><cfg:MaxEnvelopeSizekb>%d</cfg:MaxEnvelopeSizekb></cfg:Config>" % \
+            self.max_envelope_kb
+
+
+def main():
+    """Serve until interrupted"""
+    parser = argparse.ArgumentParser(description="Local WinRM (WSMan/PSRP) simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5985)
+    parser.add_argument("--latency", help="seconds added to each request", type=float,
+                        default=0.0)
+    parser.add_argument("--lines", help="output lines per command", type=int, default=10)
+    parser.add_argument("--line-size", help="characters per output line", type=int, default=80)
+    parser.add_argument("--failure-rate", help="fraction of requests to fail", type=float,
+                        default=0.0)
+    parser.add_argument("--max-envelope-kb", help="server MaxEnvelopeSizekb", type=int,
+                        default=DEFAULT_MAX_ENVELOPE_KB)
+    parser.add_argument("--deny-config", help="refuse to give the WinRM config (non-admin)",
+                        action="store_true")
+    parser.add_argument("--bandwidth-mb", help="link bandwidth in MB/s, 0 for no limit",
+                        type=float, default=0.0)
+    parser.add_argument("--run-time", help="seconds each pipeline runs", type=float,
+                        default=0.0)
+    args = parser.parse_args()
+
+    simulator = WinRMSimulator(
+        args.host, args.port, args.latency, args.lines, args.line_size, args.failure_rate,
+        args.max_envelope_kb, deny_config=args.deny_config,
+        bandwidth=int(args.bandwidth_mb * 1048576), run_time=args.run_time
+    )
+    print("Listening on %s:%s" % (args.host, simulator.port))
+
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.server.server_close()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
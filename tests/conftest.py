@@ -0,0 +1,5 @@
+import os
+import sys
+
+WIN_MGT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "win_mgt")
+sys.path.insert(0, os.path.abspath(WIN_MGT_DIR))
@@ -0,0 +1,155 @@
+"""The agent's socket, its checks on requests and where request logging goes"""
+import os
+import stat
+import shutil
+import socket
+import logging
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import constants as c
+from agent import get_parser, open_server, request_logger
+from agent_client import build_request, send_request
+
+LOGGER = logging.Logger("test_agent")
+
+
+@pytest.fixture
+def socket_path():
+    # Unix socket paths are short, so not under pytest's tmp_path
+    folder = tempfile.mkdtemp(prefix="agent")
+    yield os.path.join(folder, "agent.sock")
+    shutil.rmtree(folder)
+
+@pytest.fixture
+def server(socket_path):
+    args = get_parser().parse_args(["-user", "svc_win", "--socket", socket_path])
+    args.server = args.task = args.option = None
+    server = open_server(LOGGER, args, "pw")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def request(**fields):
+    args = argparse.Namespace(username="svc_win", pwd="secret", task="services",
+                              option="list", **fields)
+    return build_request(args, ["host1"])
+
+def send(socket_path, message):
+    messages = []
+    done = send_request(socket_path, message, messages.append)
+    return done, messages
+
+
+def test_socket_only_for_its_user(server, socket_path):
+    mode = os.stat(socket_path).st_mode
+
+    assert stat.S_ISSOCK(mode)
+    assert stat.S_IMODE(mode) == 0o600
+
+def test_socket_left_behind_is_replaced(socket_path):
+    with open(socket_path, "w", encoding="utf-8") as f:
+        f.write("stale")
+
+    args = get_parser().parse_args(["-user", "svc_win", "--socket", socket_path])
+    server = open_server(LOGGER, args, "pw")
+    server.server_close()
+
+    assert stat.S_ISSOCK(os.stat(socket_path).st_mode)
+
+def test_request_for_another_user_refused(server, socket_path):
+    message = request()
+    message["username"] = "someone_else"
+    done, messages = send(socket_path, message)
+
+    assert done["status"] == c.HOST_FAILED
+    assert messages == [{"type": c.AGENT_ERROR, "data": "The agent runs as svc_win"}]
+
+def test_request_checks(server, socket_path):
+    message = request()
+    message["task"] = "registry"
+    done, messages = send(socket_path, message)
+    assert done["status"] == c.HOST_FAILED
+    assert messages[0]["data"] == "Invalid task registry"
+
+    message = request()
+    message["option"] = None
+    done, messages = send(socket_path, message)
+    assert messages[0]["data"] == "A server and option are required"
+
+def test_bad_request(server, socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    sock.sendall(b"not json\n")
+
+    with sock.makefile("r", encoding="utf-8") as fh:
+        line = fh.readline()
+    sock.close()
+
+    assert '"status": "%s"' % c.HOST_FAILED in line
+    assert "Bad request" in line
+
+def test_request_never_carries_the_password():
+    message = request()
+
+    assert message["username"] == "svc_win"
+    assert message["server"] == "host1"
+    assert "secret" not in message.values()
+    assert "pwd" not in message
+
+def test_agent_gone_before_done(socket_path):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+
+    def answer():
+        conn, _address = listener.accept()
+        conn.recv(65536)
+        conn.sendall(b'{"type": "output", "data": "half"}\n')
+        conn.close()
+
+    thread = threading.Thread(target=answer)
+    thread.start()
+    done, messages = send(socket_path, request())
+    thread.join()
+    listener.close()
+
+    assert messages == [{"type": "output", "data": "half"}]
+    assert done["status"] == c.HOST_FAILED
+    assert done["error"] == "The agent closed the connection"
+
+def test_agent_not_running(socket_path):
+    with pytest.raises(OSError):
+        send(socket_path, request())
+
+def test_request_logger_takes_worker_threads():
+    received = []
+    logger = request_logger(LOGGER, received.append)
+    other = request_logger(LOGGER, lambda message: received.append(("other", message)))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        executor.submit(logger.warning, "host %s failed", "host1").result()
+        executor.submit(logger.info, "not for the client").result()
+
+    LOGGER.warning("agent only")
+    other.warning("another request")
+
+    assert received[0] == {"type": c.AGENT_LOG, "level": "WARNING", "message": "host host1 failed"}
+    assert len([m for m in received if isinstance(m, dict)]) == 1
+
+def test_request_logger_logs_where_the_agent_does():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    base = logging.Logger("test_agent_base", logging.DEBUG)
+    base.addHandler(handler)
+
+    request_logger(base, lambda message: None).debug("agent.handle: detail")
+
+    assert [r.getMessage() for r in records] == ["agent.handle: detail"]
@@ -0,0 +1,65 @@
+import batch
+import constants as c
+
+MARKER = "%s-0123456789abcdef0123456789abcdef##" % c.BATCH_MARKER
+
+# Output of a Windows host for the script of three commands, the second throws under
+# $ErrorActionPreference = 'Stop' after writing a line
+RECORDED = [
+    "%s BEGIN 0" % MARKER,
+    "",
+    "Status   Name               DisplayName",
+    "------   ----               -----------",
+    "Running  Spooler            Print Spooler",
+    "",
+    "%s END 0" % MARKER,
+    "%s BEGIN 1" % MARKER,
+    "partial output",
+    "%s ERROR 1 Cannot find any service with service name 'Nope'." % MARKER,
+    "%s END 1" % MARKER,
+    "%s BEGIN 2" % MARKER,
+    "C:\\Windows",
+    "%s END 2" % MARKER,
+]
+COMMANDS = ["Get-Service -Name 'Spooler'", "Get-Service -Name 'Nope'", "$env:windir"]
+
+
+def test_build_script_frames_each_command():
+    script = batch.build_script(["Get-Service -Name 'Spooler'", "Get-Process"], MARKER)
+    lines = script.splitlines()
+
+    assert lines[0] == "$ErrorActionPreference = 'Stop'"
+    assert lines[1] == "Write-Output '%s BEGIN 0'" % MARKER
+    assert "-Command 'Get-Service -Name ''Spooler'''" in lines[2]
+    assert "'%s ERROR 0 '" % MARKER in lines[2]
+    assert lines[3] == "Write-Output '%s END 0'" % MARKER
+    assert lines[6] == "Write-Output '%s END 1'" % MARKER
+
+def test_split_output():
+    results = batch.split_output(RECORDED, COMMANDS, MARKER)
+
+    assert [r["command"] for r in results] == COMMANDS
+    assert not results[0]["is_error"]
+    assert "Running  Spooler" in results[0]["stdout"]
+    assert results[1]["is_error"]
+    assert results[1]["stderr"] == "Cannot find any service with service name 'Nope'."
+    assert results[1]["stdout"] == "partial output"
+    assert results[2] == {
+        "command": "$env:windir", "stdout": "C:\\Windows", "stderr": "", "is_error": False
+    }
+
+def test_split_output_batch_stopped():
+    # The pipeline failed part way through the second command
+    results = batch.split_output(RECORDED[:8], COMMANDS, MARKER)
+
+    assert not results[0]["is_error"]
+    assert not results[1]["is_error"]
+    assert results[2]["is_error"]
+    assert results[2]["stderr"] == "Command was not run"
+
+def test_split_output_ignores_other_markers():
+    other = "%s-ffffffffffffffffffffffffffffffff##" % c.BATCH_MARKER
+    lines = RECORDED[:1] + ["%s END 0" % other, None] + RECORDED[6:7]
+    results = batch.split_output(lines, COMMANDS[:1], MARKER)
+
+    assert results[0]["stdout"] == "%s END 0\n" % other
@@ -0,0 +1,118 @@
+"""Binding task options to catalog commands - types, prompting and what cmd.exe is given"""
+import pytest
+
+import catalog
+from catalog import bind, bind_values, check_options, get_catalog
+
+OPTION = {
+    "command_type_raw": False,
+    "command": "Set-Thing",
+    "has_options": True,
+    "option_list": {
+        "-Name": {"type": str, "required": True},
+        "-Count": {"type": int},
+        "-Force": {"type": bool}
+    }
+}
+RAW_OPTION = {
+    "command_type_raw": True,
+    "command": "sc.exe query",
+    "has_options": True,
+    "option_list": {"state=": {"type": str, "required": True}}
+}
+
+
+@pytest.fixture
+def task_command():
+    return catalog._compile("things", "set", OPTION)
+
+@pytest.fixture
+def raw_command():
+    return catalog._compile("things", "query", RAW_OPTION)
+
+@pytest.fixture
+def no_input(monkeypatch):
+    """Fails the test if anything is asked for"""
+    def ask(_prompt):
+        raise AssertionError("input() was called")
+
+    monkeypatch.setattr("builtins.input", ask)
+
+
+def test_catalog_is_read_only():
+    task_command = get_catalog()["services"]["list"]
+
+    assert get_catalog() is get_catalog()
+    with pytest.raises(TypeError):
+        task_command.filter_list["name"] = {}
+    with pytest.raises(TypeError):
+        get_catalog()["services"]["new"] = task_command
+
+def test_bind_types(task_command):
+    command, error = bind(task_command, {"-Name": ["a", "b"], "-Count": "3", "-Force": "true"},
+                          interactive=False)
+
+    assert error is None
+    assert command == "Set-Thing -Name 'a','b' -Count 3 -Force:$true"
+
+def test_bind_quotes_values(task_command):
+    command, _error = bind(task_command, {"-Name": "x'; Remove-Item C:\\ -Recurse; '"},
+                           interactive=False)
+
+    assert command == "Set-Thing -Name 'x''; Remove-Item C:\\ -Recurse; '''"
+
+@pytest.mark.parametrize("options, message", [
+    ({"-Name": "a", "-Count": "three"}, "Invalid value three for parameter -Count, expected int"),
+    ({"-Name": "a", "-Count": True}, "Invalid value True for parameter -Count, expected int"),
+    ({"-Name": "a", "-Force": "maybe"}, "Invalid value maybe for parameter -Force, expected bool"),
+    ({"-Name": "a", "-Force": [True, False]}, "Parameter -Force takes a single value"),
+    ({"-Name": {"nested": 1}}, "Invalid value {'nested': 1} for parameter -Name, expected str"),
+    ({"-Name": []}, "Invalid value [] for parameter -Name, expected str"),
+])
+def test_bind_wrong_types(task_command, options, message):
+    assert bind(task_command, options, interactive=False) == (None, message)
+
+def test_missing_required_parameter_not_asked_for_without_a_tty(task_command, no_input,
+                                                                 monkeypatch):
+    monkeypatch.setattr(catalog, "is_interactive", lambda: False)
+
+    assert bind(task_command, {"-Count": 1}) == \
+        (None, "Parameter -Name is required, set it with --task-options")
+    assert bind_values(task_command, {}) == \
+        (None, "Parameter -Name is required, set it with --task-options")
+
+def test_missing_parameters_asked_for_with_a_tty(task_command, monkeypatch):
+    answers = iter(["web01", "", ""])
+    monkeypatch.setattr("builtins.input", lambda _prompt: next(answers))
+
+    assert bind(task_command, {}, interactive=True) == ("Set-Thing -Name 'web01'", None)
+
+def test_optional_parameters_left_out(task_command, no_input):
+    assert bind(task_command, {"-Name": "a"}, interactive=False) == ("Set-Thing -Name 'a'", None)
+
+def test_raw_command_values(raw_command):
+    assert bind(raw_command, {"state=": "all"}, interactive=False) == \
+        ("sc.exe query state= all", None)
+    assert bind(raw_command, {"state=": "all of them"}, interactive=False) == \
+        ('sc.exe query state= "all of them"', None)
+
+@pytest.mark.parametrize("value", [
+    "all & del C:\\x", "all | more", 'all"', "%PATH%", "a^b", "a>b", "a<b", "!x!", "a\r\nb"
+])
+def test_raw_command_unsafe_values_refused(raw_command, value):
+    assert bind(raw_command, {"state=": value}, interactive=False) == \
+        (None, "Parameter state= has characters that are not allowed")
+
+def test_bind_values(task_command):
+    assert bind_values(task_command, {"-Name": "a", "-Count": "2"}, interactive=False) == \
+        ({"-Name": "a", "-Count": 2}, None)
+    assert bind_values(task_command, {"-Name": ["a", "b"]}, interactive=False) == \
+        (None, "Parameter -Name takes a single value")
+
+def test_check_options(task_command, raw_command):
+    assert check_options([task_command], None) is None
+    assert check_options([task_command, raw_command], {"-Name": "a", "state=": "b"}) is None
+    assert check_options([task_command], ["-Name"]) == \
+        "Task options must be a JSON object of parameter: value"
+    assert check_options([task_command], {"-Nmae": "a"}) == \
+        "Unknown task options -Nmae, the valid options are: -Count, -Force, -Name"
@@ -0,0 +1,100 @@
+"""Commands built from the catalog - filters pushed down to the server, property selection and
+batches"""
+import logging
+import argparse
+
+import constants as c
+from command_builder import CommandBuilder
+
+LOGGER = logging.getLogger("test_command_builder")
+
+
+def get_command(task="services", option="list", task_options=None, filters=None, select=None,
+                output=c.OUTPUT_TEXT):
+    args = argparse.Namespace(task=task, option=option, task_options=task_options,
+                              filters=filters, select=select, output=output)
+    builder = CommandBuilder(LOGGER, args)
+    command_dict = builder.get_command()
+
+    assert builder.ok == (command_dict is not None)
+    return command_dict
+
+
+def test_no_filters():
+    command_dict = get_command()
+
+    assert command_dict["command"] == "Get-Service"
+    assert command_dict["properties"] == ["Name", "DisplayName", "Status", "StartType"]
+
+def test_native_parameters_pushed_down():
+    command_dict = get_command(filters=["name=Spooler,W32Time", "DisplayName=Print*"])
+
+    assert command_dict["command"] == \
+        "Get-Service -Name 'Spooler','W32Time' -DisplayName 'Print*'"
+
+def test_properties_filtered_with_where_object():
+    command_dict = get_command(filters=["status=Running", "starttype=Automatic,Manual"])
+
+    assert command_dict["command"] == (
+        "Get-Service | Where-Object { ($_.Status -like 'Running') -and "
+        "($_.StartType -like 'Automatic' -or $_.StartType -like 'Manual') }"
+    )
+
+def test_parameters_before_where_object():
+    command_dict = get_command(filters=["status=Stopped", "name=Sp*"])
+
+    assert command_dict["command"] == \
+        "Get-Service -Name 'Sp*' | Where-Object { ($_.Status -like 'Stopped') }"
+
+def test_filter_values_quoted():
+    command_dict = get_command(filters=["name=it's; Stop-Computer"])
+
+    assert command_dict["command"] == "Get-Service -Name 'it''s; Stop-Computer'"
+
+def test_invalid_filters(caplog):
+    assert get_command(filters=["color=red"]) is None
+    assert "the valid filters are: name, displayname, status, starttype" in caplog.text
+
+    assert get_command(filters=["name="]) is None
+    assert get_command(filters=["Spooler"]) is None
+
+def test_select_object():
+    command_dict = get_command(filters=["status=Running"], select=["Name", "Status"])
+
+    assert command_dict["command"].endswith(
+        "| Where-Object { ($_.Status -like 'Running') } | Select-Object -Property 'Name','Status'"
+    )
+    assert command_dict["properties"] == ["Name", "Status"]
+
+def test_json_output_does_its_own_selection():
+    command_dict = get_command(select=["Name"], output=c.OUTPUT_JSON)
+
+    assert command_dict["command"] == "Get-Service"
+    assert command_dict["properties"] == ["Name"]
+
+def test_filters_refused_for_raw_commands(caplog):
+    assert get_command(task="shutdown", option="restart-now", select=["Name"]) is None
+    assert "only available for PowerShell" in caplog.text
+
+def test_filters_refused_for_options_without_filters(caplog):
+    assert get_command(option="restart", task_options={"-Name": "Spooler"},
+                       filters=["name=Spooler"]) is None
+    assert "the valid filters are: none" in caplog.text
+
+def test_batch_filters_only_the_options_that_support_them():
+    command_dict = get_command(option="restart,list", task_options={"-Name": "Spooler"},
+                               filters=["name=Spooler"], select=["Name", "Status"])
+
+    assert command_dict["commands"] == [
+        "Restart-Service -Name 'Spooler'",
+        "Get-Service -Name 'Spooler' | Select-Object -Property 'Name','Status'"
+    ]
+    assert command_dict["mutates"]
+
+def test_batch_without_any_filtered_option(caplog):
+    assert get_command(option="restart,restart", task_options={"-Name": "Spooler"},
+                       select=["Name"]) is None
+    assert "not available for any of the options restart, restart" in caplog.text
+
+def test_batch_with_a_transfer():
+    assert get_command(task="filesystem", option="push,pull") is None
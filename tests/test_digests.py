@@ -0,0 +1,41 @@
+import logging
+
+import digests
+import constants as c
+
+
+def test_use_digest_only_for_cacheable_commands():
+    listing = {"command": "Get-Service", "command_type_raw": False, "cacheable": True}
+    restart = {"command": "Restart-Service -Name 'Spooler'", "command_type_raw": False,
+               "mutates": True}
+
+    assert digests.use_digest(listing)
+    assert not digests.use_digest(restart)
+    assert not digests.use_digest({"command": "Get-Service", "command_type_raw": False})
+    assert not digests.use_digest(dict(listing, mutates=True))
+    assert not digests.use_digest(dict(listing, command_type_raw=True))
+    assert not digests.use_digest(dict(listing, commands=["Get-Service", "Get-Process"]))
+
+def test_split_output():
+    marker = digests.new_marker()
+
+    assert digests.split_output("%s %s ABC\n" % (marker, c.DIGEST_SAME), marker) == \
+        ("ABC", False, "")
+    assert digests.split_output("%s %s DEF\na\nb" % (marker, c.DIGEST_CHANGED), marker) == \
+        ("DEF", True, "a\nb")
+    assert digests.split_output("error before the marker", marker) == \
+        (None, True, "error before the marker")
+
+def test_digest_store_keeps_the_last_output(tmp_path):
+    path = str(tmp_path / "digests.db")
+    store = digests.DigestStore(logging.getLogger("test_digests"), path)
+    store.put("host1", "admin", "Get-Service", "ABC", "line 1\nline 2")
+    assert store.get_output("host1", "admin", "Get-Service") == "line 1\nline 2"
+    store.close()
+
+    store = digests.DigestStore(logging.getLogger("test_digests"), path)
+    assert store.load(["host1", "host2"], "admin", "Get-Service") == 1
+    assert store.get("host1", "admin", "Get-Service")[0] == "ABC"
+    assert store.get("host2", "admin", "Get-Service") is None
+    assert store.get_output("host1", "admin", "Get-Service") == "line 1\nline 2"
+    store.close()
@@ -0,0 +1,266 @@
+"""A fleet run's results and summary counts, on a thread pool or split across worker processes,
+with the hosts run by a scripted run_host"""
+import queue
+import logging
+import argparse
+import threading
+
+import pytest
+
+import constants as c
+import argument_defs
+import fleet
+from fleet import Fleet, set_host_result
+
+LOGGER = logging.getLogger("test_fleet")
+COMMAND = {"command": "Get-Service", "command_type_raw": False}
+
+
+class ScriptedHosts:
+    """run_host where each host gives the statuses of its script, one per attempt"""
+
+    def __init__(self, scripts):
+        self.scripts = scripts
+        self.attempts = {host: 0 for host in scripts}
+        self.lock = threading.Lock()
+
+    def __call__(self, _logger, _args, _password, _command_detail, host, _rtt=None):
+        with self.lock:
+            script = self.scripts[host]
+            status = script[min(self.attempts[host], len(script) - 1)]
+            self.attempts[host] += 1
+
+        if status == "raise":
+            raise RuntimeError("worker blew up")
+
+        host_result = set_host_result(host)
+        host_result["status"] = status
+        host_result["duration"] = 0.01
+        host_result["timings"] = {c.STAGE_CONNECT: 0.01, c.STAGE_RUN: 0.02}
+        # Only a failure to connect is worth another go
+        host_result["retryable"] = status == c.HOST_UNREACHABLE
+        return host_result
+
+
+class ListSink:
+    def __init__(self):
+        self.results = []
+
+    def write(self, host_result):
+        self.results.append(host_result)
+
+
+def get_args(*extra):
+    parser = argparse.ArgumentParser()
+    argument_defs.args_credentials(parser)
+    argument_defs.args_connect(parser)
+    argument_defs.args_optional(parser)
+    argument_defs.args_fleet(parser)
+    args = parser.parse_args(["-user", "svc_win", "--retry-backoff", "0.01"] + list(extra))
+    args.ping = False
+    return args
+
+@pytest.fixture
+def scripted(monkeypatch):
+    def run_scripts(scripts, *extra):
+        hosts = ScriptedHosts(scripts)
+        monkeypatch.setattr(fleet, "run_host", hosts)
+        sink = ListSink()
+        fleet_run = Fleet(LOGGER, get_args(*extra), "pw", list(scripts), sink)
+        fleet_run._run_threads(list(scripts), COMMAND)
+        return fleet_run, hosts, sink
+
+    return run_scripts
+
+
+def test_counts_by_status(scripted):
+    fleet_run, _hosts, sink = scripted({
+        "ok1": [c.HOST_SUCCESS], "ok2": [c.HOST_SUCCESS], "bad": [c.HOST_FAILED],
+        "gone": [c.HOST_UNREACHABLE]
+    }, "--retries", "0")
+
+    assert fleet_run.counts == {c.HOST_SUCCESS: 2, c.HOST_FAILED: 1, c.HOST_UNREACHABLE: 1}
+    assert fleet_run.retried == 0
+    assert sorted(r["host"] for r in sink.results) == ["bad", "gone", "ok1", "ok2"]
+
+def test_only_what_the_summary_needs_is_kept(scripted):
+    fleet_run, _hosts, sink = scripted({"ok1": [c.HOST_SUCCESS]})
+
+    assert sink.results[0]["stdout"] == ""
+    assert fleet_run.results["ok1"] == {
+        "host": "ok1", "status": c.HOST_SUCCESS, "duration": 0.01, "rtt": None,
+        "timings": {c.STAGE_CONNECT: 0.01, c.STAGE_RUN: 0.02}
+    }
+
+def test_retries_counted_once_per_host(scripted):
+    fleet_run, hosts, sink = scripted({
+        "flaky": [c.HOST_UNREACHABLE, c.HOST_UNREACHABLE, c.HOST_SUCCESS],
+        "gone": [c.HOST_UNREACHABLE],
+        "bad": [c.HOST_FAILED]
+    }, "--retries", "2")
+
+    assert fleet_run.counts == {c.HOST_SUCCESS: 1, c.HOST_FAILED: 1, c.HOST_UNREACHABLE: 1}
+    assert hosts.attempts == {"flaky": 3, "gone": 3, "bad": 1}
+    assert fleet_run.retried == 4
+    # One result per host, however many attempts it took
+    assert len(sink.results) == 3
+    assert {r["host"]: r["attempts"] for r in sink.results} == {"flaky": 3, "gone": 3, "bad": 1}
+
+def test_worker_error_is_a_failed_host(scripted):
+    fleet_run, _hosts, sink = scripted({"boom": ["raise"], "ok1": [c.HOST_SUCCESS]})
+
+    assert fleet_run.counts[c.HOST_FAILED] == 1
+    assert fleet_run.counts[c.HOST_SUCCESS] == 1
+    assert "worker blew up" in [r for r in sink.results if r["host"] == "boom"][0]["stderr"]
+
+def test_host_with_an_open_breaker_not_tried(monkeypatch):
+    hosts = ScriptedHosts({"down": [c.HOST_SUCCESS], "ok1": [c.HOST_SUCCESS]})
+    monkeypatch.setattr(fleet, "run_host", hosts)
+    fleet_run = Fleet(LOGGER, get_args(), "pw", ["down", "ok1"])
+
+    for _ in range(c.BREAKER_THRESHOLD):
+        fleet_run.breaker.failure("down")
+
+    fleet_run._run_threads(["down", "ok1"], COMMAND)
+
+    assert hosts.attempts == {"down": 0, "ok1": 1}
+    assert fleet_run.counts == {c.HOST_SUCCESS: 1, c.HOST_FAILED: 1, c.HOST_UNREACHABLE: 0}
+
+def test_summary(scripted, caplog):
+    fleet_run, _hosts, _sink = scripted({
+        "ok1": [c.HOST_SUCCESS], "flaky": [c.HOST_UNREACHABLE, c.HOST_SUCCESS],
+        "bad": [c.HOST_FAILED]
+    })
+
+    with caplog.at_level(logging.INFO, logger="test_fleet"):
+        fleet_run.summary()
+
+    hosts_part, totals_part = caplog.records[-1].getMessage().split("\n\n")[1:3]
+    # The hosts in inventory order, then the totals
+    assert [line.split(":")[0].strip() for line in hosts_part.splitlines()] == \
+        ["ok1", "flaky", "bad"]
+    totals = dict(
+        (name.strip(), int(count)) for name, count in
+        (line.split(":") for line in totals_part.splitlines())
+    )
+    assert totals == {c.HOST_SUCCESS: 2, c.HOST_FAILED: 1, c.HOST_UNREACHABLE: 0, "retries": 1}
+
+def test_metrics_report_counts(scripted):
+    fleet_run, _hosts, _sink = scripted({"ok1": [c.HOST_SUCCESS], "bad": [c.HOST_FAILED]})
+    report = fleet_run.metrics_report()
+
+    assert report["hosts"] == 2
+    assert report["counts"] == {c.HOST_SUCCESS: 1, c.HOST_FAILED: 1, c.HOST_UNREACHABLE: 0}
+    assert report["stages"][c.STAGE_RUN]["count"] == 2
+
+
+class FakeWorker:
+    """A worker process run on a thread of this process, or one that dies straight away"""
+
+    crashing = set()
+
+    def __init__(self, target, daemon, args):
+        self.index = args[0]
+        self.shard = args[3]
+        self.thread = threading.Thread(target=target, args=args, daemon=daemon)
+        self.exitcode = None
+        self.terminated = False
+
+    def start(self):
+        if self.index in FakeWorker.crashing:
+            self.exitcode = -9
+            return
+
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def terminate(self):
+        self.terminated = True
+
+    def join(self):
+        if self.exitcode is None:
+            self.thread.join()
+            self.exitcode = 0
+
+
+class FakeContext:
+    """The spawn context, with queues and workers in this process"""
+    Queue = queue.Queue
+
+    def __init__(self):
+        self.workers = []
+
+    def Process(self, **kwargs):
+        worker = FakeWorker(**kwargs)
+        self.workers.append(worker)
+        return worker
+
+
+class StubTransport:
+    def __init__(self, _logger, _args, _password, server=None):
+        pass
+
+    def prepare_credentials(self):
+        return True
+
+
+class StubNetwork:
+    def __init__(self, _logger):
+        pass
+
+    def resolve_many(self, hosts):
+        return {}
+
+
+@pytest.fixture
+def sharded(monkeypatch):
+    context = FakeContext()
+    FakeWorker.crashing = set()
+    monkeypatch.setattr(fleet.multiprocessing, "get_context", lambda _method: context)
+    monkeypatch.setattr(fleet, "Transport", StubTransport)
+    monkeypatch.setattr(fleet, "Network", StubNetwork)
+
+    def run_scripts(scripts, processes, *extra):
+        hosts = ScriptedHosts(scripts)
+        monkeypatch.setattr(fleet, "run_host", hosts)
+        sink = ListSink()
+        fleet_run = Fleet(LOGGER, get_args("--processes", str(processes), *extra), "pw",
+                          list(scripts), sink)
+        fleet_run._run_sharded(list(scripts), COMMAND)
+        return fleet_run, hosts, sink, context.workers
+
+    return run_scripts
+
+
+def test_sharded_counts(sharded):
+    scripts = {"host%s" % i: [c.HOST_SUCCESS] for i in range(7)}
+    scripts["host3"] = [c.HOST_FAILED]
+    scripts["host5"] = [c.HOST_UNREACHABLE, c.HOST_SUCCESS]
+    fleet_run, hosts, sink, workers = sharded(scripts, 3)
+
+    assert [w.shard for w in workers] == [
+        ["host0", "host3", "host6"], ["host1", "host4"], ["host2", "host5"]
+    ]
+    assert fleet_run.counts == {c.HOST_SUCCESS: 6, c.HOST_FAILED: 1, c.HOST_UNREACHABLE: 0}
+    assert fleet_run.retried == 1
+    assert hosts.attempts["host5"] == 2
+    assert sorted(r["host"] for r in sink.results) == sorted(scripts)
+    assert not any(w.terminated for w in workers)
+
+def test_no_more_workers_than_hosts(sharded):
+    fleet_run, _hosts, _sink, workers = sharded({"host0": [c.HOST_SUCCESS]}, 4)
+
+    assert fleet_run.processes == 1
+    assert len(workers) == 1
+
+def test_hosts_of_a_worker_that_died_fail(sharded):
+    FakeWorker.crashing.add(1)
+    scripts = {"host%s" % i: [c.HOST_SUCCESS] for i in range(4)}
+    fleet_run, hosts, sink, _workers = sharded(scripts, 2)
+
+    assert fleet_run.counts == {c.HOST_SUCCESS: 2, c.HOST_FAILED: 2, c.HOST_UNREACHABLE: 0}
+    assert hosts.attempts == {"host0": 1, "host1": 0, "host2": 1, "host3": 0}
+    assert [r["stderr"] for r in sink.results if r["status"] == c.HOST_FAILED] == \
+        ["Worker process exited with code -9"] * 2
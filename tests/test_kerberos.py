@@ -0,0 +1,196 @@
+"""Kerberos ticket reuse, with stub kinit and klist scripts on PATH
+
+The stubs keep a ticket cache as a file holding the principal and the expiry time, and log
+each kinit to a file so the tests can count them.
+"""
+import os
+import sys
+import time
+import uuid
+import logging
+import argparse
+import threading
+
+import pytest
+
+import argument_defs
+import kerberos
+from kerberos import Kerberos
+
+DOMAIN = "EXAMPLE.COM"
+LOGGER = logging.getLogger("test_kerberos")
+
+STUB_COMMON = """#!%s
+import os
+import sys
+import time
+
+STUB_DIR = os.environ["STUB_KRB_DIR"]
+
+def cache_path(argv):
+    if "-c" in argv:
+        return argv[argv.index("-c") + 1]
+
+    cache = os.environ.get("KRB5CCNAME", "")
+    return cache[5:] if cache.startswith("FILE:") else cache or os.path.join(STUB_DIR, "default")
+""" % sys.executable
+
+KINIT = STUB_COMMON + """
+renew = "-R" in sys.argv
+path = cache_path(sys.argv)
+
+if renew and not os.path.exists(path):
+    sys.exit(1)
+
+if not renew:
+    sys.stdin.read()
+
+# Leave time for other connections to pile up behind the first kinit
+time.sleep(0.1)
+
+with open(os.path.join(STUB_DIR, "calls"), "a") as f:
+    f.write("%s %s\\n" % ("renew" if renew else "kinit", path))
+
+with open(path, "w") as f:
+    f.write("%s %s" % (sys.argv[-1], time.time() + int(os.environ["STUB_KRB_LIFETIME"])))
+"""
+
+KLIST = STUB_COMMON + """
+path = cache_path(sys.argv)
+
+if not os.path.exists(path):
+    sys.exit(1)
+
+with open(path) as f:
+    principal, expires = f.read().split()
+
+date = lambda t: time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(t))
+realm = principal.split("@")[1]
+print("Ticket cache: FILE:%s" % path)
+print("Default principal: %s" % principal)
+print("")
+print("Valid starting       Expires              Service principal")
+print("%s  %s  krbtgt/%s@%s" % (date(time.time()), date(float(expires)), realm, realm))
+"""
+
+MIT_KLIST = """Ticket cache: FILE:/tmp/krb5cc_1000
+Default principal: svc_win@EXAMPLE.COM
+
+Valid starting       Expires              Service principal
+10/18/2026 08:00:00  10/18/2026 18:00:00  krbtgt/EXAMPLE.COM@EXAMPLE.COM
+\trenew until 10/25/2026 08:00:00
+10/18/2026 08:01:00  10/18/2026 18:00:00  HTTP/win01.example.com@EXAMPLE.COM
+"""
+
+HEIMDAL_KLIST = """Credentials cache: FILE:/tmp/krb5cc_1000
+        Principal: svc_win@EXAMPLE.COM
+
+  Issued                Expires               Principal
+Oct 18 08:00:00 2026  Oct 18 18:00:00 2026  krbtgt/EXAMPLE.COM@EXAMPLE.COM
+"""
+
+
+def get_args(extra=None):
+    parser = argparse.ArgumentParser()
+    argument_defs.args_kerberos(parser)
+    return parser.parse_args(extra or [])
+
+def write_cache(path, principal, expires):
+    with open(path, "w") as f:
+        f.write("%s@%s %s" % (principal, DOMAIN, expires))
+
+def read_calls(stub_dir):
+    path = os.path.join(str(stub_dir), "calls")
+
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as f:
+        return [line.split() for line in f.read().splitlines()]
+
+@pytest.fixture
+def stub_dir(tmp_path, monkeypatch):
+    """Put the stubs first on PATH, with an empty default cache"""
+    for name, script in (("kinit", KINIT), ("klist", KLIST)):
+        path = tmp_path / name
+        path.write_text(script)
+        path.chmod(0o755)
+
+    monkeypatch.setenv("PATH", "%s%s%s" % (tmp_path, os.pathsep, os.environ["PATH"]))
+    monkeypatch.setenv("STUB_KRB_DIR", str(tmp_path))
+    monkeypatch.setenv("STUB_KRB_LIFETIME", "36000")
+    monkeypatch.delenv("KRB5CCNAME", raising=False)
+    kerberos._TICKETS.clear()
+    yield tmp_path
+    kerberos._TICKETS.clear()
+
+@pytest.fixture
+def principal():
+    """A principal of its own for each test, so its cache file in /tmp is its own too"""
+    name = "test_%s" % uuid.uuid4().hex[:12]
+    yield name
+
+    cache = "/tmp/krb5_%s_%s" % (DOMAIN, name)
+    if os.path.exists(cache):
+        os.remove(cache)
+
+
+def test_concurrent_connections_run_kinit_once(stub_dir, principal):
+    results = []
+
+    def connect():
+        results.append(Kerberos(LOGGER, get_args()).get_ticket(principal, DOMAIN, "pw"))
+
+    threads = [threading.Thread(target=connect) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [True] * 20
+    assert [call[0] for call in read_calls(stub_dir)] == ["kinit"]
+
+def test_expired_cache_file_is_ignored(stub_dir, principal):
+    stale = "/tmp/krb5_%s_%s" % (DOMAIN, principal)
+    write_cache(stale, principal, time.time() - 60)
+
+    for _ in range(5):
+        assert Kerberos(LOGGER, get_args()).get_ticket(principal, DOMAIN, "pw")
+
+    calls = read_calls(stub_dir)
+    assert calls == [["kinit", str(stub_dir / "default")]]
+
+    ticket = kerberos._TICKETS["%s@%s" % (principal, DOMAIN)]
+    assert ticket["cache"] == ""
+    assert ticket["expires"] > time.time() + 3600
+
+def test_ticket_close_to_expiry_is_renewed(stub_dir, principal):
+    write_cache(str(stub_dir / "default"), principal, time.time() + 300)
+
+    assert Kerberos(LOGGER, get_args()).get_ticket(principal, DOMAIN, "pw")
+
+    assert [call[0] for call in read_calls(stub_dir)] == ["renew"]
+    assert kerberos._TICKETS["%s@%s" % (principal, DOMAIN)]["expires"] > time.time() + 3600
+
+def test_ticket_with_time_left_is_reused(stub_dir, principal):
+    write_cache(str(stub_dir / "default"), principal, time.time() + 7200)
+
+    assert Kerberos(LOGGER, get_args()).get_ticket(principal, DOMAIN, "pw")
+    assert read_calls(stub_dir) == []
+
+@pytest.mark.parametrize("output", [MIT_KLIST, HEIMDAL_KLIST], ids=["mit", "heimdal"])
+def test_parse_klist(output):
+    krb = Kerberos(LOGGER, get_args())
+    krb.principal = "svc_win"
+    krb.domain = DOMAIN
+
+    expected = time.mktime((2026, 10, 18, 18, 0, 0, 0, 0, -1))
+    assert krb._parse_klist(output) == expected
+
+def test_parse_klist_other_principal():
+    krb = Kerberos(LOGGER, get_args())
+    krb.principal = "someone_else"
+    krb.domain = DOMAIN
+
+    assert krb._parse_klist(MIT_KLIST) is None
+    assert krb._parse_klist(HEIMDAL_KLIST) is None
@@ -0,0 +1,217 @@
+"""The multiplexer's steps and schedule, against a stub transport"""
+import logging
+import argparse
+
+import pytest
+
+import constants as c
+import multiplex
+from fleet import set_host_result
+from multiplex import HostPipeline, Multiplexer, STEP_START, STEP_POLL, STEP_DONE
+
+LOGGER = logging.getLogger("test_multiplex")
+COMMAND = {"command": "Get-Service", "command_type_raw": False}
+
+
+class StubPipeline:
+    def __init__(self):
+        self.output = []
+
+
+class StubTimer:
+    def __init__(self):
+        self.timings = {"run": 0.1}
+
+
+class StubTransport:
+    """Finishes the command after polls_needed polls, with one line of output per poll until
+    then if talkative. Each instance is kept by host so the tests can look at it"""
+
+    instances = {}
+    unreachable_hosts = set()
+
+    def __init__(self, logger, args, password, server=None):
+        self.server = server
+        self.connected = False
+        self.unreachable = False
+        self.retryable = False
+        self.pipeline = None
+        self.polls = []
+        self.polls_needed = getattr(args, "polls_needed", 2)
+        self.talkative = getattr(args, "talkative", True)
+        self.disconnected = None
+        self.timer = StubTimer()
+        self.result_dict = {"is_error": False, "stdout": "", "stderr": "", "changed": None,
+                            "diff": ""}
+        StubTransport.instances[server] = self
+
+    def connect(self, _verbose):
+        if self.server in StubTransport.unreachable_hosts:
+            self.unreachable = True
+            self.retryable = True
+        else:
+            self.connected = True
+
+    def begin_command(self, command="", commands=None, use_digest=False):
+        self.pipeline = StubPipeline()
+        return True
+
+    def poll_command(self, timeout):
+        self.polls.append(timeout)
+
+        if self.talkative:
+            self.pipeline.output.append("line %s" % len(self.polls))
+
+        return len(self.polls) >= self.polls_needed
+
+    def get_results(self):
+        self.result_dict["stdout"] = "\n".join(self.pipeline.output)
+        return True
+
+    def disconnect(self, close=False):
+        self.disconnected = "closed" if close else "kept"
+
+
+class StubLimit:
+    def __init__(self, current):
+        self.current = current
+
+
+class StubScheduler:
+    """Lets every host in, retries a retryable failure once after retry_delay seconds"""
+
+    def __init__(self, limit, retry_delay=None):
+        self.limit = StubLimit(limit)
+        self.retry_delay = retry_delay
+        self.attempts = []
+
+    def allow(self, _host):
+        return None
+
+    def done(self, host_result, attempt):
+        self.attempts.append((host_result["host"], attempt, host_result["status"]))
+
+        if host_result["retryable"] and self.retry_delay is not None and attempt == 1:
+            return self.retry_delay
+
+        return None
+
+
+@pytest.fixture(autouse=True)
+def stub_transport(monkeypatch):
+    monkeypatch.setattr(multiplex, "Transport", StubTransport)
+    StubTransport.instances = {}
+    StubTransport.unreachable_hosts = set()
+    yield StubTransport
+
+def get_args(**kwargs):
+    return argparse.Namespace(**kwargs)
+
+def run(hosts, scheduler, io_threads=4, **kwargs):
+    results = []
+    Multiplexer(LOGGER, get_args(**kwargs), "pw", io_threads).run(
+        hosts, COMMAND, scheduler, set_host_result, results.append
+    )
+    return {r["host"]: r for r in results}
+
+
+def test_pipeline_steps():
+    host_result = set_host_result("host1")
+    pipeline = HostPipeline(LOGGER, get_args(polls_needed=2), "pw", COMMAND, host_result)
+    assert pipeline.step == STEP_START
+
+    pipeline.run_step()
+    assert pipeline.step == STEP_POLL
+
+    pipeline.run_step()
+    assert pipeline.step == STEP_POLL
+    assert pipeline.idle_delay == 0.0
+
+    pipeline.run_step()
+    assert pipeline.step == STEP_DONE
+    assert host_result["status"] == c.HOST_SUCCESS
+    assert host_result["stdout"] == "line 1\nline 2"
+    assert host_result["timings"] == {"run": 0.1}
+    # A fleet run is done with the host, its session is closed
+    assert pipeline.transport.disconnected == "closed"
+    # Polls only take what the host already has
+    assert pipeline.transport.polls == [c.MULTIPLEX_POLL_TIMEOUT] * 2
+
+def test_pipeline_keeps_the_session_for_the_agent():
+    pipeline = HostPipeline(LOGGER, get_args(polls_needed=1, keep_sessions=True), "pw", COMMAND,
+                            set_host_result("host1"))
+    pipeline.run_step()
+    pipeline.run_step()
+
+    assert pipeline.transport.disconnected == "kept"
+
+def test_pipeline_idle_delay_grows_then_resets():
+    pipeline = HostPipeline(LOGGER, get_args(polls_needed=10, talkative=False), "pw", COMMAND,
+                            set_host_result("host1"))
+    pipeline.run_step()
+    delays = []
+
+    for _ in range(6):
+        pipeline.run_step()
+        delays.append(pipeline.idle_delay)
+
+    assert delays[0] == c.MULTIPLEX_IDLE_START
+    assert delays == sorted(delays)
+    assert delays[-1] == c.MULTIPLEX_IDLE_MAX
+
+    pipeline.transport.talkative = True
+    pipeline.run_step()
+    assert pipeline.idle_delay == 0.0
+
+def test_pipeline_connect_failure():
+    StubTransport.unreachable_hosts.add("host1")
+    host_result = set_host_result("host1")
+    pipeline = HostPipeline(LOGGER, get_args(), "pw", COMMAND, host_result)
+
+    pipeline.run_step()
+    assert pipeline.step == STEP_DONE
+    assert host_result["status"] == c.HOST_UNREACHABLE
+    assert host_result["retryable"]
+
+def test_run_every_host():
+    hosts = ["host%s" % i for i in range(20)]
+    results = run(hosts, StubScheduler(limit=5), io_threads=3, polls_needed=3)
+
+    assert sorted(results) == sorted(hosts)
+    assert all(r["status"] == c.HOST_SUCCESS for r in results.values())
+    assert all(len(t.polls) == 3 for t in StubTransport.instances.values())
+
+def test_run_retries_a_failed_connect():
+    StubTransport.unreachable_hosts.add("host1")
+    scheduler = StubScheduler(limit=5, retry_delay=0.01)
+    results = run(["host0", "host1"], scheduler)
+
+    assert results["host0"]["status"] == c.HOST_SUCCESS
+    assert results["host1"]["status"] == c.HOST_UNREACHABLE
+    assert results["host1"]["attempts"] == 2
+    assert ("host1", 1, c.HOST_UNREACHABLE) in scheduler.attempts
+
+def test_next_due_waits_for_a_step_when_threads_are_busy():
+    multiplexer = Multiplexer(LOGGER, get_args(), "pw", 2)
+    scheduler = StubScheduler(limit=10)
+
+    assert multiplexer._next_due([(5.0, 0, "h", 1)], [], 1.0, 0, scheduler, {1: 1, 2: 2}) is None
+
+def test_next_due_earliest_of_polls_and_waiting():
+    multiplexer = Multiplexer(LOGGER, get_args(), "pw", 2)
+    scheduler = StubScheduler(limit=10)
+
+    assert multiplexer._next_due([(5.0, 0, "h", 1)], [(3.0, 1, None)], 1.0, 0, scheduler,
+                                 {}) == 2.0
+    assert multiplexer._next_due([(5.0, 0, "h", 1)], [], 1.0, 0, scheduler, {}) == 4.0
+    # Past due is now
+    assert multiplexer._next_due([], [(0.5, 1, None)], 1.0, 0, scheduler, {}) == 0.0
+    assert multiplexer._next_due([], [], 1.0, 0, scheduler, {}) is None
+
+def test_next_due_ignores_waiting_hosts_over_the_limit():
+    multiplexer = Multiplexer(LOGGER, get_args(), "pw", 2)
+    scheduler = StubScheduler(limit=3)
+
+    assert multiplexer._next_due([(2.0, 0, "h", 1)], [], 1.0, 3, scheduler, {}) is None
+    assert multiplexer._next_due([(2.0, 0, "h", 1)], [(4.0, 1, None)], 1.0, 3, scheduler,
+                                 {}) == 3.0
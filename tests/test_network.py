@@ -0,0 +1,221 @@
+"""The DNS cache, and port probes against a local listening socket and a closed port"""
+import time
+import types
+import socket
+import selectors
+import logging
+
+import pytest
+
+import constants as c
+import network
+from network import Network, host_targets, known_host, lookup_host, probe_hosts
+
+LOGGER = logging.getLogger("test_network")
+
+
+@pytest.fixture
+def listening():
+    """A port listening on 127.0.0.1 only"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(128)
+    yield sock.getsockname()[1]
+    sock.close()
+
+@pytest.fixture
+def closed_port():
+    """A port nothing listens on"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class FakeResolver:
+    """getaddrinfo with a fixed answer per host, counting the lookups"""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.lookups = []
+
+    def __call__(self, host, *_args):
+        self.lookups.append(host)
+
+        if host.lower() not in self.answers:
+            raise socket.gaierror("Name or service not known")
+
+        fqdn, addresses = self.answers[host.lower()]
+        return [
+            (socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM, 6,
+             fqdn if i == 0 else "", (ip, 0)) for i, ip in enumerate(addresses)
+        ]
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def resolver(monkeypatch):
+    """An empty DNS cache, a fake resolver and clock"""
+    fake = FakeResolver({
+        "win01": ("win01.example.com", ["10.0.0.1"]),
+        "dual": ("dual.example.com", ["fd00::1", "10.0.0.2", "10.0.0.2"]),
+    })
+    clock = FakeTime()
+    monkeypatch.setattr(network.socket, "getaddrinfo", fake)
+    monkeypatch.setattr(network, "time", types.SimpleNamespace(
+        time=clock.time, monotonic=time.monotonic
+    ))
+    monkeypatch.setattr(network, "_DNS_CACHE", {})
+    fake.clock = clock
+    yield fake
+
+def host_info(*addresses):
+    info = known_host("host", "", addresses[0] if addresses else "")
+    info["addresses"] = list(addresses)
+    return info
+
+
+def test_lookup_every_address(resolver):
+    info = lookup_host("dual")
+
+    assert info["is_resolved"]
+    assert info["fqdn"] == "dual.example.com"
+    assert info["addresses"] == ["fd00::1", "10.0.0.2"]
+    assert info["ip"] == "fd00::1"
+    assert info["is_ipv6"]
+
+def test_lookup_cached_until_ttl(resolver):
+    assert lookup_host("win01")["ip"] == "10.0.0.1"
+    assert lookup_host("WIN01")["ip"] == "10.0.0.1"
+    assert resolver.lookups == ["win01"]
+
+    resolver.clock.now += c.DNS_POSITIVE_TTL + 1
+    lookup_host("win01")
+    assert resolver.lookups == ["win01", "win01"]
+
+def test_failed_lookup_cached_for_less_time(resolver):
+    assert not lookup_host("gone")["is_resolved"]
+    lookup_host("gone")
+    assert resolver.lookups == ["gone"]
+
+    resolver.clock.now += c.DNS_NEGATIVE_TTL + 1
+    lookup_host("gone")
+    assert resolver.lookups == ["gone", "gone"]
+
+def test_cached_entry_is_a_copy(resolver):
+    lookup_host("win01")["ip"] = "changed"
+
+    assert lookup_host("win01")["ip"] == "10.0.0.1"
+
+def test_resolve_many(resolver):
+    resolved = Network(LOGGER).resolve_many(["win01", "dual", "gone"], workers=2)
+
+    assert resolved["win01"]["ip"] == "10.0.0.1"
+    assert resolved["dual"]["addresses"] == ["fd00::1", "10.0.0.2"]
+    assert not resolved["gone"]["is_resolved"]
+    assert Network(LOGGER).resolve_many([]) == {}
+
+def test_cache_file_round_trip(resolver, tmp_path):
+    lookup_host("win01")
+    lookup_host("dual")
+    path = str(tmp_path / "dns.json")
+
+    assert network.save_cache(path)
+    network._DNS_CACHE.clear()
+    assert network.load_cache(path) == 2
+
+    lookup_host("win01")
+    assert resolver.lookups == ["win01", "dual"]
+
+def test_cache_file_keys_lower_case_and_expired_dropped(resolver, tmp_path):
+    path = tmp_path / "dns.json"
+    path.write_text(
+        '{"WIN01": {"host_info": {"ip": "10.0.0.9"}, "expires": %s},'
+        ' "old": {"host_info": {"ip": "10.0.0.8"}, "expires": 1}}' % (resolver.clock.now + 60),
+        encoding="utf-8"
+    )
+
+    assert network.load_cache(str(path)) == 1
+    assert lookup_host("win01")["ip"] == "10.0.0.9"
+    assert resolver.lookups == []
+
+def test_cache_file_missing_or_bad(resolver, tmp_path):
+    assert network.load_cache(str(tmp_path / "missing.json")) == 0
+
+    bad = tmp_path / "bad.json"
+    bad.write_text("not json", encoding="utf-8")
+    assert network.load_cache(str(bad)) == 0
+
+def test_host_targets_every_address_and_port():
+    infos = {"a": host_info("10.0.0.1", "fd00::1"), "b": host_info("10.0.0.2")}
+
+    assert host_targets(infos, [5985, 5986]) == [
+        ("a", "10.0.0.1", 5985), ("a", "10.0.0.1", 5986),
+        ("a", "fd00::1", 5985), ("a", "fd00::1", 5986),
+        ("b", "10.0.0.2", 5985), ("b", "10.0.0.2", 5986),
+    ]
+
+def test_host_targets_unresolved_host_still_has_a_result():
+    assert host_targets({"a": host_info()}, [5985]) == [("a", "", 5985)]
+
+def test_probe_open_and_closed(listening, closed_port):
+    results = probe_hosts([
+        ("open", "127.0.0.1", listening), ("closed", "127.0.0.1", closed_port),
+        ("unresolved", "", listening)
+    ], timeout=1.0)
+
+    assert results["open"]["reachable"]
+    assert results["open"]["port"] == listening
+    assert results["open"]["rtt"] < 1.0
+    assert results["closed"] == {"reachable": False, "port": None, "rtt": None}
+    assert not results["unresolved"]["reachable"]
+
+def test_probe_any_port(listening, closed_port):
+    results = probe_hosts([("h", "127.0.0.1", closed_port), ("h", "127.0.0.1", listening)], 1.0)
+
+    assert results["h"]["reachable"]
+    assert results["h"]["port"] == listening
+
+def test_probe_many_hosts_few_sockets(listening):
+    targets = [("h%s" % i, "127.0.0.1", listening) for i in range(50)]
+    results = probe_hosts(targets, timeout=1.0, max_inflight=4)
+
+    assert len(results) == 50
+    assert all(r["reachable"] for r in results.values())
+
+def test_probe_many_tries_every_address(listening):
+    # Nothing listens on 127.0.0.2, the host is still reachable on its second address
+    results = Network(LOGGER).probe_many(
+        {"multi": host_info("127.0.0.2", "127.0.0.1"), "single": host_info("127.0.0.2")},
+        [listening], timeout=1.0
+    )
+
+    assert results["multi"]["reachable"]
+    assert not results["single"]["reachable"]
+
+def test_probe_timeout(monkeypatch):
+    # A listening socket never becomes writable, like a connect to a host that doesn't answer
+    started = []
+
+    def start_probe(selector, host, _ip, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1)
+        selector.register(sock, selectors.EVENT_WRITE, (host, port, time.monotonic()))
+        started.append(sock)
+        return True
+
+    monkeypatch.setattr(network, "_start_probe", start_probe)
+    _start = time.monotonic()
+    results = probe_hosts([("h", "192.0.2.1", 5985)], timeout=0.2)
+
+    assert 0.2 <= time.monotonic() - _start < 1.0
+    assert not results["h"]["reachable"]
+    assert started[0].fileno() == -1
@@ -0,0 +1,44 @@
+import logging
+
+import constants as c
+from profiles import ProfileStore
+
+LOGGER = logging.getLogger("test_profiles")
+
+
+def make_profile(server):
+    profile = dict.fromkeys(c.PROFILE_FIELDS)
+    profile.update({"server": server, "username": "admin", "port": 5985, "ssl": False,
+                    "kinit_cache": False, "rtt": 0.01})
+    return profile
+
+def test_profiles_written_and_read_back(tmp_path):
+    path = str(tmp_path / "stores" / "profiles.db")
+    store = ProfileStore(LOGGER, path)
+    for i in range(3):
+        store.put(make_profile("host%s" % i))
+    store.close()
+
+    store = ProfileStore(LOGGER, path)
+    assert store.load(["host0", "host1", "host2", "host3"], "admin") == 3
+    assert store.get("host1", "admin")["port"] == 5985
+    assert store.get("host3", "admin") is None
+
+    store.invalidate("host1", "admin")
+    assert store.flush()
+    store.close()
+
+    store = ProfileStore(LOGGER, path)
+    assert store.load(["host0", "host1", "host2"], "admin") == 2
+    store.close()
+
+def test_load_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(c, "PROFILE_BATCH", 2)
+    store = ProfileStore(LOGGER, str(tmp_path / "profiles.db"))
+    for i in range(5):
+        store.put(make_profile("host%s" % i))
+    store.flush()
+
+    store.profiles = {}
+    assert store.load(["host%s" % i for i in range(7)], "admin") == 5
+    store.close()
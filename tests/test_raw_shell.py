@@ -0,0 +1,175 @@
+"""Raw commands run in a cmd shell that is kept open - reuse, a shell the server has expired, and
+a shell left broken"""
+import types
+import logging
+import argparse
+
+import pytest
+from pypsrp.exceptions import WSManFaultError
+
+import constants as c
+import argument_defs
+import transport_pypsrp
+from session import SessionManager
+from transport_pypsrp import Transport
+
+LOGGER = logging.getLogger("test_raw_shell")
+
+
+class FakeShell:
+    """A WinRS shell, which the server can expire or fail commands in"""
+
+    def __init__(self, wsman):
+        self.wsman = wsman
+        self.expired = False
+        self.fault = None
+        self.commands = []
+        self.closed = False
+
+    def open(self):
+        self.wsman.opened.append(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeProcess:
+    def __init__(self, shell, command):
+        self.shell = shell
+        self.command = command
+        self.stdout = b""
+        self.stderr = b""
+        self.rc = None
+
+    def invoke(self):
+        if self.shell.expired:
+            raise WSManFaultError(c.WINRS_SHELL_NOT_FOUND, "host1", "The shell was not found",
+                                  None, None, None)
+
+        if self.shell.fault is not None:
+            raise WSManFaultError(self.shell.fault, "host1", "Failed", None, None, None)
+
+        self.shell.commands.append(self.command)
+        self.stdout = ("output of %s\r\n" % self.command).encode(c.RAW_ENCODING)
+        self.rc = 0
+
+    def signal(self, _code):
+        pass
+
+
+@pytest.fixture
+def fake_winrs(monkeypatch):
+    monkeypatch.setattr(transport_pypsrp, "WinRS", FakeShell)
+    monkeypatch.setattr(transport_pypsrp, "Process", FakeProcess)
+    wsman = types.SimpleNamespace(opened=[], max_envelope_size=None)
+    sessions = SessionManager(LOGGER, 60, 10)
+    yield wsman, sessions
+    sessions.close_all()
+
+def get_transport(fake_winrs):
+    wsman, sessions = fake_winrs
+    parser = argparse.ArgumentParser()
+    argument_defs.args_credentials(parser)
+    argument_defs.args_connect(parser)
+    argument_defs.args_optional(parser)
+    args = parser.parse_args(["-user", "svc_win"])
+    args.ping = False
+    # Keep the envelope size as it is, there is no server to ask
+    args.max_envelope_kb = 0
+
+    transport = Transport(LOGGER, args, "pw", server="host1")
+    transport.sessions = sessions
+    transport.is_raw = True
+    transport.client = types.SimpleNamespace(wsman=wsman)
+    wsman.max_envelope_size = transport.kwargs["max_envelope_size"]
+    return transport
+
+
+def test_shell_reused(fake_winrs):
+    wsman, sessions = fake_winrs
+    first = get_transport(fake_winrs)
+
+    assert first.run_command("dir")
+    assert first.get_results()
+    assert first.result_dict["stdout"] == "output of dir\r\n"
+    first.disconnect()
+
+    second = get_transport(fake_winrs)
+    assert second.run_command("whoami")
+    second.disconnect()
+
+    assert len(wsman.opened) == 1
+    assert wsman.opened[0].commands == ["dir", "whoami"]
+    assert not wsman.opened[0].closed
+    assert [s["key"][-1] for s in sessions.sessions] == [c.SESSION_SHELL]
+
+def test_batch_runs_in_one_shell(fake_winrs):
+    wsman, _sessions = fake_winrs
+    transport = get_transport(fake_winrs)
+
+    assert transport.run_commands(["dir", "ver"])
+    transport.disconnect()
+
+    assert len(wsman.opened) == 1
+    assert wsman.opened[0].commands == ["dir", "ver"]
+
+def test_closed_when_asked(fake_winrs):
+    wsman, sessions = fake_winrs
+    transport = get_transport(fake_winrs)
+    transport.run_command("dir")
+    transport.disconnect(close=True)
+
+    assert wsman.opened[0].closed
+    assert sessions.sessions == []
+
+def test_expired_shell_replaced(fake_winrs):
+    wsman, _sessions = fake_winrs
+    first = get_transport(fake_winrs)
+    first.run_command("dir")
+    first.disconnect()
+    wsman.opened[0].expired = True
+
+    second = get_transport(fake_winrs)
+
+    assert second.run_command("whoami")
+    assert second.connected
+    assert len(wsman.opened) == 2
+    assert wsman.opened[0].closed
+    assert wsman.opened[1].commands == ["whoami"]
+
+def test_new_shell_not_retried(fake_winrs, monkeypatch):
+    wsman, sessions = fake_winrs
+    transport = get_transport(fake_winrs)
+
+    # A fault from a shell that was just opened is not an expired shell
+    def open_expired(shell):
+        shell.expired = True
+        wsman.opened.append(shell)
+
+    monkeypatch.setattr(FakeShell, "open", open_expired)
+
+    # Like a connection failure, run_host looks at connected
+    transport.run_command("dir")
+    assert not transport.connected
+    assert len(wsman.opened) == 1
+
+    transport.disconnect()
+    assert wsman.opened[0].closed
+    assert sessions.sessions == []
+
+def test_broken_shell_not_handed_out_again(fake_winrs):
+    wsman, sessions = fake_winrs
+    first = get_transport(fake_winrs)
+    first.run_command("dir")
+    first.disconnect()
+    wsman.opened[0].fault = 500
+
+    second = get_transport(fake_winrs)
+
+    second.run_command("dir")
+    assert not second.connected
+    assert second.shell_broken
+    second.disconnect()
+
+    assert wsman.opened[0].closed
+    assert sessions.sessions == []
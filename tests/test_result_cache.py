@@ -0,0 +1,46 @@
+import time
+import logging
+
+from result_cache import ResultCache
+
+LOGGER = logging.getLogger("test_result_cache")
+
+
+def make_result(stdout):
+    return {"status": "success", "stdout": stdout, "stderr": ""}
+
+def test_results_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "results.db")
+    first = ResultCache(LOGGER, path, ttl=60)
+    second = ResultCache(LOGGER, path, ttl=60)
+
+    first.put("host1", "admin", "services", make_result("Spooler Running"))
+    assert second.get("host1", "admin", "services") is None
+
+    first.flush()
+    assert second.get("host1", "admin", "services")["stdout"] == "Spooler Running"
+
+    first.invalidate("host1")
+    assert second.get("host1", "admin", "services") is None
+    first.close()
+    second.close()
+
+def test_old_results_not_used(tmp_path):
+    cache = ResultCache(LOGGER, str(tmp_path / "results.db"), ttl=60)
+    cache.put("host1", "admin", "services", make_result("Spooler Running"))
+    cache.pending[("host1", "admin", "services")]["saved"] = time.time() - 120
+    cache.flush()
+
+    assert cache.get("host1", "admin", "services") is None
+    cache.close()
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = ResultCache(LOGGER, str(tmp_path / "results.db"), ttl=60, max_mb=0.001)
+
+    for i in range(4):
+        cache.put("host%s" % i, "admin", "services", make_result("x" * 400))
+        cache.flush()
+
+    found = cache.load(["host%s" % i for i in range(4)], "admin", "services")
+    assert sorted(found) == ["host2", "host3"]
+    cache.close()
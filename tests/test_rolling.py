@@ -0,0 +1,191 @@
+"""Rolling restarts against scripted hosts - the port checks, sessions and boot times of each
+host follow a script, a step per check"""
+import logging
+import argparse
+import threading
+
+import pytest
+
+import constants as c
+import argument_defs
+import rolling
+from fleet import set_host_result
+from rolling import RollingRestart, is_rolling, wave_size
+
+LOGGER = logging.getLogger("test_rolling")
+
+# Still up with the boot time from before the restart, down, port open but no sessions yet,
+# and back with a new boot time
+OLD, DOWN, REFUSING, NEW = ("old", "down", "refusing", "new")
+NORMAL = [OLD, DOWN, DOWN, REFUSING, NEW]
+
+
+class FakeFleet:
+    """The hosts' scripts, and the most hosts seen down at once"""
+
+    def __init__(self, scripts):
+        self.scripts = scripts
+        self.steps = {host: None for host in scripts}
+        self.restarted = []
+        self.max_down = 0
+        self.lock = threading.Lock()
+
+    def phase(self, host):
+        step = self.steps[host]
+
+        if step is None:
+            return OLD
+
+        script = self.scripts[host]
+        return script[min(step, len(script) - 1)]
+
+    def run_host(self, _logger, _args, _password, _command_detail, host, _rtt=None):
+        with self.lock:
+            self.restarted.append(host)
+            self.steps[host] = 0
+
+        host_result = set_host_result(host)
+        host_result["status"] = c.HOST_SUCCESS
+        return host_result
+
+    def probe_hosts(self, targets, _timeout):
+        with self.lock:
+            for host, _ip, _port in targets:
+                if self.steps[host] is not None:
+                    self.steps[host] += 1
+
+            self.max_down = max(self.max_down, len([
+                h for h in self.scripts if self.phase(h) in (DOWN, REFUSING)
+            ]))
+
+            return {host: {"reachable": self.phase(host) != DOWN} for host, _ip, _port in targets}
+
+    def ask(self, host, command, close=True):
+        with self.lock:
+            phase = self.phase(host)
+
+        if phase in (DOWN, REFUSING):
+            return None
+
+        if command == c.RESTART_BOOT_COMMAND:
+            return "boot-2" if phase == NEW else "boot-1"
+
+        return "5"
+
+
+@pytest.fixture
+def fast_checks(monkeypatch):
+    monkeypatch.setattr(c, "RESTART_POLL_INTERVAL", 0.0)
+    monkeypatch.setattr(c, "RESTART_BOOT_CHECK_INTERVAL", 0.0)
+    monkeypatch.setattr(rolling, "lookup_host",
+                        lambda host: {"ip": host, "fqdn": host, "addresses": [host]})
+
+def get_args(max_unavailable, restart_timeout=60):
+    parser = argparse.ArgumentParser()
+    argument_defs.args_credentials(parser)
+    argument_defs.args_connect(parser)
+    argument_defs.args_optional(parser)
+    argument_defs.args_fleet(parser)
+    args = parser.parse_args(["-user", "svc_win", "--max-unavailable", max_unavailable])
+    args.restart_timeout = restart_timeout
+    args.ping = False
+    return args
+
+def run(monkeypatch, scripts, max_unavailable, restart_timeout=60):
+    fake = FakeFleet(scripts)
+    monkeypatch.setattr(rolling, "run_host", fake.run_host)
+    monkeypatch.setattr(rolling, "probe_hosts", fake.probe_hosts)
+
+    restart = RollingRestart(LOGGER, get_args(max_unavailable, restart_timeout), "pw",
+                             list(scripts))
+    restart._ask = fake.ask
+    restart._live_hosts = lambda hosts=None: list(scripts)
+    all_ok = restart.run({"command": "shutdown /r /t 0", "command_type_raw": True,
+                          "reboots": True})
+
+    return all_ok, restart, fake
+
+
+def test_wave_size():
+    assert wave_size("3", 10) == 3
+    assert wave_size("25%", 10) == 2
+    assert wave_size("1%", 10) == 1
+    assert wave_size("0", 10) == 1
+
+def test_is_rolling():
+    args = argparse.Namespace(max_unavailable="2")
+
+    assert is_rolling(args, {"reboots": True})
+    assert not is_rolling(args, {})
+    assert not is_rolling(argparse.Namespace(max_unavailable=None), {"reboots": True})
+
+def test_waves_never_exceed_max_unavailable(monkeypatch, fast_checks):
+    scripts = {"host%s" % i: NORMAL for i in range(5)}
+    all_ok, restart, fake = run(monkeypatch, scripts, "2")
+
+    assert all_ok
+    assert restart.counts[c.HOST_SUCCESS] == 5
+    # A wave at a time, in order
+    assert [sorted(fake.restarted[i:i + 2]) for i in (0, 2, 4)] == \
+        [["host0", "host1"], ["host2", "host3"], ["host4"]]
+    assert fake.max_down == 2
+
+    timings = restart.results["host3"]["timings"]
+    assert all(stage in timings for stage in (c.STAGE_DOWN, c.STAGE_BACK, c.STAGE_READY))
+
+def test_restart_seen_through_new_boot_time(monkeypatch, fast_checks):
+    # Back before a port check could see it down
+    all_ok, restart, fake = run(monkeypatch, {"fast": [NEW], "slow": NORMAL}, "2")
+
+    assert all_ok
+    assert fake.max_down == 1
+    assert restart.results["fast"]["status"] == c.HOST_SUCCESS
+    assert restart.results["fast"]["timings"][c.STAGE_BACK] == 0.0
+
+def test_host_that_does_not_restart(monkeypatch, fast_checks):
+    monkeypatch.setattr(c, "RESTART_DOWN_TIMEOUT", 0.05)
+    all_ok, restart, _fake = run(monkeypatch, {"stuck": [OLD]}, "1")
+
+    assert not all_ok
+    assert restart.results["stuck"]["status"] == c.HOST_FAILED
+
+def test_host_not_back_stops_later_waves(monkeypatch, fast_checks):
+    scripts = {"host0": [OLD, DOWN], "host1": NORMAL, "host2": NORMAL}
+    all_ok, restart, fake = run(monkeypatch, scripts, "1", restart_timeout=0.2)
+
+    assert not all_ok
+    assert fake.restarted == ["host0"]
+    assert restart.results["host0"]["status"] == c.HOST_FAILED
+    assert restart.results["host1"]["status"] == c.HOST_FAILED
+    assert restart.counts[c.HOST_SUCCESS] == 0
+
+def test_checks_leave_the_profile_and_keep_the_boot_session(monkeypatch):
+    opened = []
+
+    class StubTransport:
+        def __init__(self, _logger, _args, _password, server=None, save_profile=True):
+            self.connected = True
+            self.result_dict = {"stdout": " boot-1\n"}
+            opened.append({"server": server, "save_profile": save_profile})
+
+        def connect(self):
+            pass
+
+        def run_command(self, _command):
+            return True
+
+        def get_results(self):
+            return True
+
+        def disconnect(self, close=False):
+            opened[-1]["close"] = close
+
+    monkeypatch.setattr(rolling, "Transport", StubTransport)
+    restart = RollingRestart(LOGGER, get_args("1"), "pw", ["host0"])
+
+    assert restart._boot_time("host0") == "boot-1"
+    assert restart._is_ready("host0")
+    assert opened == [
+        {"server": "host0", "save_profile": False, "close": False},
+        {"server": "host0", "save_profile": False, "close": True},
+    ]
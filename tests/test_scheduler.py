@@ -0,0 +1,161 @@
+"""Retries, the circuit breaker and the adaptive limit, with a fake clock and seeded random"""
+import random
+import logging
+import argparse
+
+import constants as c
+from fleet import set_host_result
+from scheduler import AdaptiveLimit, CircuitBreaker, Scheduler
+
+LOGGER = logging.getLogger("test_scheduler")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def get_scheduler(concurrency=10, retries=2, backoff=1.0, adaptive=True, clock=None):
+    args = argparse.Namespace(retries=retries, retry_backoff=backoff,
+                              adaptive_concurrency=adaptive)
+    breaker = CircuitBreaker(3, 60, clock or FakeClock())
+    scheduler = Scheduler(LOGGER, args, concurrency, breaker)
+    scheduler.random = random.Random(42)
+    return scheduler
+
+def host_result(host, status, retryable=False, connect=None):
+    result = set_host_result(host)
+    result["status"] = status
+    result["retryable"] = retryable
+
+    if connect is not None:
+        result["timings"] = {c.STAGE_CONNECT: connect}
+
+    return result
+
+
+def test_breaker_opens_after_threshold_then_half_opens():
+    clock = FakeClock()
+    breaker = CircuitBreaker(3, 60, clock)
+
+    assert not breaker.failure("h")
+    assert not breaker.failure("h")
+    assert breaker.failure("h")
+    assert not breaker.allow("h")
+
+    clock.now += 45
+    assert breaker.remaining("h") == 15
+    assert not breaker.allow("h")
+
+    # One attempt is let through once the cool down is over, a failure opens it again
+    clock.now += 15
+    assert breaker.allow("h")
+    assert breaker.failure("h")
+    assert not breaker.allow("h")
+
+def test_breaker_success_closes():
+    clock = FakeClock()
+    breaker = CircuitBreaker(2, 60, clock)
+    breaker.failure("h")
+    breaker.failure("h")
+
+    clock.now += 60
+    assert breaker.allow("h")
+    breaker.success("h")
+
+    assert not breaker.failure("h")
+    assert breaker.allow("h")
+    assert breaker.remaining("h") == 0.0
+
+def test_limit_fixed():
+    limit = AdaptiveLimit(10, adaptive=False)
+
+    for _ in range(20):
+        limit.record(False)
+
+    assert limit.current == 10
+
+def test_limit_cut_once_per_round_of_failures():
+    limit = AdaptiveLimit(10)
+
+    for _ in range(9):
+        limit.record(False)
+    assert limit.current == 10
+
+    limit.record(False)
+    assert limit.current == int(10 * c.AIMD_DECREASE)
+
+    # The next cut waits for a round at the new limit
+    for _ in range(limit.current - 1):
+        limit.record(False)
+    assert limit.current == int(10 * c.AIMD_DECREASE)
+
+def test_limit_grows_back_never_past_maximum():
+    limit = AdaptiveLimit(10)
+
+    for _ in range(10):
+        limit.record(False)
+    cut = limit.current
+
+    # Up by about one for each limit's worth of good attempts
+    for _ in range(cut + 1):
+        limit.record(True)
+    assert limit.current == cut + 1
+
+    for _ in range(200):
+        limit.record(True)
+    assert limit.current == 10
+
+def test_limit_cut_when_connecting_slows():
+    limit = AdaptiveLimit(10)
+
+    for _ in range(10):
+        limit.record(True, 0.1)
+    assert limit.current == 10
+
+    for _ in range(20):
+        limit.record(True, 0.1 * c.AIMD_LATENCY_FACTOR * 4)
+    assert limit.current < 10
+
+def test_delay_backs_off_with_jitter():
+    scheduler = get_scheduler(backoff=1.0)
+
+    for attempt in range(1, 10):
+        ceiling = min(c.RETRY_BACKOFF_MAX, 2 ** (attempt - 1))
+        assert ceiling / 2 <= scheduler._delay(attempt) <= ceiling
+
+    first = [get_scheduler()._delay(1) for _ in range(2)]
+    assert first[0] == first[1]
+
+def test_done_retries_connect_failures_up_to_retries():
+    scheduler = get_scheduler(retries=2)
+    failed = host_result("h", c.HOST_UNREACHABLE, retryable=True)
+
+    assert scheduler.done(failed, 1) is not None
+    assert scheduler.done(failed, 2) is not None
+    # Third failure in a row opens the breaker
+    assert scheduler.done(failed, 3) is None
+    assert scheduler.allow("h") is not None
+
+def test_done_failures_after_connecting_are_not_successes():
+    scheduler = get_scheduler(concurrency=4)
+    scheduler.breaker.failure("h")
+    scheduler.breaker.failure("h")
+
+    for _ in range(4):
+        assert scheduler.done(host_result("h", c.HOST_FAILED), 1) is None
+
+    # Not retried, the limit was cut and the breaker was not reset
+    assert scheduler.limit.current < 4
+    assert scheduler.breaker.failure("h")
+
+def test_done_success_closes_breaker():
+    scheduler = get_scheduler()
+    scheduler.breaker.failure("h")
+    scheduler.breaker.failure("h")
+
+    assert scheduler.done(host_result("h", c.HOST_SUCCESS, connect=0.1), 1) is None
+    assert not scheduler.breaker.failure("h")
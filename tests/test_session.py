@@ -0,0 +1,165 @@
+"""The session manager's keys, reuse, idle expiry and eviction, with fake pools and clock"""
+import logging
+
+import constants as c
+from session import SessionManager, session_key
+
+LOGGER = logging.getLogger("test_session")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakePool:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Opener:
+    """open_func for acquire, counts the pools opened"""
+
+    def __init__(self):
+        self.opened = []
+
+    def __call__(self):
+        pool = FakePool(len(self.opened))
+        self.opened.append(pool)
+        return pool
+
+
+def kwargs(server="host1", port=5985, username="svc_win", auth="ntlm"):
+    return {"server": server, "port": port, "username": username, "auth": auth}
+
+def get_manager(idle_timeout=60, max_sessions=3):
+    clock = FakeClock()
+    return SessionManager(LOGGER, idle_timeout, max_sessions, clock), clock
+
+
+def test_session_key():
+    assert session_key(kwargs()) == ("host1", 5985, "svc_win", "ntlm", c.SESSION_POOL)
+    assert session_key(kwargs(), c.SESSION_SHELL)[-1] == c.SESSION_SHELL
+
+def test_released_pool_is_reused():
+    manager, _clock = get_manager()
+    opener = Opener()
+
+    pool = manager.acquire(kwargs(), opener)
+    manager.release(pool)
+
+    assert manager.acquire(kwargs(), opener) is pool
+    assert len(opener.opened) == 1
+    assert manager.sessions[0]["uses"] == 2
+
+def test_pool_in_use_is_not_shared():
+    manager, _clock = get_manager()
+    opener = Opener()
+
+    first = manager.acquire(kwargs(), opener)
+    second = manager.acquire(kwargs(), opener)
+
+    assert first is not second
+    assert [s["in_use"] for s in manager.sessions] == [True, True]
+
+def test_other_keys_get_their_own_pool():
+    manager, _clock = get_manager(max_sessions=10)
+    opener = Opener()
+
+    for other in (kwargs(), kwargs(server="host2"), kwargs(port=5986), kwargs(username="x"),
+                  kwargs(auth="kerberos")):
+        manager.release(manager.acquire(other, opener))
+    manager.release(manager.acquire(kwargs(), opener, c.SESSION_SHELL))
+
+    assert len(opener.opened) == 6
+
+def test_release_with_close():
+    manager, _clock = get_manager()
+    pool = manager.acquire(kwargs(), Opener())
+
+    manager.release(pool, close=True)
+
+    assert pool.closed
+    assert manager.sessions == []
+
+def test_idle_sessions_expire():
+    manager, clock = get_manager(idle_timeout=60)
+    opener = Opener()
+    idle = manager.acquire(kwargs(), opener)
+    busy = manager.acquire(kwargs(server="host2"), opener)
+    manager.release(idle)
+
+    clock.now += 30
+    assert manager.close_idle() == 0
+
+    clock.now += 31
+    assert manager.close_idle() == 1
+    assert idle.closed
+    assert not busy.closed
+    assert [s["pool"] for s in manager.sessions] == [busy]
+
+def test_least_recently_used_idle_session_evicted():
+    manager, clock = get_manager(max_sessions=3)
+    opener = Opener()
+    pools = []
+
+    for server in ("host1", "host2", "host3"):
+        pools.append(manager.acquire(kwargs(server=server), opener))
+        clock.now += 1
+
+    manager.release(pools[1])
+    clock.now += 1
+    manager.release(pools[0])
+    clock.now += 1
+    manager.acquire(kwargs(server="host4"), opener)
+
+    # host2 was released first, host3 is still in use
+    assert pools[1].closed
+    assert not pools[0].closed
+    assert sorted(s["key"][0] for s in manager.sessions) == ["host1", "host3", "host4"]
+
+def test_full_of_sessions_in_use():
+    manager, _clock = get_manager(max_sessions=1)
+    opener = Opener()
+    kept = manager.acquire(kwargs(), opener)
+    extra = manager.acquire(kwargs(server="host2"), opener)
+
+    assert len(manager.sessions) == 1
+
+    # Not kept, so closed when it is given back
+    manager.release(extra)
+    assert extra.closed
+    assert not kept.closed
+
+def test_close_server():
+    manager, _clock = get_manager(max_sessions=10)
+    opener = Opener()
+    by_ip = manager.acquire(kwargs(server="10.0.0.1"), opener)
+    by_name = manager.acquire(kwargs(server="host1.example.com"), opener, c.SESSION_SHELL)
+    busy = manager.acquire(kwargs(server="host1.example.com"), opener)
+    other = manager.acquire(kwargs(server="host2"), opener)
+
+    for pool in (by_ip, by_name, other):
+        manager.release(pool)
+
+    assert manager.close_server({"host1", "host1.example.com", "10.0.0.1"}) == 2
+    assert by_ip.closed and by_name.closed
+    assert not busy.closed and not other.closed
+
+def test_close_all():
+    manager, _clock = get_manager()
+    opener = Opener()
+    pools = [manager.acquire(kwargs(server=s), opener) for s in ("host1", "host2")]
+    manager.release(pools[0])
+
+    manager.close_all()
+
+    assert all(pool.closed for pool in pools)
+    assert manager.sessions == []
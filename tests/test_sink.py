@@ -0,0 +1,134 @@
+"""Host results written to JSONL and CSV files"""
+import csv
+import json
+import logging
+import threading
+
+import constants as c
+from fleet import set_host_result
+from sink import CsvSink, JsonlSink, get_format, get_sink
+
+LOGGER = logging.getLogger("test_sink")
+
+
+def host_result(host, **fields):
+    result = set_host_result(host)
+    result.update(status=c.HOST_SUCCESS, start=1700000000.5, duration=1.25, rtt=0.004,
+                  stdout="line 1\nline \"2\", with a comma", timings={c.STAGE_RUN: 1.0})
+    result.update(fields)
+    return result
+
+
+def test_format_from_the_file_name():
+    assert get_format("results.csv") == c.SINK_CSV
+    assert get_format("RESULTS.CSV") == c.SINK_CSV
+    assert get_format("results.jsonl") == c.SINK_JSONL
+    assert get_format("results.txt") == c.SINK_JSONL
+    assert get_format("results.csv", c.SINK_JSONL) == c.SINK_JSONL
+
+def test_get_sink(tmp_path):
+    with get_sink(LOGGER, str(tmp_path / "a.csv")) as sink:
+        assert isinstance(sink, CsvSink)
+
+    with get_sink(LOGGER, str(tmp_path / "a.out"), c.SINK_CSV) as sink:
+        assert isinstance(sink, CsvSink)
+
+    with get_sink(LOGGER, str(tmp_path / "a.json")) as sink:
+        assert isinstance(sink, JsonlSink)
+
+def test_jsonl(tmp_path):
+    path = tmp_path / "results.jsonl"
+
+    with JsonlSink(LOGGER, str(path)) as sink:
+        sink.write(host_result("host1", attempts=2))
+        sink.write(host_result("host2", status=c.HOST_FAILED, stderr="Access denied"))
+
+    lines = path.read_text(encoding="utf-8").splitlines()
+    first = json.loads(lines[0])
+
+    assert len(lines) == 2
+    assert list(first) == c.SINK_FIELDS + ["attempts", "timings"]
+    assert first["stdout"] == "line 1\nline \"2\", with a comma"
+    assert first["attempts"] == 2
+    assert first["timings"] == {c.STAGE_RUN: 1.0}
+    assert json.loads(lines[1])["stderr"] == "Access denied"
+    assert sink.count == 2
+
+def test_jsonl_digest_and_cache_fields_only_when_used(tmp_path):
+    path = tmp_path / "results.jsonl"
+
+    with JsonlSink(LOGGER, str(path)) as sink:
+        sink.write(host_result("plain"))
+        sink.write(host_result("digest", changed=True, diff="-a\n+b"))
+        sink.write(host_result("cached", cached=True, cached_age=30.0))
+
+    plain, digest, cached = [json.loads(line) for line in path.read_text().splitlines()]
+
+    assert "changed" not in plain and "cached" not in plain
+    assert digest["changed"] is True and digest["diff"] == "-a\n+b"
+    assert cached["cached"] is True and cached["cached_age"] == 30.0
+
+def test_csv(tmp_path):
+    path = tmp_path / "results.csv"
+
+    with CsvSink(LOGGER, str(path)) as sink:
+        sink.write(host_result("host1", attempts=3))
+        sink.write(host_result("host2", rtt=None))
+
+    with open(str(path), newline="", encoding="utf-8") as fh:
+        rows = list(csv.reader(fh))
+
+    assert rows[0] == c.SINK_FIELDS
+    assert rows[1] == ["host1", c.HOST_SUCCESS, "1700000000.5", "1.25", "0.004",
+                       "line 1\nline \"2\", with a comma", ""]
+    assert rows[2][4] == ""
+    assert len(rows) == 3
+
+def test_csv_header_only_in_a_new_file(tmp_path):
+    path = tmp_path / "results.csv"
+
+    for host in ("host1", "host2"):
+        with CsvSink(LOGGER, str(path)) as sink:
+            sink.write(host_result(host))
+
+    with open(str(path), newline="", encoding="utf-8") as fh:
+        rows = list(csv.reader(fh))
+
+    assert [row[0] for row in rows] == ["host", "host1", "host2"]
+
+def test_results_appended(tmp_path):
+    path = tmp_path / "results.jsonl"
+
+    for host in ("host1", "host2"):
+        with JsonlSink(LOGGER, str(path)) as sink:
+            sink.write(host_result(host))
+
+    assert [json.loads(line)["host"] for line in path.read_text().splitlines()] == \
+        ["host1", "host2"]
+
+def test_written_from_many_threads(tmp_path):
+    path = tmp_path / "results.jsonl"
+
+    with JsonlSink(LOGGER, str(path)) as sink:
+        threads = [
+            threading.Thread(target=lambda i=i: [
+                sink.write(host_result("host%s-%s" % (i, n), stdout="x" * 5000))
+                for n in range(50)
+            ]) for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+
+    assert len(records) == 400
+    assert len(set(r["host"] for r in records)) == 400
+
+def test_close_twice(tmp_path):
+    sink = JsonlSink(LOGGER, str(tmp_path / "results.jsonl"))
+    sink.close()
+    sink.close()
+
+    assert sink.fh is None
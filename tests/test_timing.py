@@ -0,0 +1,118 @@
+"""Stage timings - nearest rank percentiles, and the JSON and Prometheus metrics files"""
+import json
+import logging
+
+import pytest
+
+import constants as c
+import timing
+from timing import StageTimer, aggregate, build_report, percentile, write_report
+
+LOGGER = logging.getLogger("test_timing")
+
+
+@pytest.mark.parametrize("values, pct, expected", [
+    ([15, 20, 35, 40, 50], 5, 15),
+    ([15, 20, 35, 40, 50], 30, 20),
+    ([15, 20, 35, 40, 50], 40, 20),
+    ([15, 20, 35, 40, 50], 50, 35),
+    ([15, 20, 35, 40, 50], 100, 50),
+    ([3, 6, 7, 8, 8, 10, 13, 15, 16, 20], 25, 7),
+    ([3, 6, 7, 8, 8, 10, 13, 15, 16, 20], 50, 8),
+    ([3, 6, 7, 8, 8, 10, 13, 15, 16, 20], 75, 15),
+    ([7], 99, 7),
+    ([2, 1], 50, 1),
+    ([2, 1], 51, 2),
+])
+def test_nearest_rank(values, pct, expected):
+    assert percentile(values, pct) == expected
+
+def test_nearest_rank_of_many_values():
+    values = list(range(1, 1001))
+
+    assert percentile(values, 50) == 500
+    assert percentile(values, 95) == 950
+    assert percentile(values, 99) == 990
+    # Always one of the values, never an interpolation
+    assert percentile([1.0, 2.0, 10.0], 95) == 10.0
+
+def test_aggregate():
+    report = aggregate([
+        {c.STAGE_RUN: 1.0, c.STAGE_CONNECT: 0.5},
+        {c.STAGE_RUN: 3.0},
+        {c.STAGE_RUN: 2.0, "custom": 0.1},
+    ])
+
+    # Stages in the order they happen, unknown ones last
+    assert list(report) == [c.STAGE_CONNECT, c.STAGE_RUN, "custom"]
+    assert report[c.STAGE_RUN] == {"count": 3, "sum": 6.0, "max": 3.0, "p50": 2.0, "p95": 3.0,
+                                   "p99": 3.0}
+    assert report[c.STAGE_CONNECT]["count"] == 1
+
+def test_prometheus(tmp_path):
+    report = build_report([{c.STAGE_RUN: 1.0}, {c.STAGE_RUN: 2.0}],
+                          {c.HOST_SUCCESS: 2, c.HOST_FAILED: 0})
+    report["timestamp"] = 1700000000.0
+    path = tmp_path / "win_mgt.prom"
+
+    assert write_report(LOGGER, report, str(path))
+
+    name = "%s_stage_seconds" % c.METRICS_PREFIX
+    assert path.read_text(encoding="utf-8").splitlines() == [
+        "# HELP %s Time spent in each stage of connecting to and running on a host" % name,
+        "# TYPE %s summary" % name,
+        '%s{stage="run",quantile="0.5"} 1.000000' % name,
+        '%s{stage="run",quantile="0.95"} 2.000000' % name,
+        '%s{stage="run",quantile="0.99"} 2.000000' % name,
+        '%s_sum{stage="run"} 3.000000' % name,
+        '%s_count{stage="run"} 2' % name,
+        "# HELP win_mgt_hosts Hosts by result of the last run",
+        "# TYPE win_mgt_hosts gauge",
+        'win_mgt_hosts{status="success"} 2',
+        'win_mgt_hosts{status="failed"} 0',
+        "# HELP win_mgt_last_run_timestamp_seconds When the last run finished",
+        "# TYPE win_mgt_last_run_timestamp_seconds gauge",
+        "win_mgt_last_run_timestamp_seconds 1700000000.000",
+    ]
+
+def test_prometheus_without_counts(tmp_path):
+    path = tmp_path / "metrics.txt"
+
+    assert write_report(LOGGER, build_report([]), str(path), c.METRICS_PROMETHEUS)
+    assert "_hosts" not in path.read_text(encoding="utf-8")
+
+def test_json(tmp_path):
+    report = build_report([{c.STAGE_RUN: 1.5}], {c.HOST_SUCCESS: 1})
+    path = tmp_path / "metrics.json"
+
+    assert write_report(LOGGER, report, str(path))
+
+    written = json.loads(path.read_text(encoding="utf-8"))
+    assert written["hosts"] == 1
+    assert written["counts"] == {c.HOST_SUCCESS: 1}
+    assert written["stages"][c.STAGE_RUN]["p99"] == 1.5
+
+def test_write_report_leaves_no_temporary_file(tmp_path):
+    path = tmp_path / "win_mgt.prom"
+    write_report(LOGGER, build_report([]), str(path))
+
+    assert [p.name for p in tmp_path.iterdir()] == ["win_mgt.prom"]
+
+def test_write_report_failure(tmp_path):
+    assert not write_report(LOGGER, build_report([]), str(tmp_path / "missing" / "m.prom"))
+
+def test_stage_timer_adds_up_repeated_stages(monkeypatch):
+    ticks = iter([10.0, 10.5, 20.0, 20.25, 30.0, 31.0])
+    monkeypatch.setattr(timing.time, "monotonic", lambda: next(ticks))
+    timer = StageTimer()
+
+    with timer.stage(c.STAGE_RUN):
+        pass
+    with timer.stage(c.STAGE_RUN):
+        pass
+
+    with pytest.raises(ValueError):
+        with timer.stage(c.STAGE_READ):
+            raise ValueError("failed part way")
+
+    assert timer.timings == {c.STAGE_RUN: 0.75, c.STAGE_READ: 1.0}
@@ -0,0 +1,350 @@
+"""Chunked transfers against a fake host - the journal, resuming, checksums and the runspaces of
+the pool"""
+import os
+import logging
+import argparse
+
+import pytest
+
+import constants as c
+import transfer
+from transfer import FileTransfer, TransferError, checksum, get_gaps
+
+LOGGER = logging.getLogger("test_transfer")
+CHUNK = 1024
+SERVER = "host1"
+
+
+class FakeHost:
+    """The files of the host, and the scripts transfer.py runs against them"""
+
+    def __init__(self):
+        self.files = {}
+        # Offsets of the chunks asked for or sent, in order
+        self.chunks = []
+        # offset: how many more times the chunk is sent back with the wrong data
+        self.corrupt = {}
+        # offset: how many more times the chunk fails on the host
+        self.failing = {}
+
+    def run(self, script, params):
+        if script == transfer.PULL_PREPARE_SCRIPT:
+            return [str(len(self.files[params["Path"]])), "637000000000000000"]
+
+        if script == transfer.PULL_CHUNK_SCRIPT:
+            offset = int(params["Offset"])
+            self.chunks.append(offset)
+            self._fail(offset)
+            data = self.files[params["Path"]][offset:offset + params["Length"]]
+            chunk_hash = checksum(data)
+
+            if self.corrupt.get(offset, 0) > 0:
+                self.corrupt[offset] -= 1
+                data = b"x" + data[1:]
+
+            return [chunk_hash, data]
+
+        if script == transfer.PUSH_PREPARE_SCRIPT:
+            path = params["Path"]
+            part = self.files.get(path + params["Suffix"], b"")
+            verified = [
+                r["o"] for r in transfer.json.loads(params["Ranges"])
+                if checksum(part[int(r["o"]):int(r["o"]) + r["l"]]) == r["h"]
+            ]
+            return [path] + verified
+
+        if script == transfer.PUSH_CHUNK_SCRIPT:
+            offset = int(params["Offset"])
+            self.chunks.append(offset)
+            self._fail(offset)
+
+            if checksum(params["Data"]) != params["Hash"]:
+                raise TransferError("Checksum mismatch for the chunk at %s" % offset)
+
+            part = bytearray(self.files.get(params["Part"], b""))
+            part[len(part):] = bytes(max(0, offset + len(params["Data"]) - len(part)))
+            part[offset:offset + len(params["Data"])] = params["Data"]
+            self.files[params["Part"]] = bytes(part)
+            return []
+
+        if script == transfer.PUSH_FINISH_SCRIPT:
+            data = self.files.pop(params["Part"], b"")[:int(params["Length"])]
+            self.files[params["Path"]] = data
+            return []
+
+        raise AssertionError("Unexpected script")
+
+    def _fail(self, offset):
+        if self.failing.get(offset, 0) > 0:
+            self.failing[offset] -= 1
+            raise TransferError("The host failed the chunk at %s" % offset)
+
+
+class FakePool:
+    def __init__(self, host, max_runspaces=1):
+        self.host = host
+        self.max_runspaces = max_runspaces
+
+
+class FakeStreams:
+    def __init__(self):
+        self.error = []
+
+
+class FakePowerShell:
+    """Runs the script on the fake host when invoked, failures go in the error stream"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.script = None
+        self.params = None
+        self.had_errors = False
+        self.streams = FakeStreams()
+        self.output = None
+        # Every chunk in flight needs a runspace of its own
+        assert pool.max_runspaces >= 2
+
+    def add_script(self, script):
+        self.script = script
+        return self
+
+    def add_parameters(self, params):
+        self.params = params
+        return self
+
+    def invoke(self):
+        try:
+            return self.pool.host.run(self.script, self.params)
+        except TransferError as e:
+            self.had_errors = True
+            self.streams.error.append(str(e))
+            return []
+
+    def begin_invoke(self):
+        self.output = self.invoke()
+
+    def end_invoke(self):
+        return self.output
+
+
+@pytest.fixture(autouse=True)
+def fake_remote(monkeypatch, tmp_path):
+    """Fixed size chunks, and journals kept under tmp_path"""
+    monkeypatch.setattr(transfer, "PowerShell", FakePowerShell)
+    monkeypatch.setattr(c, "TRANSFER_CHUNK_MIN", CHUNK)
+    monkeypatch.setattr(c, "TRANSFER_CHUNK_MAX", CHUNK)
+    monkeypatch.setattr(c, "TRANSFER_STATE_DIR", str(tmp_path / "journals"))
+
+def get_transfer(host, max_runspaces=1):
+    args = argparse.Namespace(transfer_streams=3, transfer_chunk_kb=1)
+    return FileTransfer(LOGGER, args, FakePool(host, max_runspaces), SERVER)
+
+def file_data(size):
+    return bytes(i % 251 for i in range(size))
+
+def journals(tmp_path):
+    folder = tmp_path / "journals"
+    return sorted(os.listdir(str(folder))) if folder.exists() else []
+
+
+def test_get_gaps():
+    assert get_gaps(10, []) == [(0, 10)]
+    assert get_gaps(10, [(0, 4, "a"), (6, 2, "b")]) == [(4, 6), (8, 10)]
+    assert get_gaps(10, [(4, 6, "b"), (0, 4, "a")]) == []
+
+def test_pull(tmp_path):
+    host = FakeHost()
+    host.files["C:\\data\\big.bin"] = file_data(CHUNK * 5 + 100)
+    destination = tmp_path / "big.bin"
+    file_transfer = get_transfer(host)
+
+    summary = file_transfer.run({"direction": c.TRANSFER_PULL, "source": "C:\\data\\big.bin",
+                                 "destination": str(destination)})
+
+    assert destination.read_bytes() == host.files["C:\\data\\big.bin"]
+    assert sorted(host.chunks) == [i * CHUNK for i in range(6)]
+    assert "Pulled" in summary and "resumed" not in summary
+    assert journals(tmp_path) == []
+
+def test_pull_into_a_folder(tmp_path):
+    host = FakeHost()
+    host.files["C:\\data\\small.txt"] = b"hello"
+
+    get_transfer(host).run({"direction": c.TRANSFER_PULL, "source": "C:\\data\\small.txt",
+                            "destination": str(tmp_path)})
+
+    assert (tmp_path / "small.txt").read_bytes() == b"hello"
+
+def test_pull_chunk_that_does_not_match_its_checksum_asked_for_again(tmp_path):
+    host = FakeHost()
+    host.files["C:\\big.bin"] = file_data(CHUNK * 3)
+    host.corrupt[CHUNK] = 2
+    destination = tmp_path / "big.bin"
+
+    get_transfer(host).run({"direction": c.TRANSFER_PULL, "source": "C:\\big.bin",
+                            "destination": str(destination)})
+
+    assert destination.read_bytes() == host.files["C:\\big.bin"]
+    assert host.chunks.count(CHUNK) == 3
+
+def test_interrupted_pull_resumes(tmp_path):
+    host = FakeHost()
+    host.files["C:\\big.bin"] = file_data(CHUNK * 8)
+    # Always corrupted, the transfer gives up on it
+    host.corrupt[CHUNK * 5] = c.TRANSFER_CHUNK_RETRIES + 1
+    destination = tmp_path / "big.bin"
+    details = {"direction": c.TRANSFER_PULL, "source": "C:\\big.bin",
+               "destination": str(destination)}
+
+    with pytest.raises(TransferError):
+        get_transfer(host).run(details)
+
+    assert not destination.exists()
+    assert (tmp_path / ("big.bin" + c.TRANSFER_PART_SUFFIX)).exists()
+    assert len(journals(tmp_path)) == 1
+
+    host.chunks = []
+    file_transfer = get_transfer(host)
+    summary = file_transfer.run(details)
+
+    # Only the chunk that failed is asked for again
+    assert destination.read_bytes() == host.files["C:\\big.bin"]
+    assert file_transfer.resumed == CHUNK * 7
+    assert host.chunks == [CHUNK * 5]
+    assert "resumed with %s bytes" % file_transfer.resumed in summary
+    assert journals(tmp_path) == []
+
+def test_pull_journal_for_another_version_ignored(tmp_path):
+    host = FakeHost()
+    host.files["C:\\big.bin"] = file_data(CHUNK * 4)
+    host.failing[CHUNK * 3] = c.TRANSFER_CHUNK_RETRIES + 1
+    destination = tmp_path / "big.bin"
+    details = {"direction": c.TRANSFER_PULL, "source": "C:\\big.bin",
+               "destination": str(destination)}
+
+    with pytest.raises(TransferError):
+        get_transfer(host).run(details)
+
+    # Changed on the host since, so its size is different
+    host.files["C:\\big.bin"] = file_data(CHUNK * 4 + 1)
+    host.chunks = []
+    file_transfer = get_transfer(host)
+    file_transfer.run(details)
+
+    assert file_transfer.resumed == 0
+    assert sorted(host.chunks) == [i * CHUNK for i in range(5)]
+    assert destination.read_bytes() == host.files["C:\\big.bin"]
+
+def test_local_part_file_checked_before_resuming(tmp_path):
+    host = FakeHost()
+    host.files["C:\\big.bin"] = file_data(CHUNK * 4)
+    host.failing[CHUNK * 3] = c.TRANSFER_CHUNK_RETRIES + 1
+    destination = tmp_path / "big.bin"
+    details = {"direction": c.TRANSFER_PULL, "source": "C:\\big.bin",
+               "destination": str(destination)}
+
+    with pytest.raises(TransferError):
+        get_transfer(host).run(details)
+
+    # The first chunk of the partly copied file is damaged, so only it is copied again
+    part = tmp_path / ("big.bin" + c.TRANSFER_PART_SUFFIX)
+    with open(str(part), "r+b") as fh:
+        fh.write(b"damaged")
+
+    host.chunks = []
+    get_transfer(host).run(details)
+
+    assert sorted(host.chunks) == [0, CHUNK * 3]
+    assert destination.read_bytes() == host.files["C:\\big.bin"]
+
+def test_push_and_resume(tmp_path):
+    host = FakeHost()
+    source = tmp_path / "app.zip"
+    source.write_bytes(file_data(CHUNK * 6 + 10))
+    host.failing[CHUNK * 2] = c.TRANSFER_CHUNK_RETRIES + 1
+    details = {"direction": c.TRANSFER_PUSH, "source": str(source),
+               "destination": "C:\\deploy\\"}
+
+    with pytest.raises(TransferError):
+        get_transfer(host).run(details)
+
+    assert "C:\\deploy\\app.zip" not in host.files
+
+    host.chunks = []
+    file_transfer = get_transfer(host)
+    summary = file_transfer.run(details)
+
+    assert host.files["C:\\deploy\\app.zip"] == source.read_bytes()
+    # Only the chunk that failed is sent again
+    assert file_transfer.resumed == CHUNK * 5 + 10
+    assert host.chunks == [CHUNK * 2]
+    assert summary.startswith("Pushed %s to C:\\deploy\\app.zip" % source)
+    assert journals(tmp_path) == []
+
+def test_push_resends_what_the_host_no_longer_has(tmp_path):
+    host = FakeHost()
+    source = tmp_path / "app.zip"
+    source.write_bytes(file_data(CHUNK * 4))
+    host.failing[CHUNK * 3] = c.TRANSFER_CHUNK_RETRIES + 1
+    details = {"direction": c.TRANSFER_PUSH, "source": str(source),
+               "destination": "C:\\app.zip"}
+
+    with pytest.raises(TransferError):
+        get_transfer(host).run(details)
+
+    del host.files["C:\\app.zip" + c.TRANSFER_PART_SUFFIX]
+    host.chunks = []
+    file_transfer = get_transfer(host)
+    file_transfer.run(details)
+
+    assert file_transfer.resumed == 0
+    assert sorted(host.chunks) == [i * CHUNK for i in range(4)]
+    assert host.files["C:\\app.zip"] == source.read_bytes()
+
+def test_runspaces_given_back(tmp_path):
+    host = FakeHost()
+    host.files["C:\\big.bin"] = file_data(CHUNK * 2)
+    file_transfer = get_transfer(host, max_runspaces=1)
+
+    file_transfer.run({"direction": c.TRANSFER_PULL, "source": "C:\\big.bin",
+                       "destination": str(tmp_path / "big.bin")})
+
+    assert file_transfer.runspacepool.max_runspaces == 1
+    assert not file_transfer.pool_changed
+
+def test_runspaces_given_back_after_a_failure(tmp_path):
+    host = FakeHost()
+    file_transfer = get_transfer(host, max_runspaces=1)
+
+    with pytest.raises(KeyError):
+        file_transfer.run({"direction": c.TRANSFER_PULL, "source": "C:\\missing.bin",
+                           "destination": str(tmp_path / "missing.bin")})
+
+    assert file_transfer.runspacepool.max_runspaces == 1
+
+def test_larger_pool_left_alone(tmp_path):
+    host = FakeHost()
+    host.files["C:\\big.bin"] = file_data(CHUNK)
+    file_transfer = get_transfer(host, max_runspaces=8)
+
+    file_transfer.run({"direction": c.TRANSFER_PULL, "source": "C:\\big.bin",
+                       "destination": str(tmp_path / "big.bin")})
+
+    assert file_transfer.runspacepool.max_runspaces == 8
+
+def test_pool_that_cannot_be_given_back(tmp_path):
+    class StuckPool(FakePool):
+        def __setattr__(self, name, value):
+            if name == "max_runspaces" and getattr(self, name, 0) > value:
+                raise OSError("connection reset")
+            super().__setattr__(name, value)
+
+    host = FakeHost()
+    host.files["C:\\big.bin"] = file_data(CHUNK)
+    file_transfer = FileTransfer(LOGGER, argparse.Namespace(transfer_streams=3),
+                                 StuckPool(host), SERVER)
+
+    file_transfer.run({"direction": c.TRANSFER_PULL, "source": "C:\\big.bin",
+                       "destination": str(tmp_path / "big.bin")})
+
+    assert file_transfer.pool_changed
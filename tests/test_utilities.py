@@ -0,0 +1,11 @@
+from utilities import ps_quote
+
+
+def test_ps_quote_doubles_single_quotes():
+    assert ps_quote("it's") == "'it''s'"
+    assert ps_quote(42) == "'42'"
+
+def test_ps_quote_doubles_unicode_single_quotes():
+    for quote in "\u2018\u2019\u201a\u201b":
+        value = "x%s; Remove-Item C:\\ -Recurse; %s" % (quote, quote)
+        assert ps_quote(value) == "'x%s; Remove-Item C:\\ -Recurse; %s'" % (quote * 2, quote * 2)
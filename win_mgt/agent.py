@@ -0,0 +1,342 @@
+import os
+import sys
+import copy
+import time
+import json
+import signal
+import logging
+import argparse
+import threading
+import socketserver
+
+import constants as c
+import argument_defs
+from utilities import CustomFormatter, get_password, load_hosts
+from command_builder import CommandBuilder
+from transport_pypsrp import Transport
+from fleet import Fleet, run_host, set_host_result
+from rolling import RollingRestart, is_rolling
+from session import get_session_manager
+from profiles import get_profile_store
+from digests import get_digest_store
+from result_cache import get_result_cache, cache_key
+from sqlite_store import flush_stores
+
+def request_logger(logger, send):
+    """The logger of one request - it logs where the agent's logger does, and passes warnings
+    and errors back to the client. Everything run for the request (fleet worker threads too)
+    is given this logger, so only what is logged for the request reaches its client"""
+    request_log = logging.Logger(logger.name, logger.level)
+
+    for handler in logger.handlers:
+        request_log.addHandler(handler)
+
+    request_log.addHandler(ClientLogHandler(send))
+
+    return request_log
+
+
+class ClientLogHandler(logging.Handler):
+    """Passes warnings and errors logged for a request back to the client"""
+
+    def __init__(self, send):
+        super().__init__(logging.WARNING)
+        self.send = send
+
+    def emit(self, record):
+        try:
+            self.send({"type": c.AGENT_LOG, "level": record.levelname,
+                       "message": record.getMessage()})
+        except OSError:
+            pass
+
+
+class ClientSink:
+    """Results sink for fleet requests, each host result goes straight back to the client"""
+
+    def __init__(self, send):
+        self.send = send
+
+    def write(self, host_result):
+        """Send the result of one host"""
+        self.send(dict(host_result, type=c.AGENT_RESULT))
+
+
+class Agent:
+    def __init__(self, logger, args, password):
+        self.logger = logger
+        # Sessions are kept open between requests, that is what the agent is for
+        self.args = copy.copy(args)
+        self.args.keep_sessions = True
+        self.password = password
+        self.sessions = get_session_manager(logger, args)
+        # Opened once for every request, housekeeping writes them out (flush_stores)
+        get_profile_store(logger, args)
+        get_digest_store(logger, args)
+        self.cache = get_result_cache(logger, args)
+        self.stopping = threading.Event()
+
+    def _request_args(self, request):
+        """The agent inputs with those of the request on top, None if the request is invalid"""
+        if request.get("username", None) != self.args.username:
+            return None, "The agent runs as %s" % self.args.username
+
+        if request.get("task", None) not in c.CHOICES_TASKS:
+            return None, "Invalid task %s" % request.get("task", None)
+
+        if not request.get("server", None) or not request.get("option", None):
+            return None, "A server and option are required"
+
+        args = copy.copy(self.args)
+        for field in c.AGENT_REQUEST_FIELDS:
+            if field in request:
+                setattr(args, field, request[field])
+
+        args.task = args.task.lower()
+        args.option = args.option.lower()
+        args.output = args.output or c.DEFAULT_OUTPUT
+
+        return args, None
+
+    def _run_callbacks(self, logger, args, command_detail, host, send):
+        """A single host where output is passed on as it arrives (streaming or objects)"""
+        transport = Transport(logger, args, self.password, server=host)
+
+        try:
+            transport.connect(command_detail["command_type_raw"])
+
+            if not transport.connected:
+                return c.HOST_UNREACHABLE if transport.unreachable else c.HOST_FAILED
+
+            if args.output == c.OUTPUT_JSON:
+                run_ok = transport.run_structured(
+                    command_detail["command"], command_detail.get("properties", None),
+                    lambda obj: send({"type": c.AGENT_OBJECT, "data": obj})
+                )
+            else:
+                run_ok = transport.stream_command(
+                    command_detail["command"],
+                    lambda kind, item: send({
+                        "type": c.AGENT_ERROR if kind == c.STREAM_ERROR else c.AGENT_OUTPUT,
+                        "data": str(item)
+                    })
+                )
+
+            if not run_ok:
+                send({"type": c.AGENT_ERROR, "data": str(transport.result_dict["stderr"])})
+
+            return c.HOST_SUCCESS if run_ok else c.HOST_FAILED
+        finally:
+            transport.disconnect()
+
+    def handle(self, logger, request, send):
+        """Run one request, logging to its logger (see request_logger), returns the overall
+        status"""
+        args, error = self._request_args(request)
+
+        if args is None:
+            send({"type": c.AGENT_ERROR, "data": error})
+            return c.HOST_FAILED
+
+        hosts = load_hosts(args.server)
+        command_detail = CommandBuilder(logger, args).get_command()
+
+        if command_detail is None:
+            send({"type": c.AGENT_ERROR, "data": "Unable to build the command"})
+            return c.HOST_FAILED
+
+        is_batch = "commands" in command_detail
+
+        if is_rolling(args, command_detail):
+            fleet = RollingRestart(logger, args, self.password, hosts, ClientSink(send))
+            return c.HOST_SUCCESS if fleet.run(command_detail) else c.HOST_FAILED
+
+        if len(hosts) > 1:
+            fleet = Fleet(logger, args, self.password, hosts, ClientSink(send))
+            return c.HOST_SUCCESS if fleet.run(command_detail) else c.HOST_FAILED
+
+        # Transfers give a summary at the end, like a batch
+        if not is_batch and "transfer" not in command_detail and \
+                (args.stream or args.output == c.OUTPUT_JSON):
+            status = self._run_callbacks(logger, args, command_detail, hosts[0], send)
+        else:
+            host_result = self._run_host(logger, args, command_detail, hosts[0])
+            send(dict(host_result, type=c.AGENT_RESULT))
+            status = host_result["status"]
+
+        if self.cache is not None and command_detail.get("mutates", False):
+            self.cache.invalidate(hosts[0])
+
+        return status
+
+    def _run_host(self, logger, args, command_detail, host):
+        """Run the command on a single host, unless there is a recent enough cached result"""
+        request = cache_key(args, command_detail) if self.cache is not None else None
+
+        if request is not None and not args.cache_bypass:
+            result = self.cache.get(host, args.username, request)
+
+            if result is not None:
+                host_result = set_host_result(host)
+                host_result.update(
+                    status=result["status"], stdout=result["stdout"], stderr=result["stderr"],
+                    start=time.time(), cached=True, cached_age=time.time() - result["saved"]
+                )
+                return host_result
+
+        host_result = run_host(logger, args, self.password, command_detail, host)
+
+        # Written straight away, other jobs may be about to ask for the same thing
+        if request is not None and host_result["status"] == c.HOST_SUCCESS:
+            self.cache.put(host, args.username, request, host_result)
+            self.cache.flush()
+
+        return host_result
+
+    def housekeeping(self):
+        """Close sessions that have gone idle, until the agent stops"""
+        while not self.stopping.wait(c.AGENT_HOUSEKEEPING_INTERVAL):
+            closed = self.sessions.close_idle()
+
+            if closed > 0:
+                self.logger.debug("agent.housekeeping: Closed %s idle sessions", closed)
+
+            flush_stores()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """One request per connection - a line of JSON in, lines of JSON back"""
+
+    def handle(self):
+        agent = self.server.agent
+        lock = threading.Lock()
+
+        def send(message):
+            """Send a message, fleet requests send from several threads"""
+            with lock:
+                self.wfile.write(json.dumps(message, default=str).encode("utf-8") + b"\n")
+                self.wfile.flush()
+
+        try:
+            request = json.loads(self.rfile.readline(c.AGENT_MAX_REQUEST))
+        except ValueError as e:
+            send({"type": c.AGENT_DONE, "status": c.HOST_FAILED, "error": "Bad request: %s" % e})
+            return
+
+        logger = request_logger(agent.logger, send)
+
+        try:
+            logger.info(
+                "Request: %s %s %s", request.get("server"), request.get("task"),
+                request.get("option")
+            )
+            status = agent.handle(logger, request, send)
+            send({"type": c.AGENT_DONE, "status": status})
+        except OSError as e:
+            agent.logger.warning("agent.handle: Lost the client: %s", str(e))
+        except Exception as e:
+            logger.error("agent.handle: Error %s handling request: %s", type(e), str(e))
+            try:
+                send({"type": c.AGENT_DONE, "status": c.HOST_FAILED, "error": str(e)})
+            except OSError:
+                pass
+
+
+class AgentServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, agent):
+        self.agent = agent
+        super().__init__(socket_path, RequestHandler)
+
+
+def open_server(logger, args, password):
+    """The agent's server, bound to its socket"""
+    socket_path = os.path.expanduser(args.socket)
+
+    # A socket left by an agent that did not shut down cleanly
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    agent = Agent(logger, args, password)
+
+    # Only this user can talk to the agent, it holds their credentials. The umask keeps others
+    # out from the bind on, the chmod then drops the execute bit it leaves
+    old_umask = os.umask(0o077)
+    try:
+        server = AgentServer(socket_path, agent)
+    finally:
+        os.umask(old_umask)
+
+    os.chmod(socket_path, 0o600)
+
+    return server
+
+def serve(logger, args, password):
+    """Listen on the socket until stopped"""
+    socket_path = os.path.expanduser(args.socket)
+    server = open_server(logger, args, password)
+    agent = server.agent
+
+    threading.Thread(target=agent.housekeeping, daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("Agent listening on %s", socket_path)
+
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        agent.stopping.set()
+        server.server_close()
+        os.unlink(socket_path)
+        agent.sessions.close_all()
+        logger.info("Agent stopped")
+
+
+def get_parser():
+    """The agent's arguments - the credentials and connection settings to use for every
+    request"""
+    parser = argparse.ArgumentParser(
+        description="Agent keeping resolved hosts, Kerberos tickets and sessions between runs"
+    )
+    parser.add_argument("--socket", help="unix socket to listen on", type=str,
+                        default=c.DEFAULT_AGENT_SOCKET)
+
+    argument_defs.args_credentials(parser.add_argument_group("credentials settings"))
+    argument_defs.args_connect(parser.add_argument_group("connection settings"))
+    argument_defs.args_session(parser.add_argument_group("session settings"))
+    argument_defs.args_kerberos(parser.add_argument_group("kerberos settings"))
+    argument_defs.args_optional(parser.add_argument_group("additional settings"))
+    argument_defs.args_fleet(parser.add_argument_group("fleet settings"))
+    argument_defs.args_transfer(parser.add_argument_group("transfer settings"))
+    argument_defs.args_command(parser.add_argument_group("task options"))
+
+    return parser
+
+def main():
+    """Start the agent, manage_device.py then sends its requests with --agent-socket"""
+    args = get_parser().parse_args()
+    # Filled in by each request
+    args.server = args.task = args.option = None
+
+    logger = logging.Logger(__name__)
+    logger.level = logging.DEBUG if args.debug else logging.INFO
+    h = logging.StreamHandler(sys.stdout)
+    h.setFormatter(CustomFormatter())
+    logger.addHandler(h)
+
+    password = get_password(args.username, args.pwd)
+
+    if password is None or len(password) == 0:
+        logger.error("No password was supplied for user: %s", args.username)
+        sys.exit(1)
+
+    # Nobody is there to answer a prompt, so missing task options fail the request straight away
+    sys.stdin = open(os.devnull, "r", encoding="utf-8")
+
+    serve(logger, args, password)
+
+
+if __name__ == "__main__":
+    main()
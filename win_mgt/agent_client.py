@@ -0,0 +1,39 @@
+import os
+import json
+import socket
+
+import constants as c
+
+def build_request(args, hosts):
+    """The request for the agent - the task inputs only, no credentials"""
+    request = {field: getattr(args, field, None) for field in c.AGENT_REQUEST_FIELDS}
+    request["server"] = ",".join(hosts)
+    request["username"] = args.username
+
+    return request
+
+def send_request(socket_path, request, callback):
+    """Send a request to the agent, each message it sends back goes to callback(message)
+
+    Returns the final (done) message, raises OSError if the agent can't be reached"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(os.path.expanduser(socket_path))
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+        with sock.makefile("r", encoding="utf-8") as fh:
+            for line in fh:
+                message = json.loads(line)
+
+                if message["type"] == c.AGENT_DONE:
+                    return message
+
+                callback(message)
+    finally:
+        sock.close()
+
+    # The agent went away before it finished
+    return {
+        "type": c.AGENT_DONE, "status": c.HOST_FAILED, "error": "The agent closed the connection"
+    }
@@ -1,14 +1,30 @@
 import constants as c
 import json
+import argparse
+
+def _count_or_percent(value):
+    """A number of hosts (3) or a percentage of them (25%)"""
+    number = value[:-1] if value.endswith("%") else value
+
+    if not number.isdigit() or int(number) < 1:
+        raise argparse.ArgumentTypeError("%s is not a number or percentage of hosts" % value)
+
+    return value
 
 def args_positional(parser):
     """Positional arguments"""
-    parser.add_argument("server", help="Windows server to manage", type=str)
+    parser.add_argument(
+        "server", type=str,
+        help="Windows server to manage, a comma separated list of servers, or %sfile to read "
+        "servers from an inventory file (one per line)" % c.INVENTORY_PREFIX
+    )
     parser.add_argument(
         "task", help="task to perform", type=str.lower, choices=c.CHOICES_TASKS.keys()
     )
     parser.add_argument(
-        "option", help="specific command for task", type=str.lower,
+        "option", type=str.lower,
+        help="specific command for task, separate several with %s to run them as one batch"
+        % c.BATCH_SEPARATOR,
     )
 
 def args_credentials(parser):
@@ -44,12 +60,65 @@ def args_connect(parser):
         "--connection-timeout", help="connection timeout", type=int,
         default=c.DEFAULT_PYPSRP_ARGS["connection_timeout"]
     )
+    parser.add_argument(
+        "--max-envelope-kb",
+        help="largest envelope to use for raw commands when the server allows it (0 to keep the "
+        "default)", type=int, default=c.MAX_ENVELOPE_KB
+    )
+    parser.add_argument(
+        "--pool-envelope",
+        help="use the larger envelope for PowerShell too, which helps file transfers but slows "
+        "down commands with a lot of output", action="store_true"
+    )
+    parser.add_argument(
+        "--dns-cache", help="file to keep resolved hosts in between runs", type=str
+    )
+
+def args_session(parser):
+    """Reuse of RunspacePool sessions and cmd shells"""
+    parser.add_argument(
+        "--session-idle-timeout", help="seconds an unused session is kept open", type=int,
+        default=c.DEFAULT_SESSION_IDLE_TIMEOUT
+    )
+    parser.add_argument(
+        "--max-sessions", help="maximum number of sessions kept open", type=int,
+        default=c.DEFAULT_MAX_SESSIONS
+    )
 
 def args_command(parser):
     """Options relating to the command"""
     parser.add_argument(
         "--task-options", help="task specific options", type=json.loads
     )
+    parser.add_argument(
+        "--output", help="text as shown by PowerShell, or json for one object per line",
+        type=str.lower, choices=c.CHOICES_OUTPUT, default=c.DEFAULT_OUTPUT
+    )
+    parser.add_argument(
+        "--filter", action="append", dest="filters", metavar="NAME=VALUE",
+        help="only return items matching the filter (wildcards allowed, several values "
+        "separated by %s), can be repeated" % c.FILTER_VALUE_SEPARATOR
+    )
+    parser.add_argument(
+        "--select", help="comma separated properties to return",
+        type=lambda s: [p.strip() for p in s.split(",") if p.strip()]
+    )
+    parser.add_argument(
+        "--stream", help="show the output as it arrives rather than when the command ends",
+        action="store_true"
+    )
+
+def args_transfer(parser):
+    """File transfers (filesystem push / pull)"""
+    parser.add_argument(
+        "--transfer-streams", help="chunks of a file transfer in flight at once", type=int,
+        default=c.DEFAULT_TRANSFER_STREAMS
+    )
+    parser.add_argument(
+        "--transfer-chunk-kb",
+        help="starting chunk size in KB, it is raised while that makes the transfer faster",
+        type=int, default=c.DEFAULT_TRANSFER_CHUNK_KB
+    )
 
 def args_kerberos(parser):
     """Kerberos related"""
@@ -58,8 +127,114 @@ def args_kerberos(parser):
         "--force-cache", help="force the use of a cache file for kerberos ticket", 
         action="store_true"
     )
+    parser.add_argument(
+        "--ticket-renew-before", type=int, default=c.DEFAULT_KRB_RENEW_BEFORE,
+        help="renew a cached kerberos ticket when it has less than this many seconds left"
+    )
+
+def args_fleet(parser):
+    """Multi-host (fleet) related"""
+    parser.add_argument(
+        "--concurrency", help="maximum number of hosts to manage at the same time", type=int,
+        default=c.DEFAULT_CONCURRENCY
+    )
+    parser.add_argument(
+        "--processes",
+        help="split the hosts across this many processes, for CPU bound message encryption",
+        type=int, default=1
+    )
+    parser.add_argument(
+        "--retries", help="times to retry a host that could not be connected to", type=int,
+        default=c.DEFAULT_RETRIES
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        help="seconds before the first retry, doubled (with jitter) for each one after",
+        type=float, default=c.DEFAULT_RETRY_BACKOFF
+    )
+    parser.add_argument(
+        "--fixed-concurrency",
+        help="always run --concurrency hosts at a time, rather than backing off when hosts "
+        "fail or slow down", action="store_false", dest="adaptive_concurrency"
+    )
+    parser.add_argument(
+        "--multiplex",
+        help="run PowerShell commands from one event loop on a few I/O threads, so "
+        "--concurrency can be far higher than the number of threads", action="store_true"
+    )
+    parser.add_argument(
+        "--io-threads", help="threads doing the I/O of a multiplexed run", type=int,
+        default=c.DEFAULT_IO_THREADS
+    )
+    parser.add_argument(
+        "--max-unavailable",
+        help="restart the hosts in waves of this many (or this %% of the hosts), each wave "
+        "waiting for its hosts to come back before the next", type=_count_or_percent
+    )
+    parser.add_argument(
+        "--restart-timeout", help="seconds for a restarted host to come back and be ready",
+        type=int, default=c.DEFAULT_RESTART_TIMEOUT
+    )
+
+def args_results(parser):
+    """Where to write the results of each host"""
+    parser.add_argument(
+        "--results-file", help="append the result of each host to this file as it completes",
+        type=str
+    )
+    parser.add_argument(
+        "--results-format", help="format of the results file (default: from the file extension)",
+        type=str.lower, choices=c.CHOICES_SINK
+    )
+    parser.add_argument(
+        "--metrics-file", help="write per stage timings (p50/p95/p99 across hosts) to this file",
+        type=str
+    )
+    parser.add_argument(
+        "--metrics-format",
+        help="format of the metrics file (default: prometheus for .prom, otherwise json)",
+        type=str.lower, choices=c.CHOICES_METRICS
+    )
+
+def args_agent(parser):
+    """Sending the request to a running agent (agent.py)"""
+    parser.add_argument(
+        "--agent-socket", help="send the request to the agent listening on this socket",
+        type=str
+    )
 
 def args_optional(parser):
     """Arguments that are optional"""
     parser.add_argument("-n", help="do not ping target", action="store_false", dest="ping")
+    parser.add_argument(
+        "--probe-timeout", help="seconds to wait for the target port to answer a ping",
+        type=float, default=c.DEFAULT_PROBE_TIMEOUT
+    )
+    parser.add_argument(
+        "--profile-store",
+        help="SQLite file of what last worked for each host, used to skip lookups and probes",
+        type=str
+    )
+    parser.add_argument(
+        "--digest-store",
+        help="SQLite file of the last output of each host, the output only comes back (with a "
+        "diff) when it has changed", type=str
+    )
+    parser.add_argument(
+        "--result-cache",
+        help="SQLite file of the results of read-only tasks, shared by every job on the machine",
+        type=str
+    )
+    parser.add_argument(
+        "--cache-ttl", help="seconds a cached result is used for", type=int,
+        default=c.DEFAULT_CACHE_TTL
+    )
+    parser.add_argument(
+        "--cache-max-mb", help="size of the result cache before the least used are dropped",
+        type=int, default=c.DEFAULT_CACHE_MAX_MB
+    )
+    parser.add_argument(
+        "--no-cache", help="run the command even if there is a cached result (the new result "
+        "is still cached)", action="store_true", dest="cache_bypass"
+    )
     parser.add_argument("-d", help="enable debug logging", action="store_true", dest="debug")
@@ -0,0 +1,77 @@
+import uuid
+
+import constants as c
+from utilities import ps_quote
+
+def new_marker():
+    """A marker that will not appear in the output of the commands themselves"""
+    return "%s-%s##" % (c.BATCH_MARKER, uuid.uuid4().hex)
+
+def set_command_result(command):
+    """Use a dictionary for the result of each command in the batch"""
+    return {
+        "command": command,
+        "stdout": "",
+        "stderr": "",
+        "is_error": False
+    }
+
+def build_script(commands, marker):
+    """Build one script running every command, with marker lines around the output of each"""
+    # Make non-terminating errors stop the command they occur in, so they can be caught
+    lines = ["$ErrorActionPreference = 'Stop'"]
+
+    for i, command in enumerate(commands):
+        lines.append("Write-Output %s" % ps_quote("%s %s %s" % (marker, c.BATCH_BEGIN, i)))
+        lines.append(
+            "try { Invoke-Expression -Command %s | Out-String -Stream } "
+            "catch { Write-Output (%s + ($_.Exception.Message -replace '\\s*[\\r\\n]+\\s*', ' ')) }"
+            % (ps_quote(command), ps_quote("%s %s %s " % (marker, c.BATCH_ERROR, i)))
+        )
+        lines.append("Write-Output %s" % ps_quote("%s %s %s" % (marker, c.BATCH_END, i)))
+
+    return "\n".join(lines)
+
+def split_output(lines, commands, marker):
+    """Split the output of the batch script back out into a result per command"""
+    results = [set_command_result(command) for command in commands]
+    output = [[] for _ in commands]
+    started = set()
+    current = None
+
+    for line in lines:
+        line = "" if line is None else str(line)
+
+        if not line.startswith(marker):
+            if current is not None:
+                output[current].append(line)
+            continue
+
+        parts = line[len(marker):].strip().split(" ", 2)
+
+        try:
+            index = int(parts[1])
+        except (IndexError, ValueError):
+            continue
+
+        if index >= len(results):
+            continue
+
+        if parts[0] == c.BATCH_BEGIN:
+            current = index
+            started.add(index)
+        elif parts[0] == c.BATCH_END:
+            current = None
+        elif parts[0] == c.BATCH_ERROR:
+            results[index]["is_error"] = True
+            results[index]["stderr"] = parts[2] if len(parts) > 2 else ""
+
+    for i, result in enumerate(results):
+        result["stdout"] = "\n".join(output[i])
+
+        # The batch stopped before this command was reached
+        if i not in started:
+            result["is_error"] = True
+            result["stderr"] = "Command was not run"
+
+    return results
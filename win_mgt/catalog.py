@@ -0,0 +1,227 @@
+import sys
+import threading
+import collections
+from types import MappingProxyType
+
+import constants as c
+from utilities import ps_quote
+
+# The compiled form of one option of a task, built once from CHOICES_TASKS and never changed
+TaskCommand = collections.namedtuple(
+    "TaskCommand",
+    [
+        "task", "option", "command_type_raw", "command", "parameters", "properties", "filter_list",
+        "transfer", "reboots", "read_only", "cacheable"
+    ]
+)
+Parameter = collections.namedtuple("Parameter", ["name", "type", "required"])
+
+_CATALOG = None
+_CATALOG_LOCK = threading.Lock()
+
+# Characters cmd.exe would treat as something other than part of a value
+_CMD_UNSAFE = set('"%^&|<>!\r\n')
+
+def _freeze(value):
+    """Read-only copy of a catalog value"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+
+    return value
+
+def _compile(task, option, option_dict):
+    """Compile one option of a task"""
+    parameters = tuple(
+        Parameter(name, props.get("type", str), props.get("required", False))
+        for name, props in option_dict.get("option_list", {}).items()
+    ) if option_dict.get("has_options", False) else ()
+
+    return TaskCommand(
+        task=task,
+        option=option,
+        command_type_raw=option_dict["command_type_raw"],
+        command=option_dict["command"],
+        parameters=parameters,
+        properties=_freeze(option_dict.get("properties", None)),
+        filter_list=_freeze(option_dict.get("filter_list", {})),
+        transfer=option_dict.get("transfer", None),
+        reboots=option_dict.get("reboots", False),
+        read_only=option_dict.get("read_only", False),
+        # Only a command that leaves the host as it was can have its results reused
+        cacheable=option_dict.get("read_only", False) and option_dict.get("cacheable", False)
+    )
+
+def get_catalog():
+    """The compiled task catalog, built on first use - {task: {option: TaskCommand}}"""
+    global _CATALOG
+
+    with _CATALOG_LOCK:
+        if _CATALOG is None:
+            _CATALOG = MappingProxyType({
+                task: MappingProxyType({
+                    option: _compile(task, option, option_dict)
+                    for option, option_dict in options.items()
+                })
+                for task, options in c.CHOICES_TASKS.items()
+            })
+
+    return _CATALOG
+
+def is_interactive():
+    """Only prompt for missing parameters when someone is there to answer"""
+    return sys.stdin is not None and sys.stdin.isatty()
+
+def _convert(parameter, value):
+    """Check a value against the parameter type, returns the value or None if invalid"""
+    if parameter.type is bool:
+        if isinstance(value, bool):
+            return value
+
+        text = str(value).strip().lower()
+        return {"true": True, "1": True, "false": False, "0": False}.get(text, None)
+
+    if parameter.type is int:
+        if isinstance(value, bool):
+            return None
+
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    if isinstance(value, (dict, list, tuple)):
+        return None
+
+    return str(value)
+
+def _format_ps(parameter, values):
+    """PowerShell parameter with its value(s) quoted"""
+    if parameter.type is bool:
+        return " %s:$%s" % (parameter.name, str(values[0]).lower())
+
+    if parameter.type is int:
+        return " %s %s" % (parameter.name, ",".join(str(v) for v in values))
+
+    return " %s %s" % (parameter.name, ",".join(ps_quote(v) for v in values))
+
+def _format_cmd(parameter, values):
+    """cmd parameter, values that cmd.exe would interpret are refused"""
+    formatted = []
+
+    for value in values:
+        text = str(value)
+
+        if any(ch in _CMD_UNSAFE for ch in text):
+            return None
+
+        formatted.append('"%s"' % text if " " in text or len(text) == 0 else text)
+
+    return " %s %s" % (parameter.name, " ".join(formatted))
+
+def _get_values(parameter, task_options, interactive):
+    """The value(s) given for a parameter, asking for it if allowed. Returns (values, error)"""
+    value = task_options.get(parameter.name, None)
+
+    if value is None and interactive:
+        value = input("Enter value for %s: " % parameter.name)
+
+        if len(value) == 0:
+            value = None
+
+    if value is None:
+        if parameter.required:
+            return None, "Parameter %s is required, set it with --task-options" % parameter.name
+
+        return [], None
+
+    raw_values = value if isinstance(value, list) else [value]
+    values = [_convert(parameter, v) for v in raw_values]
+
+    if len(values) == 0 or any(v is None for v in values):
+        return None, "Invalid value %s for parameter %s, expected %s" % (
+            value, parameter.name, parameter.type.__name__
+        )
+
+    if parameter.type is bool and len(values) > 1:
+        return None, "Parameter %s takes a single value" % parameter.name
+
+    return values, None
+
+def check_options(task_commands, task_options):
+    """Task options have to be a dictionary, naming parameters of at least one of the commands.
+    Returns an error message, or None if they are fine"""
+    if task_options is None:
+        return None
+
+    if not isinstance(task_options, dict):
+        return "Task options must be a JSON object of parameter: value"
+
+    known = set(p.name for tc in task_commands for p in tc.parameters)
+    unknown = [k for k in task_options if k not in known]
+
+    if len(unknown) > 0:
+        return "Unknown task options %s, the valid options are: %s" % (
+            ", ".join(unknown), ", ".join(sorted(known)) if len(known) > 0 else "none"
+        )
+
+    return None
+
+def bind_values(task_command, task_options=None, interactive=None):
+    """The value of each parameter rather than a command line, for options that are not run as
+    a command (e.g. transfers) - returns ({name: value}, error)"""
+    task_options = task_options or {}
+
+    if interactive is None:
+        interactive = is_interactive()
+
+    bound = {}
+
+    for parameter in task_command.parameters:
+        values, error = _get_values(parameter, task_options, interactive)
+
+        if error is not None:
+            return None, error
+
+        if len(values) > 1:
+            return None, "Parameter %s takes a single value" % parameter.name
+
+        if len(values) == 1:
+            bound[parameter.name] = values[0]
+
+    return bound, None
+
+def bind(task_command, task_options=None, interactive=None):
+    """Bind the task options to the command - returns (command, error)
+
+    Missing required parameters are asked for only when interactive (default: stdin is a TTY),
+    otherwise they are an error straight away"""
+    task_options = task_options or {}
+
+    if interactive is None:
+        interactive = is_interactive()
+
+    command = task_command.command
+
+    for parameter in task_command.parameters:
+        values, error = _get_values(parameter, task_options, interactive)
+
+        if error is not None:
+            return None, error
+
+        if len(values) == 0:
+            continue
+
+        if task_command.command_type_raw:
+            param_string = _format_cmd(parameter, values)
+
+            if param_string is None:
+                return None, "Parameter %s has characters that are not allowed" % parameter.name
+        else:
+            param_string = _format_ps(parameter, values)
+
+        command += param_string
+
+    return command, None
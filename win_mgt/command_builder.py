@@ -1,4 +1,6 @@
 import constants as c
+from utilities import ps_quote
+from catalog import get_catalog, bind, bind_values, check_options
 
 class CommandBuilder:
     def __init__(self, logger, args):
@@ -6,64 +8,242 @@ class CommandBuilder:
         self.args = args
         self.ok = False
 
-    def _get_command_options(self, command_dict):
-        """Get additional options for the command"""
-        input_options = self.args.task_options
+    def _parse_filters(self):
+        """Turn the name=value filter inputs into a dictionary of name: [values]"""
+        filters = {}
+
+        for filter_string in self.args.filters or []:
+            name, sep, value = filter_string.partition(c.FILTER_SEPARATOR)
+            values = [v.strip() for v in value.split(c.FILTER_VALUE_SEPARATOR) if v.strip()]
+
+            if len(sep) == 0 or len(name.strip()) == 0 or len(values) == 0:
+                self.logger.error("Invalid filter %s, the format is name=value", filter_string)
+                return None
+
+            filters.setdefault(name.strip().lower(), []).extend(values)
+
+        return filters
+
+    def _get_filters(self, filter_list):
+        """Build the filtering for the command so it is done on the server
+
+        Returns the extra parameters and the Where-Object conditions, or None if invalid"""
+        filters = self._parse_filters()
+
+        if filters is None:
+            return None
+
         param_string = ""
+        conditions = []
 
-        # set true - set false if we have issues here
-        self.ok = True
+        for name, values in filters.items():
+            filter_def = filter_list.get(name, None)
+
+            if filter_def is None:
+                _msg = ", ".join(filter_list.keys()) if len(filter_list) > 0 else "none"
+                self.logger.error("Invalid filter %s - the valid filters are: %s", name, _msg)
+                return None
 
-        for param, props in command_dict["option_list"].items():
-            param_type = props["type"]
-            param_required = props["required"]
-
-            # Was the param passed as an input
-            input_param = input_options.get(param, None) if input_options else None
-
-            if input_param is None:
-                ask_for = input("Enter value for %s: " % param)
-                if (ask_for is None or len(ask_for) == 0) and param_required:
-                    self.logger.error("Parameter %s is required, unable to continue")
-                    self.ok = False
-                    return None
-                else:
-                    param_string += " %s %s" % (param, ask_for)
+            quoted = [ps_quote(v) for v in values]
+
+            if "parameter" in filter_def:
+                param_string += " %s %s" % (filter_def["parameter"], ",".join(quoted))
             else:
-                param_string += " %s %s" % (param, input_param)
+                conditions.append("(%s)" % " -or ".join(
+                    "$_.%s -like %s" % (filter_def["property"], q) for q in quoted
+                ))
+
+        return param_string, conditions
+
+    def _apply_filters(self, command_dict, filter_list):
+        """Add any filtering and property selection to the command, returns False if invalid"""
+        if not self.args.filters and not self.args.select:
+            return True
+
+        if command_dict["command_type_raw"]:
+            self.logger.error("Filters and property selection are only available for PowerShell")
+            return False
+
+        filters = self._get_filters(filter_list)
+
+        if filters is None:
+            return False
 
-        if len(param_string) > 0:
-            return param_string
-        
-        return None
+        param_string, conditions = filters
+        command_dict["command"] += param_string
 
+        if len(conditions) > 0:
+            command_dict["command"] += " | Where-Object { %s }" % " -and ".join(conditions)
+
+        if self.args.select:
+            command_dict["properties"] = self.args.select
+
+            # JSON output does its own selection
+            if self.args.output != c.OUTPUT_JSON:
+                command_dict["command"] += " | Select-Object -Property %s" % \
+                    ",".join(ps_quote(p) for p in self.args.select)
+
+        return True
+
+    def _get_transfer_command(self, task_command):
+        """A file transfer - the paths are kept as they are, transfer.py does the work"""
+        if self.args.filters or self.args.select:
+            self.logger.error("Filters and property selection are not available for transfers")
+            return None
+
+        values, error = bind_values(task_command, self.args.task_options)
+
+        if error is not None:
+            self.logger.error("%s", error)
+            return None
+
+        transfer = {
+            "direction": task_command.transfer,
+            "source": values[c.TRANSFER_SOURCE],
+            "destination": values[c.TRANSFER_DESTINATION]
+        }
+
+        self.ok = True
+        return {
+            "command_type_raw": False,
+            "command": "%s %s %s" % (transfer["direction"], transfer["source"],
+                                     transfer["destination"]),
+            "has_options": True,
+            "transfer": transfer,
+            "mutates": not task_command.read_only
+        }
+
+    def _get_option_command(self, task_command, filtered=True):
+        """Get the command for one option of the task, filtered unless filtered is False"""
+        self.ok = False
+
+        if task_command.transfer is not None:
+            return self._get_transfer_command(task_command)
+
+        # The catalog is shared and read-only, the bound command is a new string
+        command, error = bind(task_command, self.args.task_options)
+
+        if error is not None:
+            self.logger.error("%s", error)
+            return None
+
+        command_dict = {
+            "command_type_raw": task_command.command_type_raw,
+            "command": command,
+            "has_options": len(task_command.parameters) > 0
+        }
+
+        if task_command.properties is not None:
+            command_dict["properties"] = list(task_command.properties)
+
+        if task_command.reboots:
+            command_dict["reboots"] = True
+
+        if task_command.cacheable:
+            command_dict["cacheable"] = True
+
+        if not task_command.read_only:
+            command_dict["mutates"] = True
+
+        if filtered and not self._apply_filters(command_dict, task_command.filter_list):
+            return None
+
+        self.ok = True
+        return command_dict
+
+    def _get_task_commands(self, task_commands, options):
+        """Look up each option of the task, None if any is invalid"""
+        selected = []
+
+        for option in options:
+            # Example - task is "services", option is "list" or "restart"
+            task_command = task_commands.get(option, None)
+
+            if task_command is None:
+                _msg = "\n"
+                for k in task_commands:
+                    _msg += "  %s\n" % k
+
+                self.logger.error("Invalid task option - the valid options are: %s", _msg)
+                return None
+
+            selected.append(task_command)
+
+        error = check_options(selected, self.args.task_options)
+
+        if error is not None:
+            self.logger.error("%s", error)
+            return None
+
+        return selected
 
     def get_command(self):
         """Figure out the command to use based on the choice made"""
-        task_dict = c.CHOICES_TASKS.get(self.args.task, None)
+        task_commands = get_catalog().get(self.args.task, None)
         self.ok = False
 
-        if task_dict is None:
-            c.logger.error("Invalid task selected")
+        if task_commands is None:
+            self.logger.error("Invalid task selected")
+            return None
+
+        # Several options can be given (e.g. "restart,list") to run them as one batch
+        options = [o.strip() for o in self.args.option.split(c.BATCH_SEPARATOR) if o.strip()]
+        selected = self._get_task_commands(task_commands, options)
+
+        if selected is None or len(selected) == 0:
+            return None
+
+        if len(selected) == 1:
+            return self._get_option_command(selected[0])
+
+        if any(tc.transfer is not None for tc in selected):
+            self.logger.error("File transfers cannot be run as part of a batch")
+            return None
+
+        # In a batch the filters and selection only go to the options that can be filtered
+        filtered = [tc.option for tc in selected if len(tc.filter_list) > 0]
+
+        if (self.args.filters or self.args.select) and len(filtered) == 0:
+            self.logger.error(
+                "Filters and property selection are not available for any of the options %s",
+                ", ".join(options)
+            )
             return None
-        
-        # Example - task is "services", option is "list" or "restart"
-        command_dict = task_dict.get(self.args.option, None)
 
-        if command_dict is None:
-            _msg = "\n"
-            for k in task_dict:
-                _msg += "  %s\n" % k
+        command_dicts = []
+
+        for task_command in selected:
+            command_dict = self._get_option_command(task_command,
+                                                    task_command.option in filtered)
+
+            if command_dict is None or not self.ok:
+                return None
 
-            self.logger.error("Invalid task option - the valid options are: %s", _msg)
+            command_dicts.append(command_dict)
+
+        if len(set(cd["command_type_raw"] for cd in command_dicts)) > 1:
+            self.logger.error(
+                "Options %s mix PowerShell and non-PowerShell commands, they cannot be run "
+                "as one batch", ", ".join(options)
+            )
+            self.ok = False
             return None
-        
-        if command_dict["has_options"]:
-            param_string = self._get_command_options(command_dict)
 
-            if param_string is not None and len(param_string) > 0:
-                command_dict["command"] += param_string
-        else:
-            self.ok = True
+        commands = [cd["command"] for cd in command_dicts]
+        batch_dict = {
+            "command_type_raw": command_dicts[0]["command_type_raw"],
+            "command": "; ".join(commands),
+            "has_options": any(cd["has_options"] for cd in command_dicts),
+            "commands": commands
+        }
+
+        if any(cd.get("reboots", False) for cd in command_dicts):
+            batch_dict["reboots"] = True
+
+        if all(cd.get("cacheable", False) for cd in command_dicts):
+            batch_dict["cacheable"] = True
+
+        if any(cd.get("mutates", False) for cd in command_dicts):
+            batch_dict["mutates"] = True
 
-        return command_dict        
\ No newline at end of file
+        return batch_dict
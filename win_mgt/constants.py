@@ -1,17 +1,32 @@
 
 CHOICES_TASKS = {
     "shutdown": {
+        # With --max-unavailable a fleet is restarted in waves, see rolling.py
         "restart-now": {
             "command_type_raw": True,
             "command": "shutdown -r -t 0 -f",
-            "has_options": False
+            "has_options": False,
+            "reboots": True
         }
     },
     "services": {
+        # read_only options don't change the host, and the results of cacheable ones can be
+        # kept in the result cache (see result_cache.py). Options that aren't read_only drop
+        # the cached results of the host they run on
         "list": {
             "command_type_raw": False,
             "command": "Get-Service",
-            "has_options": False        
+            "has_options": False,
+            "read_only": True,
+            "cacheable": True,
+            "properties": ["Name", "DisplayName", "Status", "StartType"],
+            "filter_list": {
+                # Native parameters are applied by Get-Service itself, properties by Where-Object
+                "name": {"parameter": "-Name"},
+                "displayname": {"parameter": "-DisplayName"},
+                "status": {"property": "Status"},
+                "starttype": {"property": "StartType"}
+            }
         },
         "restart": {
             "command_type_raw": False,
@@ -25,7 +40,42 @@ CHOICES_TASKS = {
             }
         }
     },
-    "filesystem": {}
+    "filesystem": {
+        # Files are copied in chunks by transfer.py rather than by running a command
+        "push": {
+            "command_type_raw": False,
+            "command": "push",
+            "transfer": "push",
+            "has_options": True,
+            "option_list": {
+                "-Source": {
+                    "type": str,
+                    "required": True
+                },
+                "-Destination": {
+                    "type": str,
+                    "required": True
+                }
+            }
+        },
+        "pull": {
+            "command_type_raw": False,
+            "command": "pull",
+            "transfer": "pull",
+            "has_options": True,
+            "read_only": True,
+            "option_list": {
+                "-Source": {
+                    "type": str,
+                    "required": True
+                },
+                "-Destination": {
+                    "type": str,
+                    "required": True
+                }
+            }
+        }
+    }
 }
 
 
@@ -81,7 +131,214 @@ DEFAULT_PYPSRP_ARGS = {
     "negotiate_service": "HTTP" #Override the service part of the calculated SPN used when authenticating the server, default is WSMAN. This is only valid if negotiate auth negotiated Kerberos or kerberos was explicitly set
 }
 
+# Characters PowerShell takes as a single quote - the ASCII one, the curly ones and the low-9 ones
+PS_SINGLE_QUOTES = "'\u2018\u2019\u201a\u201b"
+
+# DNS cache options - seconds to keep resolved and failed lookups
+DNS_POSITIVE_TTL = 300
+DNS_NEGATIVE_TTL = 30
+DNS_RESOLVE_WORKERS = 32
+
+# Port probe options
+DEFAULT_PROBE_TIMEOUT = 2.0
+PROBE_MAX_INFLIGHT = 512
+
+# Largest envelope (in KB) asked for when the server allows bigger ones, WinRM's default is 500.
+# Only cmd shells ask by default: pypsrp's handling of a PowerShell Receive grows faster than its
+# size, so bigger envelopes make PowerShell output slower even though there are fewer round trips
+MAX_ENVELOPE_KB = 1024
+
+# Rolling restart - seconds for a restarted host to stop answering, then in all to come back and
+# accept a session, how often the hosts of a wave are checked, and the command that shows a
+# host is ready
+RESTART_DOWN_TIMEOUT = 180
+DEFAULT_RESTART_TIMEOUT = 900
+RESTART_POLL_INTERVAL = 2.0
+RESTART_READY_COMMAND = "$PSVersionTable.PSVersion.Major"
+# A host can come back between two checks without being seen down, so its boot time is read
+# before the restart and looked at again every RESTART_BOOT_CHECK_INTERVAL seconds while it is up
+RESTART_BOOT_COMMAND = \
+    "(Get-CimInstance Win32_OperatingSystem).LastBootUpTime.ToUniversalTime().ToString('o')"
+RESTART_BOOT_CHECK_INTERVAL = 15.0
+
+# Host profile store - what last worked for each host (and user), so later runs can skip the
+# lookups and probes. Profiles older than PROFILE_MAX_AGE are not used, and the ping is only
+# skipped for hosts that worked in the last PROFILE_SKIP_PING_AGE seconds
+PROFILE_FIELDS = [
+    "server", "username", "auth", "port", "ssl", "encryption", "fqdn", "ip", "rtt",
+    "max_envelope_size", "kinit_cache", "last_success"
+]
+PROFILE_MAX_AGE = 86400
+PROFILE_SKIP_PING_AGE = 900
+# Hosts per SELECT when loading an inventory, and profiles held before they are written
+PROFILE_BATCH = 500
+PROFILE_FLUSH_EVERY = 200
+PROFILE_DB_TIMEOUT = 30
+
+# Digest store - the last output of each command on each host. The host hashes the output and
+# only sends it back if the digest differs from the one kept from the last run
+DIGEST_MARKER = "##WIN_MGT_DIGEST"
+DIGEST_SAME, DIGEST_CHANGED = ("same", "changed")
+DIGEST_BATCH = 500
+DIGEST_FLUSH_EVERY = 100
+DIGEST_DB_TIMEOUT = 30
+DIGEST_DIFF_CONTEXT = 3
+
+# Result cache - results of cacheable (read-only) tasks, shared by every job on the machine.
+# Results are used for DEFAULT_CACHE_TTL seconds, the least recently used are dropped once
+# they come to more than DEFAULT_CACHE_MAX_MB
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_MAX_MB = 64
+CACHE_BATCH = 500
+CACHE_FLUSH_EVERY = 100
+CACHE_DB_TIMEOUT = 30
+
+# Session (RunspacePool and cmd shell reuse) options
+DEFAULT_SESSION_IDLE_TIMEOUT = 300
+DEFAULT_MAX_SESSIONS = 50
+SESSION_POOL, SESSION_SHELL = ("pool", "shell")
+# WSMan fault for a shell the server no longer has (it timed out), and the code page of the
+# output of raw commands
+WINRS_SHELL_NOT_FOUND = 2150858843
+RAW_ENCODING = "437"
+
+# Batch options
+BATCH_SEPARATOR = ","
+BATCH_MARKER = "##WIN_MGT"
+BATCH_BEGIN, BATCH_END, BATCH_ERROR = ("BEGIN", "END", "ERROR")
+
+# Filters are given as name=value, several values separated by FILTER_VALUE_SEPARATOR
+FILTER_SEPARATOR = "="
+FILTER_VALUE_SEPARATOR = ","
+
+# Output formats
+OUTPUT_TEXT, OUTPUT_JSON = ("text", "json")
+CHOICES_OUTPUT = [OUTPUT_TEXT, OUTPUT_JSON]
+DEFAULT_OUTPUT = OUTPUT_TEXT
+
+# Result file formats
+SINK_JSONL, SINK_CSV = ("jsonl", "csv")
+CHOICES_SINK = [SINK_JSONL, SINK_CSV]
+SINK_FIELDS = ["host", "status", "start", "duration", "rtt", "stdout", "stderr"]
+# Written to JSONL as well when the digest store is used
+SINK_DIGEST_FIELDS = ["changed", "diff"]
+# Written to JSONL as well for results taken from the result cache
+SINK_CACHE_FIELDS = ["cached", "cached_age"]
+SINK_BUFFER_SIZE = 65536
+
+# Stages timed for each host, in the order they happen. Client (raw) connections only really
+# connect when the command runs, so for those the connection time is part of run
+STAGE_PREPARE, STAGE_RESOLVE, STAGE_PING = ("prepare", "resolve", "ping")
+STAGE_KERBEROS, STAGE_CONNECT, STAGE_RUN, STAGE_READ = ("kerberos", "connect", "run", "read")
+# A rolling restart adds the time for the host to go down, answer on the port again and then
+# accept a session
+STAGE_DOWN, STAGE_BACK, STAGE_READY = ("down", "back", "ready")
+STAGES = [
+    STAGE_PREPARE, STAGE_RESOLVE, STAGE_PING, STAGE_KERBEROS, STAGE_CONNECT, STAGE_RUN,
+    STAGE_READ, STAGE_DOWN, STAGE_BACK, STAGE_READY
+]
+
+# Metrics report formats
+METRICS_JSON, METRICS_PROMETHEUS = ("json", "prometheus")
+CHOICES_METRICS = [METRICS_JSON, METRICS_PROMETHEUS]
+METRICS_PROMETHEUS_EXTENSION = ".prom"
+METRICS_PERCENTILES = [50, 95, 99]
+METRICS_PREFIX = "win_mgt"
+
+# File transfer options. Chunks are sent on several runspaces at once, the chunk size starts at
+# DEFAULT_TRANSFER_CHUNK_KB and is doubled while the throughput keeps improving
+TRANSFER_PUSH, TRANSFER_PULL = ("push", "pull")
+TRANSFER_SOURCE, TRANSFER_DESTINATION = ("-Source", "-Destination")
+DEFAULT_TRANSFER_STREAMS = 4
+MAX_TRANSFER_STREAMS = 16
+DEFAULT_TRANSFER_CHUNK_KB = 1024
+TRANSFER_CHUNK_MIN = 262144
+TRANSFER_CHUNK_MAX = 8388608
+# A new size has to be this much faster to count as better, and a drop of TRANSFER_TUNE_RESET
+# after settling starts the search again
+TRANSFER_TUNE_MARGIN = 0.05
+TRANSFER_TUNE_RESET = 0.3
+TRANSFER_CHUNK_RETRIES = 3
+# Partly copied files are written next to the destination with this suffix, and progress is
+# kept in TRANSFER_STATE_DIR so an interrupted transfer can carry on where it stopped
+TRANSFER_PART_SUFFIX = ".win_mgt.part"
+TRANSFER_STATE_DIR = "~/.win_mgt/transfers"
+TRANSFER_JOURNAL_EVERY = 16
+
+# Kinds of item passed on when streaming output
+STREAM_OUTPUT, STREAM_ERROR = ("output", "error")
+
+# Fleet options
+INVENTORY_PREFIX = "@"
+INVENTORY_COMMENT = "#"
+DEFAULT_CONCURRENCY = 10
+MAX_CONCURRENCY = 200
+# Multiplexed runs (see multiplex.py) - hosts in flight are not threads, so the limit is higher.
+# The I/O is still blocking calls on a pool of io threads, so a poll only asks the host for what
+# it already has (waiting at most MULTIPLEX_POLL_TIMEOUT seconds) and the waiting is done by the
+# loop's schedule: hosts with nothing to give are polled less often, up to every
+# MULTIPLEX_IDLE_MAX seconds. Each thread manages about 1 / (round trip + MULTIPLEX_POLL_TIMEOUT)
+# polls a second, so size --io-threads to the polls the hosts in flight need
+MAX_MULTIPLEX_HOSTS = 5000
+DEFAULT_IO_THREADS = 16
+MAX_IO_THREADS = 128
+MULTIPLEX_POLL_TIMEOUT = 0.05
+MULTIPLEX_IDLE_START = 0.25
+MULTIPLEX_IDLE_MAX = 2.0
+
+# Retries, circuit breaker and adaptive concurrency for fleets. Only failures to connect are
+# retried, a command that may have started is never run a second time
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 1.0
+RETRY_BACKOFF_MAX = 30.0
+# Failed attempts in a row that open the breaker for a host, and the seconds it stays open
+# before one attempt is let through to see if the host has recovered
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 300
+# The concurrency limit grows by one for each limit's worth of good attempts, and is cut by
+# AIMD_DECREASE when connections fail or take AIMD_LATENCY_FACTOR times longer than the best
+# seen (which creeps up by AIMD_BASELINE_DRIFT each attempt, so a slower network is accepted)
+AIMD_DECREASE = 0.5
+AIMD_LATENCY_FACTOR = 2.0
+AIMD_BASELINE_DRIFT = 0.01
+AIMD_EWMA_WEIGHT = 0.2
+
+# Hosts can be split across worker processes, which send back these messages
+MAX_PROCESSES = 64
+SHARD_RESULT, SHARD_DONE = ("result", "done")
+
+HOST_SUCCESS, HOST_FAILED, HOST_UNREACHABLE = ("success", "failed", "unreachable")
+CHOICES_HOST_STATUS = [HOST_SUCCESS, HOST_FAILED, HOST_UNREACHABLE]
+
+# Agent (daemon) options. Requests carry these inputs, the credentials and connection settings
+# are those the agent was started with
+AGENT_REQUEST_FIELDS = [
+    "server", "task", "option", "task_options", "filters", "select", "output", "stream",
+    "max_unavailable", "restart_timeout", "cache_bypass"
+]
+# Kinds of message sent back by the agent, one JSON object per line
+AGENT_OUTPUT, AGENT_ERROR, AGENT_OBJECT = ("output", "error", "object")
+AGENT_RESULT, AGENT_LOG, AGENT_DONE = ("result", "log", "done")
+DEFAULT_AGENT_SOCKET = "~/.win_mgt_agent.sock"
+AGENT_HOUSEKEEPING_INTERVAL = 60
+AGENT_MAX_REQUEST = 1048576
+
 # Kerberos constants
 KRB_KINIT_OK = 0
 KRB_RETRY_CACHE = 1
 KRB_FAIL = 2
+
+# A ticket with less than this many seconds left is renewed rather than reused
+DEFAULT_KRB_RENEW_BEFORE = 600
+# If the expiry can't be read from klist, assume the ticket lasts this long
+KRB_ASSUMED_LIFETIME = 3600
+KRB_TGT_PREFIX = "krbtgt/"
+# klist date formats - MIT (depends on locale), ISO and Heimdal
+KRB_KLIST_DATE_FORMATS = [
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%y %H:%M:%S",
+    "%d/%m/%Y %H:%M:%S",
+    "%d/%m/%y %H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%b %d %H:%M:%S %Y"
+]
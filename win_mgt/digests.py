@@ -0,0 +1,159 @@
+import time
+import uuid
+import difflib
+import sqlite3
+
+import constants as c
+from utilities import ps_quote
+from sqlite_store import SqliteStore, get_store
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS digests (
+    server TEXT NOT NULL,
+    username TEXT NOT NULL,
+    command TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    output TEXT NOT NULL,
+    saved REAL NOT NULL,
+    PRIMARY KEY (server, username, command)
+)
+"""
+
+def get_digest_store(logger, args=None):
+    """Return the digest store shared by every transport in this process, None unless
+    --digest-store was given"""
+    return get_store(logger, DigestStore, getattr(args, "digest_store", None))
+
+def use_digest(command_detail):
+    """Only read-only commands whose output can be cached are hashed on the host, the script
+    must not get in the way of anything that changes the host"""
+    return command_detail.get("cacheable", False) and not command_detail.get("mutates", False) \
+        and not command_detail["command_type_raw"] and "commands" not in command_detail
+
+def new_marker():
+    """A marker that will not appear in the output of the command itself"""
+    return "%s-%s##" % (c.DIGEST_MARKER, uuid.uuid4().hex)
+
+def build_script(command, known_digest, marker):
+    """Build a script that hashes the output of the command on the host. The output only comes
+    back if its digest is not known_digest, after a marker line with the digest"""
+    return "\n".join([
+        "$output = @(Invoke-Expression -Command %s | Out-String -Stream)" % ps_quote(command),
+        "$bytes = [System.Text.Encoding]::UTF8.GetBytes($output -join \"`n\")",
+        "$sha = [System.Security.Cryptography.SHA256]::Create()",
+        "$digest = [System.BitConverter]::ToString($sha.ComputeHash($bytes)) -replace '-', ''",
+        "if ($digest -eq %s) { Write-Output (%s + $digest) }" % (
+            ps_quote(known_digest or ""), ps_quote("%s %s " % (marker, c.DIGEST_SAME))
+        ),
+        "else { Write-Output (%s + $digest); $output }" % ps_quote(
+            "%s %s " % (marker, c.DIGEST_CHANGED)
+        )
+    ])
+
+def split_output(output, marker):
+    """Take the marker line off the output, returns (digest, changed, output). The digest is
+    None if the script stopped before it got that far"""
+    if not output.startswith(marker):
+        return None, True, output
+
+    line, _sep, output = output.partition("\n")
+    parts = line[len(marker):].split()
+
+    if len(parts) != 2:
+        return None, True, output
+
+    return parts[1], parts[0] != c.DIGEST_SAME, output
+
+def diff_output(previous, current):
+    """Unified diff of the output of the last run and this one"""
+    return "\n".join(difflib.unified_diff(
+        previous.splitlines(), current.splitlines(), "previous", "current", lineterm="",
+        n=c.DIGEST_DIFF_CONTEXT
+    ))
+
+
+class DigestStore(SqliteStore):
+    """The digest and output of the last run of each command on each host (and user), so a
+    host only has to send its output when it has changed. Digests are read in bulk for an
+    inventory, the output is only read back when a diff is needed"""
+
+    NAME = "digest store"
+    SCHEMA = [_CREATE_TABLE]
+    DB_TIMEOUT = c.DIGEST_DB_TIMEOUT
+
+    def __init__(self, logger, path):
+        super().__init__(logger, path)
+        # (server, username, command): (digest, saved), or None if there isn't one
+        self.digests = {}
+        # pending is (server, username, command): (digest, output, saved) to write
+
+    def load(self, servers, username, command):
+        """Read the digests of a whole inventory in one go, returns how many were found"""
+        with self.lock:
+            wanted = [
+                s for s in dict.fromkeys(servers) if (s, username, command) not in self.pending
+            ]
+            rows = self._select_servers(
+                "SELECT server, digest, saved FROM digests WHERE username = ? AND command = ? "
+                "AND server IN (%s)", [username, command], wanted, c.DIGEST_BATCH
+            )
+            found = {server: (digest, saved) for server, digest, saved in rows}
+
+            for server in wanted:
+                self.digests[(server, username, command)] = found.get(server, None)
+
+        self.logger.debug(
+            "digests.load: %s of %s hosts have a digest", len(found), len(wanted)
+        )
+        return len(found)
+
+    def get(self, server, username, command):
+        """(digest, saved) of the last output of the command, None if there isn't one"""
+        key = (server, username, command)
+
+        if key not in self.digests:
+            self.load([server], username, command)
+
+        with self.lock:
+            return self.digests.get(key, None)
+
+    def get_output(self, server, username, command):
+        """The output of the last run of the command, None if there isn't one"""
+        key = (server, username, command)
+
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key][1]
+
+            try:
+                row = self.db.execute(
+                    "SELECT output FROM digests WHERE server = ? AND username = ? AND "
+                    "command = ?", list(key)
+                ).fetchone()
+            except sqlite3.Error as e:
+                self.logger.warning("Unable to read the digest store: %s", str(e))
+                return None
+
+        return row[0] if row is not None else None
+
+    def put(self, server, username, command, digest, output):
+        """Record the output of a run that has changed"""
+        key = (server, username, command)
+        saved = time.time()
+
+        with self.lock:
+            self.digests[key] = (digest, saved)
+            self.pending[key] = (digest, output, saved)
+            flush = len(self.pending) >= c.DIGEST_FLUSH_EVERY
+
+        if flush:
+            self.flush()
+
+    def _write(self, pending):
+        """Write the new output"""
+        self.db.executemany(
+            "INSERT OR REPLACE INTO digests (server, username, command, digest, output, saved) "
+            "VALUES (?, ?, ?, ?, ?, ?)", [list(key) + list(entry) for key, entry in pending.items()]
+        )
+
+        return "Wrote the output of %s hosts" % len(pending)
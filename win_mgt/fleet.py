@@ -0,0 +1,542 @@
+import copy
+import json
+import time
+import heapq
+import queue
+import logging
+import logging.handlers
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import constants as c
+from utilities import pad_string
+from transport_pypsrp import Transport
+from network import Network, known_host
+from timing import StageTimer, build_report
+from session import get_session_manager
+from profiles import get_profile_store, is_fresh
+from digests import get_digest_store, use_digest
+from result_cache import get_result_cache, cache_key
+from sqlite_store import flush_stores
+from scheduler import Scheduler, CircuitBreaker
+from multiplex import Multiplexer, can_multiplex
+
+def set_host_result(host):
+    """Use a dictionary for the result of one host"""
+    return {
+        "host": host,
+        "status": c.HOST_FAILED,
+        "stdout": "",
+        "stderr": "",
+        "start": 0.0,
+        "duration": 0.0,
+        "rtt": None,
+        "attempts": 1,
+        "retryable": False,
+        "changed": None,
+        "diff": "",
+        "timings": {}
+    }
+
+def run_host(logger, args, password, command_detail, host, rtt=None):
+    """Run the command against a single host of the fleet, rtt is from the fleet's ping"""
+    host_result = set_host_result(host)
+    host_result["start"] = time.time()
+    _start = time.monotonic()
+
+    transport = Transport(logger, args, password, server=host)
+    transport.rtt = rtt
+
+    try:
+        transport.connect(command_detail["command_type_raw"])
+
+        if not transport.connected:
+            host_result["status"] = c.HOST_UNREACHABLE if transport.unreachable else \
+                c.HOST_FAILED
+            host_result["stderr"] = "Connection failed"
+            host_result["retryable"] = transport.retryable
+            return host_result
+
+        is_structured = args.output == c.OUTPUT_JSON and "commands" not in command_detail \
+            and "transfer" not in command_detail
+
+        if "transfer" in command_detail:
+            run_ok = transport.run_transfer(command_detail["transfer"])
+        elif is_structured:
+            properties = command_detail.get("properties", None)
+            run_ok = transport.run_structured(command_detail["command"], properties)
+        elif "commands" in command_detail:
+            run_ok = transport.run_commands(command_detail["commands"])
+        else:
+            run_ok = transport.run_command(command_detail["command"], use_digest(command_detail))
+
+        # Client connections only really connect when the command is run
+        if not transport.connected:
+            host_result["stderr"] = "Connection failed"
+            host_result["retryable"] = transport.retryable
+            return host_result
+
+        if is_structured:
+            transport.result_dict["stdout"] = "\n".join(
+                json.dumps(obj) for obj in transport.result_dict["objects"]
+            )
+        elif run_ok and "transfer" not in command_detail:
+            run_ok = transport.get_results()
+
+        host_result["stdout"] = transport.result_dict["stdout"]
+        host_result["stderr"] = str(transport.result_dict["stderr"])
+        host_result["changed"] = transport.result_dict["changed"]
+        host_result["diff"] = transport.result_dict["diff"]
+        host_result["status"] = c.HOST_SUCCESS if run_ok else c.HOST_FAILED
+    except Exception as e:
+        host_result["stderr"] = "Error %s: %s" % (type(e), str(e))
+    finally:
+        # The host is done with, so only the agent (keep_sessions) holds on to its session
+        transport.disconnect(close=not getattr(args, "keep_sessions", False))
+        host_result["duration"] = time.monotonic() - _start
+        host_result["timings"] = dict(transport.timer.timings)
+
+    return host_result
+
+def run_shard(index, args, password, hosts, command_detail, results_queue, log_level,
+              probes=None):
+    """Worker process - runs its share of the fleet on its own thread pool. Log records and
+    host results go back to the parent on results_queue"""
+    logger = logging.Logger("%s.shard%s" % (__name__, index))
+    logger.level = log_level
+    logger.addHandler(logging.handlers.QueueHandler(results_queue))
+
+    try:
+        fleet = Fleet(logger, args, password, hosts, QueueSink(results_queue))
+        fleet.probes = probes or {}
+        fleet.run(command_detail)
+    except Exception as e:
+        logger.error("fleet.run_shard: Error %s in worker %s: %s", type(e), index, str(e))
+    finally:
+        # Worker processes skip atexit, so close the sessions and write the stores here
+        get_session_manager(logger).close_all()
+        flush_stores()
+        results_queue.put((c.SHARD_DONE, index))
+
+
+class QueueSink:
+    """Stands in for the results sink in a worker process, results go back to the parent"""
+
+    def __init__(self, results_queue):
+        self.results_queue = results_queue
+
+    def write(self, host_result):
+        """Hand the result of one host to the parent"""
+        self.results_queue.put((c.SHARD_RESULT, host_result))
+
+
+class Fleet:
+    def __init__(self, logger, args, password, hosts, sink=None):
+        self.logger = logger
+        self.sink = sink
+        self.args = args
+        self.password = password
+        self.hosts = hosts
+        self.results = {}
+        self.counts = dict.fromkeys(c.CHOICES_HOST_STATUS, 0)
+        self.multiplex = getattr(args, "multiplex", False)
+        self.concurrency = self._set_concurrency(args.concurrency)
+        self.processes = self._set_processes(getattr(args, "processes", 1))
+        # Hosts are pinged together before the run, so each transport doesn't need to
+        self.host_args = copy.copy(args)
+        self.host_args.ping = False
+        self.probes = {}
+        self.profiles = get_profile_store(logger, args)
+        self.digests = get_digest_store(logger, args)
+        # Hosts whose output was the same as on the last run
+        self.unchanged = 0
+        self.cache = get_result_cache(logger, args)
+        # What results are cached under for this command, and whether it changes the hosts
+        self.cache_key = None
+        self.mutates = False
+        self.cached = 0
+        # host: profile, for hosts that worked recently with the same settings
+        self.known = {}
+        self.retried = 0
+        # Hosts that keep failing to connect are left alone for the rest of the run
+        self.breaker = CircuitBreaker(c.BREAKER_THRESHOLD, c.BREAKER_COOLDOWN)
+        # Work done once for the whole fleet rather than per host
+        self.timer = StageTimer()
+
+    def _set_concurrency(self, concurrency):
+        """Keep the number of workers within sensible limits"""
+        if concurrency is None or concurrency < 1:
+            concurrency = c.DEFAULT_CONCURRENCY
+
+        # Multiplexed hosts don't each need a thread
+        maximum = c.MAX_MULTIPLEX_HOSTS if self.multiplex else c.MAX_CONCURRENCY
+
+        return max(1, min(concurrency, maximum, len(self.hosts)))
+
+    def _set_processes(self, processes):
+        """Number of worker processes, never more than there are hosts"""
+        if processes is None or processes < 1:
+            return 1
+
+        return max(1, min(processes, c.MAX_PROCESSES, len(self.hosts)))
+
+    def _get_port(self):
+        """The port the transports will connect on"""
+        if self.args.port is not None:
+            return self.args.port
+
+        return c.DEFAULT_PORTS[self.args.protocol]
+
+    def _known_hosts(self, hosts):
+        """Read the profiles of the whole inventory, returns host_info for the hosts with a
+        recent one so they needn't be resolved again"""
+        if self.profiles is None:
+            return {}
+
+        self.profiles.load(hosts, self.args.username)
+        port = self._get_port()
+        known_hosts = {}
+
+        for host in hosts:
+            profile = self.profiles.get(host, self.args.username)
+
+            if profile is not None and profile["ip"] and profile["port"] == port:
+                self.known[host] = profile
+                known_hosts[host] = known_host(host, profile["fqdn"], profile["ip"])
+
+        return known_hosts
+
+    def _preflight(self, resolved, hosts):
+        """Ping every host at once, returns the hosts worth connecting to. Hosts that answered
+        a short while ago are not pinged again"""
+        port = self._get_port()
+        _start = time.time()
+        recent = {
+            host: {"reachable": True, "port": port, "rtt": profile["rtt"]}
+            for host, profile in self.known.items()
+            if is_fresh(profile, c.PROFILE_SKIP_PING_AGE)
+        }
+        to_probe = {host: info for host, info in resolved.items() if host not in recent}
+        self.probes = Network(self.logger).probe_many(to_probe, [port], self.args.probe_timeout)
+        self.probes.update(recent)
+        live_hosts = []
+
+        for host in hosts:
+            if self.probes[host]["reachable"]:
+                live_hosts.append(host)
+            else:
+                host_result = set_host_result(host)
+                host_result["status"] = c.HOST_UNREACHABLE
+                host_result["start"] = _start
+                host_result["stderr"] = "No response on port %s" % port
+                self._host_done(host_result)
+
+        return live_hosts
+
+    def _record(self, host_result):
+        """Write out the result of a host, keeping only what the summary needs"""
+        if self.sink is not None:
+            self.sink.write(host_result)
+
+        # Only keep what the summary and metrics need, the output has been handed over
+        self.results[host_result["host"]] = {
+            k: host_result[k] for k in ("host", "status", "duration", "rtt", "timings")
+        }
+        self.counts[host_result["status"]] += 1
+        self.retried += host_result.get("attempts", 1) - 1
+        self._cache_result(host_result)
+
+        if host_result.get("changed", None) is False:
+            self.unchanged += 1
+
+    def _host_done(self, host_result):
+        """Record the result of a host as soon as it completes"""
+        self._record(host_result)
+
+        if host_result["status"] == c.HOST_SUCCESS:
+            self.logger.info(
+                "[%s] completed in %.2f seconds", host_result["host"], host_result["duration"]
+            )
+        else:
+            self.logger.warning(
+                "[%s] %s: %s", host_result["host"], host_result["status"], host_result["stderr"]
+            )
+
+    def _cache_result(self, host_result):
+        """Keep a new result of a cacheable command, or drop the cached results of a host the
+        command may have changed"""
+        if self.cache is None:
+            return
+
+        if self.mutates:
+            self.cache.invalidate(host_result["host"])
+        elif host_result.get("cached", False):
+            self.cached += 1
+        elif self.cache_key is not None and host_result["status"] == c.HOST_SUCCESS:
+            self.cache.put(host_result["host"], self.args.username, self.cache_key, host_result)
+
+    def _use_cache(self, command_detail):
+        """Work out how the command's results are cached"""
+        self.mutates = command_detail.get("mutates", False)
+
+        if self.cache is not None:
+            self.cache_key = cache_key(self.args, command_detail)
+
+    def _from_cache(self):
+        """Hosts with a recent enough cached result are done without connecting to them,
+        returns the others"""
+        if self.cache_key is None or self.args.cache_bypass:
+            return self.hosts
+
+        cached = self.cache.load(self.hosts, self.args.username, self.cache_key)
+        now = time.time()
+
+        for host, result in cached.items():
+            host_result = set_host_result(host)
+            host_result.update(
+                status=result["status"], stdout=result["stdout"], stderr=result["stderr"],
+                start=now, cached=True, cached_age=now - result["saved"]
+            )
+            self._host_done(host_result)
+
+        return [host for host in self.hosts if host not in cached]
+
+    def _live_hosts(self, hosts=None):
+        """Resolve the whole inventory up front, each host then finds its entry in the cache.
+        Hosts with a profile were resolved on an earlier run. Dead hosts are dropped before any
+        authentication work is done"""
+        hosts = self.hosts if hosts is None else hosts
+
+        with self.timer.stage(c.STAGE_RESOLVE):
+            resolved = self._known_hosts(hosts)
+            resolved.update(Network(self.logger).resolve_many(
+                [host for host in hosts if host not in resolved]
+            ))
+
+        if not self.args.ping:
+            return hosts
+
+        with self.timer.stage(c.STAGE_PING):
+            return self._preflight(resolved, hosts)
+
+    def run(self, command_detail):
+        """Run the command against every host, at most concurrency hosts at a time"""
+        self.logger.info(
+            "Running against %s hosts with a concurrency of %s", len(self.hosts), self.concurrency
+        )
+
+        self._use_cache(command_detail)
+        live_hosts = self._live_hosts(self._from_cache())
+
+        if self.digests is not None and use_digest(command_detail):
+            self.digests.load(live_hosts, self.args.username, command_detail["command"])
+
+        if self.processes > 1:
+            self._run_sharded(live_hosts, command_detail)
+        elif self.multiplex and can_multiplex(self.args, command_detail):
+            self._run_multiplexed(live_hosts, command_detail)
+        else:
+            self._run_threads(live_hosts, command_detail)
+
+        flush_stores()
+
+        return self.counts[c.HOST_SUCCESS] == len(self.hosts)
+
+    def _run_threads(self, live_hosts, command_detail):
+        """Run the hosts on a thread pool in this process. Hosts that could not be connected to
+        are tried again after a backoff, and no more than the scheduler's limit run at once"""
+        scheduler = Scheduler(self.logger, self.host_args, self.concurrency, self.breaker)
+        # (when, order, host, attempt) - hosts waiting to be tried, soonest first
+        waiting = [(0.0, i, host, 1) for i, host in enumerate(live_hosts)]
+        order = len(waiting)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while len(waiting) > 0 or len(running) > 0:
+                now = time.monotonic()
+
+                while len(waiting) > 0 and waiting[0][0] <= now and \
+                        len(running) < scheduler.limit.current:
+                    _when, _order, host, attempt = heapq.heappop(waiting)
+                    reason = scheduler.allow(host)
+
+                    if reason is not None:
+                        host_result = set_host_result(host)
+                        host_result["start"] = time.time()
+                        host_result["attempts"] = attempt
+                        host_result["stderr"] = reason
+                        self._host_done(host_result)
+                        continue
+
+                    future = executor.submit(
+                        run_host, self.logger, self.host_args, self.password, command_detail,
+                        host, self.probes.get(host, {}).get("rtt", None)
+                    )
+                    running[future] = (host, attempt)
+
+                # Wake up for the next retry that is due, if there is room to start it
+                timeout = None
+                if len(waiting) > 0 and len(running) < scheduler.limit.current:
+                    timeout = max(0.0, waiting[0][0] - now)
+
+                if len(running) == 0:
+                    time.sleep(timeout or 0.0)
+                    continue
+
+                done, _pending = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    host, attempt = running.pop(future)
+
+                    try:
+                        host_result = future.result()
+                    except Exception as e:
+                        host_result = set_host_result(host)
+                        host_result["stderr"] = "Error %s: %s" % (type(e), str(e))
+
+                    host_result["attempts"] = attempt
+                    delay = scheduler.done(host_result, attempt)
+
+                    if delay is not None:
+                        self.logger.warning(
+                            "[%s] attempt %s failed, retrying in %.1f seconds: %s",
+                            host, attempt, delay, host_result["stderr"]
+                        )
+                        heapq.heappush(waiting, (time.monotonic() + delay, order, host,
+                                                 attempt + 1))
+                        order += 1
+                        continue
+
+                    host_result["rtt"] = self.probes.get(host, {}).get("rtt", None)
+                    self._host_done(host_result)
+
+    def _run_multiplexed(self, live_hosts, command_detail):
+        """Run the hosts from one event loop, see multiplex.py"""
+        io_threads = getattr(self.args, "io_threads", c.DEFAULT_IO_THREADS)
+        io_threads = max(1, min(io_threads or c.DEFAULT_IO_THREADS, c.MAX_IO_THREADS,
+                                self.concurrency))
+        self.logger.debug(
+            "fleet._run_multiplexed: Up to %s hosts in flight on %s I/O threads",
+            self.concurrency, io_threads
+        )
+
+        Multiplexer(self.logger, self.host_args, self.password, io_threads).run(
+            live_hosts, command_detail,
+            Scheduler(self.logger, self.host_args, self.concurrency, self.breaker),
+            set_host_result, self._host_done, self.probes
+        )
+
+    def _run_sharded(self, live_hosts, command_detail):
+        """Split the hosts across worker processes, each with its own thread pool. Message
+        encryption is CPU bound, so this gets past the GIL on encrypted fleets"""
+        # Get any Kerberos ticket once here, the workers inherit KRB5CCNAME and reuse it
+        if not Transport(self.logger, self.host_args, self.password).prepare_credentials():
+            self.logger.warning(
+                "fleet._run_sharded: Unable to get a ticket before starting the workers"
+            )
+
+        shards = [live_hosts[i::self.processes] for i in range(self.processes)]
+        shards = [shard for shard in shards if len(shard) > 0]
+        shard_args = copy.copy(self.host_args)
+        shard_args.processes = 1
+        # Results come back here, so only this process reads and writes the result cache
+        shard_args.result_cache = None
+        shard_args.concurrency = max(1, self.concurrency // len(shards))
+
+        self.logger.info(
+            "Splitting %s hosts across %s processes, each with a concurrency of %s",
+            len(live_hosts), len(shards), shard_args.concurrency
+        )
+
+        # spawn rather than fork, forking a process that has threads running is not safe. The
+        # password goes to the workers over a pipe, it is not put on the command line
+        context = multiprocessing.get_context("spawn")
+        results_queue = context.Queue()
+        workers = []
+
+        for index, shard in enumerate(shards):
+            worker = context.Process(
+                target=run_shard, daemon=True,
+                args=(index, shard_args, self.password, shard, command_detail, results_queue,
+                      self.logger.level, {host: self.probes[host] for host in shard
+                                          if host in self.probes})
+            )
+            worker.start()
+            workers.append(worker)
+
+        pending = set(range(len(workers)))
+
+        try:
+            while len(pending) > 0:
+                try:
+                    item = results_queue.get(timeout=1)
+                except queue.Empty:
+                    self._check_workers(workers, shards, pending)
+                    continue
+
+                if isinstance(item, logging.LogRecord):
+                    self.logger.handle(item)
+                elif item[0] == c.SHARD_RESULT:
+                    host_result = item[1]
+                    host_result["rtt"] = self.probes.get(host_result["host"], {}).get("rtt", None)
+                    self._record(host_result)
+                elif item[0] == c.SHARD_DONE:
+                    pending.discard(item[1])
+        finally:
+            for worker in workers:
+                if worker.is_alive() and len(pending) > 0:
+                    worker.terminate()
+                worker.join()
+
+    def _check_workers(self, workers, shards, pending):
+        """Hosts of a worker that died without finishing are marked as failed"""
+        for index in list(pending):
+            if workers[index].is_alive():
+                continue
+
+            pending.discard(index)
+            self.logger.error(
+                "fleet._check_workers: Worker %s exited with code %s",
+                index, workers[index].exitcode
+            )
+
+            for host in shards[index]:
+                if host not in self.results:
+                    host_result = set_host_result(host)
+                    host_result["stderr"] = "Worker process exited with code %s" % \
+                        workers[index].exitcode
+                    self._host_done(host_result)
+
+    def metrics_report(self):
+        """Stage timings across the hosts, plus the fleet wide resolve and ping"""
+        report = build_report([r["timings"] for r in self.results.values()], self.counts)
+        report["fleet"] = dict(self.timer.timings)
+
+        return report
+
+    def summary(self):
+        """Show a per host summary plus totals"""
+        _pad_len = max(len(h) for h in self.hosts) + 2
+        _msg = "Fleet summary:\n\n"
+
+        # Keep the order of the inventory rather than the order of completion
+        for host in self.hosts:
+            host_result = self.results.get(host, set_host_result(host))
+            _msg += "  %s: %s (%.2fs)\n" % (
+                pad_string(host, _pad_len), host_result["status"], host_result["duration"]
+            )
+
+        _msg += "\n"
+        for status in c.CHOICES_HOST_STATUS:
+            _msg += "  %s: %s\n" % (pad_string(status, _pad_len), self.counts[status])
+
+        if self.retried > 0:
+            _msg += "  %s: %s\n" % (pad_string("retries", _pad_len), self.retried)
+
+        if self.digests is not None:
+            _msg += "  %s: %s\n" % (pad_string("unchanged", _pad_len), self.unchanged)
+
+        if self.cache is not None:
+            _msg += "  %s: %s\n" % (pad_string("cached", _pad_len), self.cached)
+
+        self.logger.info(_msg)
@@ -1,11 +1,35 @@
 import subprocess
+import threading
+import time
 import sys
 import os
+import re
+from datetime import datetime
 
 import constants as c
 
 IS_PY3 = int(sys.version[0]) > 2
 
+# Tickets obtained or found by this process, shared by every Kerberos instance
+_TICKETS = {}
+_TICKET_LOCKS = {}
+_TICKET_LOCKS_LOCK = threading.Lock()
+
+def _ticket_lock(user_string):
+    """One lock per principal, so only one thread runs kinit for it at a time"""
+    with _TICKET_LOCKS_LOCK:
+        return _TICKET_LOCKS.setdefault(user_string, threading.Lock())
+
+def _parse_date(date_string):
+    """Turn a klist date into seconds since the epoch"""
+    for fmt in c.KRB_KLIST_DATE_FORMATS:
+        try:
+            return time.mktime(datetime.strptime(date_string, fmt).timetuple())
+        except ValueError:
+            continue
+
+    return None
+
 class Kerberos:
     def __init__(self, logger, args):
         self.logger = logger
@@ -13,6 +37,7 @@ class Kerberos:
         self.domain = ""
         self.timeout = args.kinit_timeout
         self.force_cache = args.force_cache
+        self.renew_before = getattr(args, "ticket_renew_before", c.DEFAULT_KRB_RENEW_BEFORE)
         self.cache = ""
 
 
@@ -32,6 +57,148 @@ class Kerberos:
             return c.KRB_FAIL
     
 
+    def _user_string(self):
+        """The principal in user@DOMAIN format"""
+        return "%s@%s" % (self.principal, self.domain)
+
+    def _run(self, cmd, env=None):
+        """Run a kerberos command, returns rc, stdout, stderr"""
+        ph = subprocess.Popen(
+            cmd,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE,
+            stdin = subprocess.PIPE,
+            env = env
+        )
+        _stdout, _stderr = ph.communicate(timeout=self.timeout)
+
+        return ph.returncode, _stdout, _stderr
+
+    def _parse_klist(self, output):
+        """Get the expiry time of the user's TGT from the klist output"""
+        user_string = self._user_string().lower()
+        tgt = "%s%s@%s" % (c.KRB_TGT_PREFIX, self.domain, self.domain)
+        principal_ok = False
+
+        for line in output.splitlines():
+            line = line.strip()
+
+            # MIT is "Default principal: ...", Heimdal is "Principal: ..."
+            if line.lower().startswith(("default principal:", "principal:")):
+                principal_ok = line.split(":", 1)[1].strip().lower() == user_string
+            elif principal_ok and tgt.lower() in line.lower():
+                # Valid starting, Expires and Service principal are separated by 2+ spaces
+                fields = re.split(r"\s{2,}", line)
+
+                if len(fields) >= 3:
+                    return _parse_date(fields[1])
+
+        return None
+
+    def _klist(self, cache=""):
+        """List the tickets in a cache (the default cache if none given)"""
+        env = dict(os.environ)
+        cmd = ["klist"]
+
+        if len(cache) > 0:
+            cmd.extend(["-c", cache])
+        else:
+            env.pop("KRB5CCNAME", None)
+
+        try:
+            rc, _stdout, _stderr = self._run(cmd, env)
+        except Exception as e:
+            self.logger.debug("kerberos._klist: Error %s with klist: %s", type(e), str(e))
+            return ""
+
+        if rc != 0:
+            return ""
+
+        return _stdout.decode("utf-8") if type(_stdout) == bytes else _stdout
+
+    def _find_ticket(self):
+        """Look for a ticket for the user in our cache file, then the default cache. A cache
+        holding an expired ticket is skipped"""
+        caches = [self.cache] if os.path.exists(self.cache) else []
+
+        if not self.force_cache:
+            caches.append("")
+
+        for cache in caches:
+            expires = self._parse_klist(self._klist(cache))
+
+            if expires is not None and expires > time.time():
+                return {"expires": expires, "cache": cache}
+
+        return None
+
+    def _use_cache(self, cache):
+        """Point KRB5CCNAME at the cache holding the ticket (or the default cache)"""
+        if len(cache) > 0:
+            os.environ["KRB5CCNAME"] = cache
+        elif "KRB5CCNAME" in os.environ:
+            del os.environ["KRB5CCNAME"]
+
+    def _record_ticket(self):
+        """Remember the ticket just obtained so other connections can use it"""
+        # kinit leaves KRB5CCNAME pointing at the cache it wrote to, unset for the default
+        cache = os.environ.get("KRB5CCNAME", "")
+        expires = self._parse_klist(self._klist(cache))
+
+        if expires is None or expires <= time.time():
+            # klist could not tell us, so assume the shortest lifetime we would expect
+            self.logger.debug("kerberos._record_ticket: Unable to read the ticket expiry")
+            expires = time.time() + self.renew_before + c.KRB_ASSUMED_LIFETIME
+
+        _TICKETS[self._user_string()] = {"expires": expires, "cache": cache}
+
+    def _renew(self, cache):
+        """Renew a ticket that is about to expire"""
+        cmd = ["kinit", "-R"]
+
+        if len(cache) > 0:
+            cmd.extend(["-c", cache])
+
+        cmd.append(self._user_string())
+
+        try:
+            rc, _stdout, _stderr = self._run(cmd)
+        except Exception as e:
+            self.logger.debug("kerberos._renew: Error %s renewing ticket: %s", type(e), str(e))
+            return False
+
+        if rc != 0:
+            self.logger.debug("kerberos._renew: Unable to renew ticket, rc: %s", rc)
+            return False
+
+        return True
+
+    def _reuse_ticket(self):
+        """Use an existing ticket if it has enough time left, renewing it if it is close"""
+        ticket = _TICKETS.get(self._user_string(), None) or self._find_ticket()
+
+        if ticket is None:
+            return False
+
+        remaining = ticket["expires"] - time.time()
+
+        if remaining > self.renew_before:
+            self.logger.debug(
+                "Reusing kerberos ticket for %s, %d seconds left", self._user_string(), remaining
+            )
+            self._use_cache(ticket["cache"])
+            _TICKETS[self._user_string()] = ticket
+            return True
+
+        if remaining > 0 and self._renew(ticket["cache"]):
+            self.logger.debug("Renewed kerberos ticket for %s", self._user_string())
+            self._use_cache(ticket["cache"])
+            self._record_ticket()
+            return True
+
+        _TICKETS.pop(self._user_string(), None)
+        return False
+
     def _kinit(self, password, use_cache=False):
         """Run the kinit command"""
         user_string = "%s@%s" % (self.principal, self.domain)
@@ -87,11 +254,8 @@ class Kerberos:
             return c.KRB_RETRY_CACHE
                 
 
-    def get_ticket(self, principal, domain, password):
-        """Get a ticket"""
-        self.principal = principal
-        self.domain = domain.upper()
-        self.cache = "/tmp/krb5_%s_%s" % (self.domain, self.principal)
+    def _new_ticket(self, password):
+        """Get a new ticket with kinit"""
         err = self._kinit(password, self.force_cache)
 
         if err == c.KRB_KINIT_OK:
@@ -102,4 +266,22 @@ class Kerberos:
 
             return err == c.KRB_KINIT_OK
         
-        return False
\ No newline at end of file
+        return False
+
+    def get_ticket(self, principal, domain, password):
+        """Get a ticket, reusing a valid one rather than running kinit each time"""
+        self.principal = principal
+        self.domain = domain.upper()
+        self.cache = "/tmp/krb5_%s_%s" % (self.domain, self.principal)
+
+        # Connections for the same principal wait here, so only the first runs kinit
+        with _ticket_lock(self._user_string()):
+            if self._reuse_ticket():
+                return True
+
+            ok = self._new_ticket(password)
+
+            if ok:
+                self._record_ticket()
+
+            return ok
@@ -1,44 +1,90 @@
 import sys
+import json
+import time
 import argparse
 import logging
 
 import constants as c
 import argument_defs
-from utilities import CustomFormatter, get_password, show_inputs
+from utilities import CustomFormatter, get_password, show_inputs, load_hosts
 from command_builder import CommandBuilder
-
-# If pypsrp is not present, this import will fail
-try:
-    from transport_pypsrp import Transport
-    HAS_PYPSRP = True
-    IMPORT_ERROR = None
-except ImportError as e:
-    HAS_PYPSRP = False
-    IMPORT_ERROR = "The pypsrp module could not be loaded. Error: %s" % str(e)
+from sink import get_sink
+from result_cache import get_result_cache, cache_key
+from digests import use_digest
+from timing import build_report, write_report, show_timings
+import network
 
 def process_results(is_ok, result_dict):
     """Process the results"""
 
-    if is_ok:
+    if is_ok and result_dict.get("changed", None) is False:
+        logger.info("Results unchanged since the last run")
+    elif is_ok and len(result_dict.get("diff", "")) > 0:
+        msg = "Results changed since the last run:\n\n%s\n" % result_dict["diff"]
+        logger.info(msg)
+    elif is_ok:
         msg = "Results:\n\n%s\n" % result_dict["stdout"]
         logger.info(msg)
     else:
         msg = "Command Error:\n\n%s\n" % result_dict["stderr"]
         logger.warning(msg)
 
+def show_stream(kind, item):
+    """Show output as it arrives when streaming"""
+    if kind == c.STREAM_ERROR:
+        logger.warning("%s", item)
+    else:
+        logger.info("%s", item)
+
+def show_object(obj):
+    """Show an object from structured output as a line of JSON"""
+    logger.info("%s", json.dumps(obj))
+
+def show_agent_message(message):
+    """Show a message sent back by the agent"""
+    if message["type"] == c.AGENT_OUTPUT:
+        logger.info("%s", message["data"])
+    elif message["type"] == c.AGENT_ERROR:
+        logger.warning("%s", message["data"])
+    elif message["type"] == c.AGENT_OBJECT:
+        show_object(message["data"])
+    elif message["type"] == c.AGENT_LOG:
+        logger.warning("Agent: %s", message["message"])
+    elif message["type"] == c.AGENT_RESULT:
+        logger.info("[%s] %s (%.2fs)", message["host"], message["status"], message["duration"])
+        process_results(message["status"] == c.HOST_SUCCESS, message)
+
+def run_via_agent(hosts):
+    """Hand the request to a running agent, which already has the sessions and tickets"""
+    from agent_client import build_request, send_request
+
+    try:
+        done = send_request(args.agent_socket, build_request(args, hosts), show_agent_message)
+    except OSError as e:
+        logger.error("Unable to reach the agent on %s: %s", args.agent_socket, str(e))
+        return
+
+    if done["status"] != c.HOST_SUCCESS:
+        logger.warning("Agent request %s %s", done["status"], done.get("error", ""))
+
 def main():
     """Main routine starting point"""
     logger.info("Starting")
+    show_inputs(logger, args)
 
-    # If the password is not entered then ask for it
-    password = get_password(args.username, args.pwd)
+    try:
+        hosts = load_hosts(args.server)
+    except OSError as e:
+        logger.error("Unable to read the inventory: %s", str(e))
+        return
 
-    # If the password is still empty then we cannot carry on
-    if password is None or len(password) == 0:
-        logger.error("No password was supplied for user: %s", args.user)
+    if len(hosts) == 0:
+        logger.error("No servers to manage")
+        return
+
+    if args.agent_socket:
+        run_via_agent(hosts)
         return
-    
-    show_inputs(logger, args)
 
     # Build command
     commander = CommandBuilder(logger, args)
@@ -47,36 +93,144 @@ def main():
     if command_detail is None or not commander.ok:
         return
 
+    # pypsrp (and everything it pulls in) is slow to load, so only import it once we know there
+    # is something to run. If pypsrp is not present, this import will fail
+    try:
+        from transport_pypsrp import Transport
+        from fleet import Fleet
+        from rolling import RollingRestart, is_rolling
+    except ImportError as e:
+        logger.error("The pypsrp module could not be loaded. Error: %s", str(e))
+        return
+
+    # If the password is not entered then ask for it
+    password = get_password(args.username, args.pwd)
+
+    # If the password is still empty then we cannot carry on
+    if password is None or len(password) == 0:
+        logger.error("No password was supplied for user: %s", args.username)
+        return
+
+    rolling = is_rolling(args, command_detail)
+
+    if len(hosts) > 1 or args.results_file or rolling:
+        try:
+            sink = get_sink(logger, args.results_file, args.results_format) \
+                if args.results_file else None
+        except OSError as e:
+            logger.error("Unable to open the results file: %s", str(e))
+            return
+
+        # A rolling restart waits for each host to come back, even if there is only one
+        fleet_class = RollingRestart if rolling else Fleet
+        fleet = fleet_class(logger, args, password, hosts, sink)
+
+        try:
+            fleet.run(command_detail)
+        finally:
+            if sink is not None:
+                sink.close()
+
+        fleet.summary()
+
+        if args.metrics_file:
+            write_report(logger, fleet.metrics_report(), args.metrics_file, args.metrics_format)
+        return
+
+    cache = get_result_cache(logger, args)
+    # Objects are shown as they arrive rather than kept, so only text results are cached
+    request = cache_key(args, command_detail) if cache is not None and \
+        args.output != c.OUTPUT_JSON else None
+
+    if request is not None and not args.cache_bypass:
+        result = cache.get(hosts[0], args.username, request)
+
+        if result is not None:
+            logger.info("Cached result from %.0f seconds ago", time.time() - result["saved"])
+            process_results(result["status"] == c.HOST_SUCCESS, result)
+            return
+
     # Set up transport
-    transport = Transport(logger, args, password)
+    transport = Transport(logger, args, password, server=hosts[0])
+    status = run_single(transport, command_detail)
+    show_timings(logger, transport.timer.timings)
+
+    if cache is not None and command_detail.get("mutates", False):
+        cache.invalidate(hosts[0])
+    elif request is not None and status == c.HOST_SUCCESS:
+        cache.put(hosts[0], args.username, request, {
+            "status": status, "stdout": transport.result_dict["stdout"],
+            "stderr": transport.result_dict["stderr"]
+        })
 
+    if args.metrics_file:
+        counts = dict.fromkeys(c.CHOICES_HOST_STATUS, 0)
+        counts[status] = 1
+        report = build_report([transport.timer.timings], counts)
+        write_report(logger, report, args.metrics_file, args.metrics_format)
+
+def run_single(transport, command_detail):
+    """Connect to a single host, run the command and show the results - returns the status"""
     # Establish a connection
     transport.connect(command_detail["command_type_raw"])
 
 
     if not transport.connected:
         logger.warning("Connection failed, exiting procedure")
-        return
+        return c.HOST_UNREACHABLE if transport.unreachable else c.HOST_FAILED
     
-    # Run the command
-    run_ok = transport.run_command(command_detail["command"])
+    # A file transfer has a summary rather than command output
+    if "transfer" in command_detail:
+        run_ok = transport.run_transfer(command_detail["transfer"])
+        process_results(run_ok, transport.result_dict)
+        transport.disconnect()
+        return c.HOST_SUCCESS if run_ok else c.HOST_FAILED
+
+    # Objects rather than text, shown as they arrive
+    if args.output == c.OUTPUT_JSON and "commands" not in command_detail:
+        properties = command_detail.get("properties", None)
+        run_ok = transport.run_structured(command_detail["command"], properties, show_object)
+
+        if transport.connected and not run_ok:
+            logger.warning("Command Error:\n\n%s\n", transport.result_dict["stderr"])
+
+        transport.disconnect()
+        return c.HOST_SUCCESS if run_ok else c.HOST_FAILED
+
+    # Streaming shows the output as it arrives, so there are no results to read after
+    if args.stream and "commands" not in command_detail:
+        stream_ok = transport.stream_command(command_detail["command"], show_stream)
+
+        if transport.connected and not stream_ok:
+            logger.warning("Command Error:\n\n%s\n", transport.result_dict["stderr"])
+
+        transport.disconnect()
+        return c.HOST_SUCCESS if stream_ok else c.HOST_FAILED
+
+    # Run the command, or all of the commands in one go for a batch
+    if "commands" in command_detail:
+        run_ok = transport.run_commands(command_detail["commands"])
+    else:
+        run_ok = transport.run_command(command_detail["command"], use_digest(command_detail))
     # For Client connection, we will reset connected and give an error if there is an issue. This
     # is because the "connect" doesn;t really connect, the command execution does. So verify we
     # are connected first
 
     if not transport.connected:
-        return
+        return c.HOST_FAILED
 
     if not run_ok:
         logger.warning(
             "Command failed to run: %s", transport.result_dict["stderr"]
         )
     else:
-        read_ok = transport.get_results()
-        process_results(read_ok, transport.result_dict)
+        run_ok = transport.get_results()
+        process_results(run_ok, transport.result_dict)
 
     transport.disconnect()
 
+    return c.HOST_SUCCESS if run_ok else c.HOST_FAILED
+
     
 if __name__ == "__main__":
     # First process arguments
@@ -93,6 +247,10 @@ if __name__ == "__main__":
     connect_parser = parser.add_argument_group("connection settings")
     argument_defs.args_connect(connect_parser)
 
+    # Session arguments
+    session_parser = parser.add_argument_group("session settings")
+    argument_defs.args_session(session_parser)
+
     # Kerberos arguments
     krb5_parser = parser.add_argument_group("kerberos settings")
     argument_defs.args_kerberos(krb5_parser)
@@ -101,6 +259,22 @@ if __name__ == "__main__":
     optional_parser = parser.add_argument_group("additional settings")
     argument_defs.args_optional(optional_parser)
 
+    # Results arguments
+    results_parser = parser.add_argument_group("results settings")
+    argument_defs.args_results(results_parser)
+
+    # Fleet arguments
+    fleet_parser = parser.add_argument_group("fleet settings")
+    argument_defs.args_fleet(fleet_parser)
+
+    # Agent arguments
+    agent_parser = parser.add_argument_group("agent settings")
+    argument_defs.args_agent(agent_parser)
+
+    # File transfer arguments
+    transfer_parser = parser.add_argument_group("transfer settings")
+    argument_defs.args_transfer(transfer_parser)
+
     # Options for the task
     to_parser = parser.add_argument_group("task options")
     argument_defs.args_command(to_parser)
@@ -114,7 +288,10 @@ if __name__ == "__main__":
     h.setFormatter(CustomFormatter())
     logger.addHandler(h)
 
-    if HAS_PYPSRP:
-        main()
-    else:
-        logger.error(IMPORT_ERROR)
+    if args.dns_cache:
+        network.load_cache(args.dns_cache)
+
+    main()
+
+    if args.dns_cache and not network.save_cache(args.dns_cache):
+        logger.warning("Unable to save the DNS cache to %s", args.dns_cache)
@@ -0,0 +1,201 @@
+import time
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import constants as c
+from transport_pypsrp import Transport
+from digests import use_digest
+
+# Where a host's command has got to
+STEP_START, STEP_POLL, STEP_DONE = ("start", "poll", "done")
+
+def can_multiplex(args, command_detail):
+    """PowerShell commands (or batches) whose output is read once they finish"""
+    return not command_detail["command_type_raw"] and "transfer" not in command_detail and \
+        (args.output != c.OUTPUT_JSON or "commands" in command_detail)
+
+
+class HostPipeline:
+    """The command on one host, moved on a step at a time. Each step is one short exchange
+    with the host, a poll only takes what output is already there, so nothing waits on the
+    host between steps"""
+
+    def __init__(self, logger, args, password, command_detail, host_result, rtt=None):
+        self.logger = logger
+        self.command_detail = command_detail
+        self.host_result = host_result
+        self.transport = Transport(logger, args, password, server=host_result["host"])
+        self.transport.rtt = rtt
+        self.keep_session = getattr(args, "keep_sessions", False)
+        self.step = STEP_START
+        # Seconds to wait before the next poll, grows while the host has nothing to give
+        self.idle_delay = 0.0
+        self.started = time.monotonic()
+
+    def _start(self):
+        """Connect and start the command"""
+        self.transport.connect(False)
+
+        if not self.transport.connected:
+            self.host_result["status"] = c.HOST_UNREACHABLE if self.transport.unreachable else \
+                c.HOST_FAILED
+            self.host_result["stderr"] = "Connection failed"
+            self.host_result["retryable"] = self.transport.retryable
+            return True
+
+        if "commands" in self.command_detail:
+            started = self.transport.begin_command(commands=self.command_detail["commands"])
+        else:
+            started = self.transport.begin_command(
+                self.command_detail["command"], use_digest=use_digest(self.command_detail)
+            )
+
+        return not started
+
+    def _poll(self):
+        """Collect what output there is, returns True once the command has finished"""
+        received = len(self.transport.pipeline.output)
+
+        if not self.transport.poll_command(c.MULTIPLEX_POLL_TIMEOUT):
+            if len(self.transport.pipeline.output) > received:
+                self.idle_delay = 0.0
+            else:
+                self.idle_delay = min(c.MULTIPLEX_IDLE_MAX,
+                                      max(c.MULTIPLEX_IDLE_START, self.idle_delay * 2))
+            return False
+
+        run_ok = not self.transport.result_dict["is_error"]
+
+        if run_ok:
+            run_ok = self.transport.get_results()
+
+        self.host_result["stdout"] = self.transport.result_dict["stdout"]
+        self.host_result["stderr"] = str(self.transport.result_dict["stderr"])
+        self.host_result["changed"] = self.transport.result_dict["changed"]
+        self.host_result["diff"] = self.transport.result_dict["diff"]
+        self.host_result["status"] = c.HOST_SUCCESS if run_ok else c.HOST_FAILED
+        return True
+
+    def run_step(self):
+        """Take the next step, returns the pipeline so the loop knows which one it was"""
+        try:
+            finished = self._start() if self.step == STEP_START else self._poll()
+
+            if self.step == STEP_START and not finished:
+                self.step = STEP_POLL
+        except Exception as e:
+            self.host_result["stderr"] = "Error %s: %s" % (type(e), str(e))
+            finished = True
+
+        if finished:
+            self.step = STEP_DONE
+            self.transport.disconnect(close=not self.keep_session)
+            self.host_result["duration"] = time.monotonic() - self.started
+            self.host_result["timings"] = dict(self.transport.timer.timings)
+
+        return self
+
+
+class Multiplexer:
+    """Runs a command on many hosts from one loop. pypsrp only has blocking calls, so this is
+    a bounded pool of io_threads doing the connects, starts and polls, and the loop decides
+    when each host gets its next one. Polls are short and a host waits its idle delay in the
+    loop's schedule rather than on a thread, so far more hosts can be in flight than there are
+    threads (the scheduler's limit sets how many), but every step still takes a thread for a
+    round trip"""
+
+    def __init__(self, logger, args, password, io_threads):
+        self.logger = logger
+        self.args = args
+        self.password = password
+        self.io_threads = io_threads
+
+    def run(self, hosts, command_detail, scheduler, new_result, on_done, probes=None):
+        """Run the command on the hosts. new_result(host) gives an empty host result and
+        on_done(host_result) is called as each host finishes"""
+        probes = probes or {}
+        # (when, order, item, attempt) - hosts waiting to start, and pipelines due a poll
+        waiting = [(0.0, i, host, 1) for i, host in enumerate(hosts)]
+        polls = []
+        order = len(waiting)
+        running = {}
+        in_flight = 0
+
+        with ThreadPoolExecutor(max_workers=self.io_threads) as executor:
+            while len(waiting) > 0 or len(polls) > 0 or len(running) > 0:
+                now = time.monotonic()
+
+                while len(waiting) > 0 and waiting[0][0] <= now and \
+                        in_flight < scheduler.limit.current and len(running) < self.io_threads:
+                    _when, _order, host, attempt = heapq.heappop(waiting)
+                    reason = scheduler.allow(host)
+                    host_result = new_result(host)
+                    host_result["start"] = time.time()
+                    host_result["attempts"] = attempt
+
+                    if reason is not None:
+                        host_result["stderr"] = reason
+                        on_done(host_result)
+                        continue
+
+                    pipeline = HostPipeline(
+                        self.logger, self.args, self.password, command_detail, host_result,
+                        probes.get(host, {}).get("rtt", None)
+                    )
+                    running[executor.submit(pipeline.run_step)] = pipeline
+                    in_flight += 1
+
+                # Only hand out as many polls as there are threads, the rest wait their turn
+                while len(polls) > 0 and polls[0][0] <= now and len(running) < self.io_threads:
+                    pipeline = heapq.heappop(polls)[2]
+                    running[executor.submit(pipeline.run_step)] = pipeline
+
+                timeout = self._next_due(waiting, polls, now, in_flight, scheduler, running)
+
+                if len(running) == 0:
+                    time.sleep(timeout or 0.0)
+                    continue
+
+                done, _pending = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    pipeline = running.pop(future)
+
+                    if pipeline.step != STEP_DONE:
+                        heapq.heappush(polls, (time.monotonic() + pipeline.idle_delay, order,
+                                               pipeline))
+                        order += 1
+                        continue
+
+                    in_flight -= 1
+                    host_result = pipeline.host_result
+                    delay = scheduler.done(host_result, host_result["attempts"])
+
+                    if delay is not None:
+                        self.logger.warning(
+                            "[%s] attempt %s failed, retrying in %.1f seconds: %s",
+                            host_result["host"], host_result["attempts"], delay,
+                            host_result["stderr"]
+                        )
+                        heapq.heappush(waiting, (
+                            time.monotonic() + delay, order, host_result["host"],
+                            host_result["attempts"] + 1
+                        ))
+                        order += 1
+                        continue
+
+                    host_result["rtt"] = probes.get(host_result["host"], {}).get("rtt", None)
+                    on_done(host_result)
+
+    def _next_due(self, waiting, polls, now, in_flight, scheduler, running):
+        """Seconds until a waiting host or poll could be started, None to wait for a step"""
+        if len(running) >= self.io_threads:
+            return None
+
+        due = []
+        if len(polls) > 0:
+            due.append(polls[0][0])
+        if len(waiting) > 0 and in_flight < scheduler.limit.current:
+            due.append(waiting[0][0])
+
+        return max(0.0, min(due) - now) if len(due) > 0 else None
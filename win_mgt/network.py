@@ -1,81 +1,284 @@
+import ipaddress
+import threading
+import selectors
 import socket
-import re
+import errno
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import constants as c
+
+# Resolved hosts shared by every Network instance - host: {"host_info": ..., "expires": ...}
+_DNS_CACHE = {}
+_DNS_CACHE_LOCK = threading.Lock()
+
+def _ip_version(host):
+    """4 or 6 for an IP address, None for anything else"""
+    try:
+        return ipaddress.ip_address(host).version
+    except ValueError:
+        return None
 
 def _is_ipv6(host):
     """IPv6 address??"""
-    return len(host.split(":")) == 8
+    return _ip_version(host) == 6
 
 def _is_ipv4(host):
     """IPv4 address??"""
-    pattern = r"\b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b"
-    return re.match(pattern, host)
+    return _ip_version(host) == 4
+
+def _set_dict():
+    """Default values for dictionary"""
+    return {
+        "host": "",
+        "fqdn": "",
+        "ip": "",
+        "addresses": [],
+        "is_resolved": False,
+        "is_ipv6": False
+    }
+
+def _resolve(host):
+    """Look up every A/AAAA record for a host name/ip, plus the fqdn"""
+    host_info = _set_dict()
+    host_info["host"] = host
+
+    try:
+        addr_info = socket.getaddrinfo(
+            host, None, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_CANONNAME
+        )
+    except (socket.gaierror, UnicodeError):
+        # Return what information we have
+        if _ip_version(host) is not None:
+            host_info["ip"] = host
+            host_info["addresses"] = [host]
+            host_info["is_ipv6"] = _is_ipv6(host)
+
+        return host_info
+
+    # Keep the order given by the resolver, it already prefers the best address
+    host_info["addresses"] = list(dict.fromkeys(a[4][0] for a in addr_info))
+    host_info["ip"] = host_info["addresses"][0]
+    host_info["is_ipv6"] = _is_ipv6(host_info["ip"])
+    host_info["fqdn"] = addr_info[0][3]
+    host_info["is_resolved"] = True
+
+    # For an IP the canonical name is the IP, a reverse lookup gives the name (needed for SPNs)
+    if _ip_version(host) is not None:
+        try:
+            host_info["fqdn"] = socket.gethostbyaddr(host)[0]
+        except (socket.herror, socket.gaierror):
+            host_info["fqdn"] = ""
+
+    return host_info
+
+def known_host(host, fqdn, ip):
+    """host_info for a host already resolved on an earlier run, so it needn't be looked up"""
+    host_info = _set_dict()
+    host_info["host"] = host
+    host_info["fqdn"] = fqdn or ""
+    host_info["ip"] = ip or ""
+    host_info["addresses"] = [ip] if ip else []
+    host_info["is_resolved"] = len(host_info["ip"]) > 0
+    host_info["is_ipv6"] = _is_ipv6(host_info["ip"])
+
+    return host_info
+
+def lookup_host(host):
+    """Resolve a host, using the shared cache when the entry has not expired"""
+    now = time.time()
+
+    with _DNS_CACHE_LOCK:
+        entry = _DNS_CACHE.get(host.lower(), None)
+
+    if entry is not None and entry["expires"] > now:
+        return dict(entry["host_info"])
+
+    host_info = _resolve(host)
+    ttl = c.DNS_POSITIVE_TTL if host_info["is_resolved"] else c.DNS_NEGATIVE_TTL
+
+    with _DNS_CACHE_LOCK:
+        _DNS_CACHE[host.lower()] = {"host_info": host_info, "expires": now + ttl}
+
+    return dict(host_info)
+
+def load_cache(file_name):
+    """Load resolved hosts saved by a previous run, ignoring any that have expired"""
+    try:
+        with open(file_name, "r", encoding="utf-8") as fh:
+            entries = json.load(fh)
+    except (OSError, ValueError):
+        return 0
+
+    now = time.time()
+
+    with _DNS_CACHE_LOCK:
+        for host, entry in entries.items():
+            # Looked up lower case, whatever wrote the file
+            if entry.get("expires", 0) > now and "host_info" in entry:
+                _DNS_CACHE[host.lower()] = entry
+
+    return len(_DNS_CACHE)
+
+def save_cache(file_name):
+    """Save the resolved hosts that are still valid for the next run"""
+    now = time.time()
+
+    with _DNS_CACHE_LOCK:
+        entries = {h: e for h, e in _DNS_CACHE.items() if e["expires"] > now}
+
+    try:
+        with open(file_name, "w", encoding="utf-8") as fh:
+            json.dump(entries, fh)
+    except OSError:
+        return False
+
+    return True
+
+def _start_probe(selector, host, ip, port):
+    """Start a non-blocking connect, returns False if it failed straight away"""
+    family = socket.AF_INET6 if _is_ipv6(ip) else socket.AF_INET
+
+    try:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+    except OSError:
+        return False
+
+    sock.setblocking(False)
+    r = sock.connect_ex((ip, port))
+
+    if r not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        sock.close()
+        return False
+
+    selector.register(sock, selectors.EVENT_WRITE, (host, port, time.monotonic()))
+    return True
+
+def _end_probe(selector, sock):
+    """Stop watching a probe socket and close it"""
+    selector.unregister(sock)
+    sock.close()
+
+def host_targets(host_infos, ports):
+    """(host, ip, port) targets for probe_hosts, every address of each host on every port so a
+    host is reachable through any of them. host_infos is a dictionary of host: host_info"""
+    return [
+        (host, ip, port)
+        for host, host_info in host_infos.items()
+        for ip in host_info["addresses"] or [host_info["ip"]]
+        for port in ports
+    ]
+
+def probe_hosts(targets, timeout=c.DEFAULT_PROBE_TIMEOUT, max_inflight=c.PROBE_MAX_INFLIGHT):
+    """Check many (host, ip, port) targets at once without blocking on any one of them.
+
+    Returns a dictionary of host: {"reachable", "port", "rtt"}, a host is reachable if any of
+    its targets accepted a connection within the timeout"""
+    results = {}
+    pending = []
+
+    for host, ip, port in targets:
+        results.setdefault(host, {"reachable": False, "port": None, "rtt": None})
+
+        if ip:
+            pending.append((host, ip, port))
+
+    pending.reverse()
+    selector = selectors.DefaultSelector()
+
+    try:
+        while len(pending) > 0 or len(selector.get_map()) > 0:
+            # Keep the number of open sockets under the limit
+            while len(pending) > 0 and len(selector.get_map()) < max_inflight:
+                host, ip, port = pending.pop()
+
+                if not results[host]["reachable"]:
+                    _start_probe(selector, host, ip, port)
+
+            if len(selector.get_map()) == 0:
+                continue
+
+            oldest = min(key.data[2] for key in selector.get_map().values())
+            wait = max(0.0, oldest + timeout - time.monotonic())
+
+            for key, _events in selector.select(wait):
+                host, port, started = key.data
+                err = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+                if err == 0 and not results[host]["reachable"]:
+                    results[host] = {
+                        "reachable": True, "port": port, "rtt": time.monotonic() - started
+                    }
+
+                _end_probe(selector, key.fileobj)
+
+            # Give up on probes that have taken too long
+            now = time.monotonic()
+            for key in list(selector.get_map().values()):
+                if now - key.data[2] >= timeout:
+                    _end_probe(selector, key.fileobj)
+    finally:
+        for key in list(selector.get_map().values()):
+            _end_probe(selector, key.fileobj)
+        selector.close()
+
+    return results
 
 class Network:
     def __init__(self, logger):
         self.logger = logger
-        self.host_info = self._set_dict()
-
-    def _set_dict(self):
-        """Default values for dictionary"""
-        return {
-            "host": "",
-            "fqdn": "",
-            "ip": "",
-            "is_resolved": False,
-            "is_ipv6": False
-        }
-    
-
-    def _is_ip(self, host):
-        """See if this is IP - and whether it is IPv6"""
-        # Test for IPv6 first
-        if _is_ipv6(host):
-            self.host_info["ip"] = host
-            self.host_info["is_ipv6"] = True
-            return
-        
-        # Now test for IPv4
-        if _is_ipv4(host):
-            self.host_info["ip"] = host
-            self.host_info["is_ipv6"] = False
-            return
-        
-        # Must be a host name
-        self.host_info["host"] = host
-        return
-    
+        self.host_info = _set_dict()
 
     def resolve_host(self, host):
         """Try to resolve a host name/ip to get host, fqdn and IP"""
-        try:
-            host_info = socket.gethostbyaddr(host)
-        except socket.herror:
+        self.host_info = lookup_host(host)
+
+        if not self.host_info["is_resolved"]:
             self.logger.debug("network.resolve_host: Failed to resolve host from: %s", host)
-            # Return what information we have
-            self._is_ip(host)
-            # Set the host to be the input
-            self.host_info["host"] = host
-            return self.host_info
-        
-        self.host_info["host"] = host_info[0]
-        self.host_info["fqdn"] = host_info[1][0]
-        self.host_info["ip"] = host_info[2][0]
-        self.host_info["is_ipv6"] = _is_ipv6(self.host_info["ip"])
-        self.host_info["is_resolved"] = True
 
         return self.host_info
+
+    def resolve_many(self, hosts, workers=c.DNS_RESOLVE_WORKERS):
+        """Resolve many hosts at the same time, returns a dictionary of host: host_info"""
+        if len(hosts) == 0:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(hosts)))) as executor:
+            resolved = dict(zip(hosts, executor.map(lookup_host, hosts)))
+
+        failed = [h for h, info in resolved.items() if not info["is_resolved"]]
+        if len(failed) > 0:
+            self.logger.debug("network.resolve_many: Failed to resolve: %s", ", ".join(failed))
+
+        return resolved
     
-    def ping_host(self, port):
+    def probe_many(self, host_infos, ports, timeout=c.DEFAULT_PROBE_TIMEOUT):
+        """Check which hosts are listening on any of the ports, host_infos as from resolve_many"""
+        _start = time.monotonic()
+        results = probe_hosts(host_targets(host_infos, ports), timeout)
+
+        self.logger.debug(
+            "network.probe_many: %s of %s hosts reachable, took %.2f seconds",
+            len([r for r in results.values() if r["reachable"]]), len(results),
+            time.monotonic() - _start
+        )
+
+        return results
+
+    def ping_host(self, port, timeout=c.DEFAULT_PROBE_TIMEOUT):
         """Attempt to ping a device"""
 
         # Should the ping be IPv6 or IPv4
         family = socket.AF_INET6 if self.host_info["is_ipv6"] else socket.AF_INET
         sock = socket.socket(family)
+        # Don't wait for the OS connect timeout on a host that isn't there
+        sock.settimeout(timeout)
         r = None
 
         try:
             r = sock.connect_ex((self.host_info["ip"], port))
-        except socket.gaierror as e:
+        except (socket.gaierror, OSError) as e:
             self.logger.error(
                 "Error in ping test: %s", str(e)
             )
@@ -0,0 +1,128 @@
+import time
+
+import constants as c
+from sqlite_store import SqliteStore, get_store
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS profiles (
+    server TEXT NOT NULL,
+    username TEXT NOT NULL,
+    auth TEXT,
+    port INTEGER,
+    ssl INTEGER,
+    encryption TEXT,
+    fqdn TEXT,
+    ip TEXT,
+    rtt REAL,
+    max_envelope_size INTEGER,
+    kinit_cache INTEGER,
+    last_success REAL,
+    PRIMARY KEY (server, username)
+)
+"""
+
+def get_profile_store(logger, args=None):
+    """Return the profile store shared by every transport in this process, None unless
+    --profile-store was given"""
+    return get_store(logger, ProfileStore, getattr(args, "profile_store", None))
+
+def is_fresh(profile, max_age=c.PROFILE_MAX_AGE):
+    """Did the profile work within max_age seconds"""
+    return profile is not None and time.time() - (profile["last_success"] or 0) < max_age
+
+
+class ProfileStore(SqliteStore):
+    """What last worked for each host and user - the connection settings, the resolved name and
+    address, round trip time, envelope size and whether kinit needed the cache file. Profiles
+    are read in bulk for an inventory and written back in one transaction"""
+
+    NAME = "profile store"
+    SCHEMA = [_CREATE_TABLE]
+    DB_TIMEOUT = c.PROFILE_DB_TIMEOUT
+
+    def __init__(self, logger, path):
+        super().__init__(logger, path)
+        # (server, username): profile, or None if there isn't one - saves asking again
+        self.profiles = {}
+        # pending is (server, username): profile to write, or None to delete
+
+    def _row_profile(self, row):
+        """Turn a row into a profile dictionary"""
+        profile = dict(zip(c.PROFILE_FIELDS, row))
+        profile["ssl"] = bool(profile["ssl"])
+        profile["kinit_cache"] = bool(profile["kinit_cache"])
+
+        return profile
+
+    def load(self, servers, username):
+        """Read the profiles of a whole inventory in one go, returns how many were found. They
+        are read again even if already held, other processes may have written them since"""
+        with self.lock:
+            wanted = [s for s in dict.fromkeys(servers) if (s, username) not in self.pending]
+            rows = self._select_servers(
+                "SELECT %s FROM profiles WHERE username = ? AND server IN (%%s)" %
+                ", ".join(c.PROFILE_FIELDS), [username], wanted, c.PROFILE_BATCH
+            )
+            found = {row[0]: self._row_profile(row) for row in rows}
+
+            for server in wanted:
+                self.profiles[(server, username)] = found.get(server, None)
+
+        self.logger.debug(
+            "profiles.load: %s of %s hosts have a profile", len(found), len(wanted)
+        )
+        return len(found)
+
+    def get(self, server, username):
+        """The profile of a host if it is recent enough to use, otherwise None"""
+        if (server, username) not in self.profiles:
+            self.load([server], username)
+
+        with self.lock:
+            profile = self.profiles.get((server, username), None)
+
+        return dict(profile) if is_fresh(profile) else None
+
+    def put(self, profile):
+        """Record what just worked for a host"""
+        key = (profile["server"], profile["username"])
+        profile = dict(profile, last_success=time.time())
+
+        with self.lock:
+            self.profiles[key] = profile
+            self.pending[key] = profile
+            flush = len(self.pending) >= c.PROFILE_FLUSH_EVERY
+
+        if flush:
+            self.flush()
+
+    def invalidate(self, server, username):
+        """The profile no longer works, so the next run works everything out again"""
+        key = (server, username)
+
+        with self.lock:
+            if self.profiles.get(key, None) is None and key not in self.pending:
+                self.profiles[key] = None
+                return
+
+            self.profiles[key] = None
+            self.pending[key] = None
+
+        self.logger.debug("profiles.invalidate: Dropped the profile of %s", server)
+
+    def _write(self, pending):
+        """Write the changed profiles and drop the invalidated ones"""
+        rows = [
+            [profile[f] for f in c.PROFILE_FIELDS]
+            for profile in pending.values() if profile is not None
+        ]
+        deleted = [list(key) for key, profile in pending.items() if profile is None]
+
+        self.db.executemany(
+            "INSERT OR REPLACE INTO profiles (%s) VALUES (%s)" % (
+                ", ".join(c.PROFILE_FIELDS), ", ".join("?" * len(c.PROFILE_FIELDS))
+            ), rows
+        )
+        self.db.executemany("DELETE FROM profiles WHERE server = ? AND username = ?", deleted)
+
+        return "Wrote %s profiles, dropped %s" % (len(rows), len(deleted))
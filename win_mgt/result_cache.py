@@ -0,0 +1,187 @@
+import json
+import time
+import sqlite3
+
+import constants as c
+from sqlite_store import SqliteStore, get_store
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS results (
+    server TEXT NOT NULL,
+    username TEXT NOT NULL,
+    request TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stdout TEXT NOT NULL,
+    stderr TEXT NOT NULL,
+    saved REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (server, username, request)
+)
+"""
+_CREATE_INDEX = "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+
+def get_result_cache(logger, args=None):
+    """Return the result cache shared by everything in this process, None unless
+    --result-cache was given"""
+    return get_store(
+        logger, ResultCache, getattr(args, "result_cache", None),
+        getattr(args, "cache_ttl", None), getattr(args, "cache_max_mb", None)
+    )
+
+def cache_key(args, command_detail):
+    """What the result depends on besides the host and user, None if it can't be cached.
+    Parameters and filters are part of the command"""
+    if not command_detail.get("cacheable", False) or getattr(args, "stream", False):
+        return None
+
+    return json.dumps([
+        command_detail["command"], command_detail["command_type_raw"],
+        command_detail.get("properties", None), args.output
+    ])
+
+
+class ResultCache(SqliteStore):
+    """Results of read-only commands, shared on disk by every job on the machine. A result is
+    used for ttl seconds, and the least recently used are dropped once the results come to
+    more than max_mb. Hosts that run a command changing them have their results dropped"""
+
+    NAME = "result cache"
+    SCHEMA = [_CREATE_TABLE, _CREATE_INDEX]
+    DB_TIMEOUT = c.CACHE_DB_TIMEOUT
+
+    def __init__(self, logger, path, ttl=c.DEFAULT_CACHE_TTL, max_mb=c.DEFAULT_CACHE_MAX_MB):
+        super().__init__(logger, path)
+        self.ttl = ttl if ttl is not None and ttl >= 0 else c.DEFAULT_CACHE_TTL
+        self.max_size = int((max_mb or c.DEFAULT_CACHE_MAX_MB) * 1048576)
+        # pending is (server, username, request): result to write
+        # (server, username, request): when it was last used, written with the results
+        self.touched = {}
+
+    def load(self, servers, username, request):
+        """The results of an inventory young enough to use, {server: result}"""
+        oldest = time.time() - self.ttl
+        found = {}
+
+        with self.lock:
+            wanted = []
+
+            for server in dict.fromkeys(servers):
+                result = self.pending.get((server, username, request), None)
+
+                if result is None:
+                    wanted.append(server)
+                elif result["saved"] >= oldest:
+                    found[server] = dict(result)
+
+            rows = self._select_servers(
+                "SELECT server, status, stdout, stderr, saved FROM results WHERE username = ? "
+                "AND request = ? AND saved >= ? AND server IN (%s)", [username, request, oldest],
+                wanted, c.CACHE_BATCH
+            )
+
+            for server, status, stdout, stderr, saved in rows:
+                found[server] = {
+                    "status": status, "stdout": stdout, "stderr": stderr, "saved": saved
+                }
+
+            now = time.time()
+            for server in found:
+                self.touched[(server, username, request)] = now
+
+        self.logger.debug(
+            "result_cache.load: %s of %s hosts have a cached result", len(found),
+            len(set(servers))
+        )
+        return found
+
+    def get(self, server, username, request):
+        """The result for one host, None if there isn't one young enough to use"""
+        return self.load([server], username, request).get(server, None)
+
+    def put(self, server, username, request, host_result):
+        """Keep the result of a host"""
+        key = (server, username, request)
+        result = {
+            "status": host_result["status"],
+            "stdout": host_result["stdout"],
+            "stderr": str(host_result["stderr"]),
+            "saved": time.time()
+        }
+
+        with self.lock:
+            self.pending[key] = result
+            self.touched.pop(key, None)
+            flush = len(self.pending) >= c.CACHE_FLUSH_EVERY
+
+        if flush:
+            self.flush()
+
+    def invalidate(self, server):
+        """Drop every result of a host, straight away so other jobs don't use them"""
+        with self.lock:
+            for key in [k for k in self.pending if k[0] == server]:
+                del self.pending[key]
+
+            try:
+                with self.db:
+                    deleted = self.db.execute(
+                        "DELETE FROM results WHERE server = ?", [server]
+                    ).rowcount
+            except sqlite3.Error as e:
+                self.logger.warning("Unable to update the result cache: %s", str(e))
+                return
+
+        self.logger.debug("result_cache.invalidate: Dropped %s results of %s", deleted, server)
+
+    def _evict(self):
+        """Drop the least recently used results until they fit in max_size"""
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+        if total <= self.max_size:
+            return 0
+
+        evicted = []
+        for rowid, size in self.db.execute("SELECT rowid, size FROM results ORDER BY accessed"):
+            if total <= self.max_size:
+                break
+
+            evicted.append([rowid])
+            total -= size
+
+        self.db.executemany("DELETE FROM results WHERE rowid = ?", evicted)
+        return len(evicted)
+
+    def _take_pending(self):
+        """The new results and when results were used"""
+        pending = self.pending
+        touched = self.touched
+        self.pending = {}
+        self.touched = {}
+
+        if len(pending) == 0 and len(touched) == 0:
+            return None
+
+        return pending, touched
+
+    def _write(self, pending):
+        """Write the new results and when results were used, then make room if needed"""
+        results, touched = pending
+        rows = [
+            list(key) + [
+                r["status"], r["stdout"], r["stderr"], r["saved"], r["saved"],
+                len(r["stdout"]) + len(r["stderr"])
+            ]
+            for key, r in results.items()
+        ]
+
+        self.db.executemany(
+            "INSERT OR REPLACE INTO results (server, username, request, status, stdout, stderr, "
+            "saved, accessed, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        self.db.executemany(
+            "UPDATE results SET accessed = ? WHERE server = ? AND username = ? AND request = ?",
+            [[when] + list(key) for key, when in touched.items()]
+        )
+
+        return "Wrote %s results, evicted %s" % (len(rows), self._evict())
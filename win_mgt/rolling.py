@@ -0,0 +1,256 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import constants as c
+from network import lookup_host, host_targets, probe_hosts
+from transport_pypsrp import Transport
+from session import get_session_manager
+from fleet import Fleet, run_host, set_host_result
+from sqlite_store import flush_stores
+
+def is_rolling(args, command_detail):
+    """Restart the hosts in waves rather than all at once"""
+    return command_detail.get("reboots", False) and \
+        getattr(args, "max_unavailable", None) is not None
+
+def wave_size(max_unavailable, hosts):
+    """Hosts per wave from a number (3) or a percentage of the hosts (25%), at least one"""
+    if max_unavailable.endswith("%"):
+        return max(1, int(hosts * int(max_unavailable[:-1]) / 100))
+
+    return max(1, int(max_unavailable))
+
+
+class RollingRestart(Fleet):
+    """Restarts the hosts in waves so no more than max_unavailable are down at once. The hosts
+    of a wave are watched with port checks until they go down and come back, then have to accept
+    a session before the next wave is started. While a host is still up its boot time is read
+    on the session kept from before the restart, so those checks don't open a new one each
+    time"""
+
+    def __init__(self, logger, args, password, hosts, sink=None):
+        super().__init__(logger, args, password, hosts, sink)
+        self.wave_size = wave_size(args.max_unavailable, len(hosts))
+        self.timeout = args.restart_timeout if args.restart_timeout and \
+            args.restart_timeout > 0 else c.DEFAULT_RESTART_TIMEOUT
+        self.port = self._get_port()
+        self.sessions = get_session_manager(logger, args)
+        # Connecting fails until the host is ready, so only log that when debugging
+        self.ready_logger = logging.Logger("%s.ready" % __name__)
+        self.ready_logger.level = logger.level if logger.level <= logging.DEBUG else \
+            logging.CRITICAL
+        for handler in logger.handlers:
+            self.ready_logger.addHandler(handler)
+
+    def _ask(self, host, command, close=True):
+        """Run a command on a session to the host (kept for the next check unless close is
+        set), returns its output or None if that failed. The host's profile is left as it is,
+        it is not itself while restarting"""
+        transport = Transport(self.ready_logger, self.host_args, self.password, server=host,
+                              save_profile=False)
+
+        try:
+            transport.connect()
+
+            if transport.connected and transport.run_command(command) and \
+                    transport.get_results():
+                return transport.result_dict["stdout"].strip()
+        except Exception as e:
+            self.ready_logger.debug("rolling._ask: %s did not answer: %s", host, str(e))
+        finally:
+            transport.disconnect(close=close)
+
+        return None
+
+    def _is_ready(self, host):
+        """Can a session be opened and a command run. Only asked once the port answers, and
+        its sessions were closed when the host went down, so this is always a new one"""
+        return self._ask(host, c.RESTART_READY_COMMAND) is not None
+
+    def _boot_time(self, host):
+        """When the host last started, None if it could not be read. The session is kept for
+        the next read (a restart leaves it broken, so it is closed then)"""
+        return self._ask(host, c.RESTART_BOOT_COMMAND, close=False) or None
+
+    def _close_sessions(self, host):
+        """Close the sessions kept for a host, under whichever name they were opened"""
+        host_info = lookup_host(host)
+        self.sessions.close_server({host, host_info["fqdn"], host_info["ip"]})
+
+    def _restart_done(self, state, status, message):
+        """Record the result of a host of the wave"""
+        host_result = state["result"]
+        host_result["status"] = status
+        host_result["duration"] = time.monotonic() - state["sent"] + host_result["duration"]
+        self._close_sessions(host_result["host"])
+
+        if status == c.HOST_SUCCESS:
+            host_result["stdout"] = message
+        else:
+            host_result["stderr"] = message
+
+        self._host_done(host_result)
+
+    def _not_restarted(self, state):
+        """The host is still up with the same boot time, so it doesn't count against the hosts
+        that can be down"""
+        self._restart_done(
+            state, c.HOST_FAILED, "Did not restart within %s seconds%s" % (
+                c.RESTART_DOWN_TIMEOUT, state["error"]
+            )
+        )
+
+    def _check(self, states, executor):
+        """Check each host once, returns the hosts that are finished and whether all came back"""
+        probes = probe_hosts(
+            host_targets({host: lookup_host(host) for host in states}, [self.port]),
+            self.args.probe_timeout
+        )
+        now = time.monotonic()
+        finished = []
+        came_back = True
+        to_check = []
+        boot_check = []
+
+        for host, state in states.items():
+            elapsed = now - state["sent"]
+            timings = state["result"]["timings"]
+            # Looked at one last time before giving up on the host
+            boot_due = elapsed > c.RESTART_DOWN_TIMEOUT or \
+                now - state["boot_checked"] >= c.RESTART_BOOT_CHECK_INTERVAL
+
+            if c.STAGE_DOWN not in timings:
+                if not probes[host]["reachable"]:
+                    timings[c.STAGE_DOWN] = elapsed
+                    self.logger.debug("rolling._check: %s is down after %.0fs", host, elapsed)
+                    # Dead now, the ready check has to open a new session
+                    self._close_sessions(host)
+                elif state["boot"] is not None and boot_due:
+                    state["boot_checked"] = now
+                    boot_check.append(host)
+                elif elapsed > c.RESTART_DOWN_TIMEOUT:
+                    self._not_restarted(state)
+                    finished.append(host)
+                continue
+
+            if elapsed > self.timeout:
+                self._restart_done(
+                    state, c.HOST_FAILED, "Not back within %s seconds of the restart" % self.timeout
+                )
+                finished.append(host)
+                came_back = False
+            elif probes[host]["reachable"]:
+                timings.setdefault(c.STAGE_BACK, elapsed - timings[c.STAGE_DOWN])
+                to_check.append(host)
+
+        # A host that came back between two checks has a new boot time, and as it answered
+        # it is ready too
+        for host, boot in zip(boot_check, executor.map(self._boot_time, boot_check)):
+            state = states[host]
+            elapsed = time.monotonic() - state["sent"]
+
+            if boot is not None and boot != state["boot"]:
+                self.logger.debug(
+                    "rolling._check: %s restarted at %s without being seen down", host, boot
+                )
+                state["result"]["timings"].update({
+                    c.STAGE_DOWN: elapsed, c.STAGE_BACK: 0.0, c.STAGE_READY: 0.0
+                })
+                self._restart_done(
+                    state, c.HOST_SUCCESS, "Restarted, ready after %.0f seconds" % elapsed
+                )
+                finished.append(host)
+            elif elapsed > c.RESTART_DOWN_TIMEOUT:
+                self._not_restarted(state)
+                finished.append(host)
+
+        # Answering on the port doesn't mean WinRM is ready, so open a session to be sure
+        for host, ready in zip(to_check, executor.map(self._is_ready, to_check)):
+            if ready:
+                state = states[host]
+                timings = state["result"]["timings"]
+                timings[c.STAGE_READY] = time.monotonic() - state["sent"] - \
+                    timings[c.STAGE_DOWN] - timings[c.STAGE_BACK]
+                self._restart_done(
+                    state, c.HOST_SUCCESS,
+                    "Restarted, ready after %.0f seconds" % (time.monotonic() - state["sent"])
+                )
+                finished.append(host)
+
+        return finished, came_back
+
+    def _run_wave(self, wave, command_detail):
+        """Restart the hosts of a wave and wait for them, returns False if any did not come
+        back"""
+        with ThreadPoolExecutor(max_workers=len(wave)) as executor:
+            # Read before the restart, so a host back before it is seen down can be told apart
+            boot_times = dict(zip(wave, executor.map(self._boot_time, wave)))
+            results = list(executor.map(
+                lambda host: run_host(self.logger, self.host_args, self.password, command_detail,
+                                      host), wave
+            ))
+
+            states = {}
+            for host_result in results:
+                # Nothing reached the host, so it is not restarting
+                if host_result["status"] != c.HOST_SUCCESS and host_result["retryable"]:
+                    self._host_done(host_result)
+                    continue
+
+                # The connection can drop as the host goes down, so watch it either way
+                sent = time.monotonic()
+                states[host_result["host"]] = {
+                    "result": host_result,
+                    "sent": sent,
+                    "boot": boot_times[host_result["host"]],
+                    "boot_checked": sent,
+                    "error": "" if host_result["status"] == c.HOST_SUCCESS else
+                             ": %s" % host_result["stderr"]
+                }
+
+            all_back = True
+
+            while len(states) > 0:
+                _start = time.monotonic()
+                finished, came_back = self._check(states, executor)
+                all_back = all_back and came_back
+
+                for host in finished:
+                    del states[host]
+
+                if len(states) > 0:
+                    time.sleep(max(0.0, c.RESTART_POLL_INTERVAL - (time.monotonic() - _start)))
+
+        return all_back
+
+    def run(self, command_detail):
+        """Restart the hosts wave by wave, stopping if a host does not come back"""
+        self._use_cache(command_detail)
+        live_hosts = self._live_hosts()
+        waves = [
+            live_hosts[i:i + self.wave_size] for i in range(0, len(live_hosts), self.wave_size)
+        ]
+        self.logger.info(
+            "Restarting %s hosts in %s waves of up to %s", len(live_hosts), len(waves),
+            self.wave_size
+        )
+
+        for index, wave in enumerate(waves):
+            self.logger.info("Wave %s of %s: %s", index + 1, len(waves), ", ".join(wave))
+
+            if self._run_wave(wave, command_detail):
+                continue
+
+            # Restarting more could take down more than max unavailable hosts
+            for host in [h for later in waves[index + 1:] for h in later]:
+                host_result = set_host_result(host)
+                host_result["start"] = time.time()
+                host_result["stderr"] = "Not restarted, a host of wave %s did not come back" % \
+                    (index + 1)
+                self._host_done(host_result)
+            break
+
+        flush_stores()
+
+        return self.counts[c.HOST_SUCCESS] == len(self.hosts)
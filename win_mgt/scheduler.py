@@ -0,0 +1,180 @@
+import time
+import random
+import threading
+
+import constants as c
+
+def connect_latency(host_result):
+    """Seconds it took to get a session (ticket plus connection), None if one was reused"""
+    timings = host_result.get("timings", {})
+    latency = timings.get(c.STAGE_KERBEROS, 0.0) + timings.get(c.STAGE_CONNECT, 0.0)
+
+    return latency if latency > 0 else None
+
+
+class CircuitBreaker:
+    """Stops connecting to hosts that keep failing, until they have had time to recover.
+    clock gives the time in seconds"""
+
+    def __init__(self, threshold, cooldown, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        # host: {"failures": failed attempts in a row, "opened": when the breaker opened}
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def allow(self, host):
+        """True if the host can be tried now. Once the cool down is over one attempt is let
+        through (half open), and its result closes the breaker or opens it again"""
+        with self.lock:
+            state = self.hosts.get(host, None)
+
+            if state is None or state["opened"] is None:
+                return True
+
+            if self.clock() - state["opened"] < self.cooldown:
+                return False
+
+            state["opened"] = None
+            state["failures"] = self.threshold - 1
+            return True
+
+    def remaining(self, host):
+        """Seconds until the breaker of a host lets an attempt through"""
+        with self.lock:
+            state = self.hosts.get(host, None)
+
+            if state is None or state["opened"] is None:
+                return 0.0
+
+            return max(0.0, self.cooldown - (self.clock() - state["opened"]))
+
+    def success(self, host):
+        """The command ran on the host"""
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def failure(self, host):
+        """The host could not be connected to, returns True if its breaker is now open"""
+        with self.lock:
+            state = self.hosts.setdefault(host, {"failures": 0, "opened": None})
+            state["failures"] += 1
+
+            if state["failures"] >= self.threshold:
+                state["opened"] = self.clock()
+
+            return state["opened"] is not None
+
+
+class AdaptiveLimit:
+    """How many hosts to run at once, AIMD style - up by one per round of good attempts, cut
+    when connections fail or get slow, never above the concurrency asked for"""
+
+    def __init__(self, maximum, adaptive=True):
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.limit = float(maximum)
+        self.latency = None
+        self.baseline = None
+        self.completed = 0
+        self.last_decrease = 0
+        self.lock = threading.Lock()
+
+    @property
+    def current(self):
+        """The limit as a number of hosts"""
+        return max(1, min(self.maximum, int(self.limit)))
+
+    def _congested(self, ok, latency):
+        """Did the attempt fail, or has the time to connect gone well past the best seen"""
+        if not ok:
+            return True
+
+        if latency is None:
+            return False
+
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += c.AIMD_EWMA_WEIGHT * (latency - self.latency)
+
+        if self.baseline is None:
+            self.baseline = self.latency
+        else:
+            self.baseline = min(self.baseline * (1 + c.AIMD_BASELINE_DRIFT), self.latency)
+
+        return self.latency > self.baseline * c.AIMD_LATENCY_FACTOR
+
+    def record(self, ok, latency=None):
+        """Adjust the limit for the outcome of an attempt, returns the new limit"""
+        with self.lock:
+            if not self.adaptive:
+                return self.current
+
+            self.completed += 1
+
+            if self._congested(ok, latency):
+                # The attempts still running were started at the old limit, so only cut once
+                # for each round of them
+                if self.completed - self.last_decrease >= self.current:
+                    self.limit = max(1.0, self.limit * c.AIMD_DECREASE)
+                    self.last_decrease = self.completed
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+
+            return self.current
+
+
+class Scheduler:
+    """Decides when each host of a fleet is tried - retries with jittered backoff, the circuit
+    breaker (of the fleet run) and the concurrency limit"""
+
+    def __init__(self, logger, args, concurrency, breaker):
+        self.logger = logger
+        self.retries = max(0, getattr(args, "retries", c.DEFAULT_RETRIES) or 0)
+        self.backoff = getattr(args, "retry_backoff", c.DEFAULT_RETRY_BACKOFF)
+        self.breaker = breaker
+        self.limit = AdaptiveLimit(concurrency, getattr(args, "adaptive_concurrency", True))
+        self.random = random.Random()
+
+    def allow(self, host):
+        """None if the host can be tried, otherwise why not"""
+        if self.breaker.allow(host):
+            return None
+
+        return "Not tried, the host keeps failing to connect (retry in %.0f seconds)" % \
+            self.breaker.remaining(host)
+
+    def _delay(self, attempt):
+        """Exponential backoff with jitter, so retries from many hosts don't arrive together"""
+        ceiling = min(c.RETRY_BACKOFF_MAX, self.backoff * 2 ** (attempt - 1))
+        return ceiling / 2 + self.random.uniform(0, ceiling / 2)
+
+    def done(self, host_result, attempt):
+        """Record the outcome of an attempt, returns the seconds to wait before trying the host
+        again, or None if it is finished"""
+        host = host_result["host"]
+        succeeded = host_result["status"] == c.HOST_SUCCESS
+        previous = self.limit.current
+        limit = self.limit.record(succeeded, connect_latency(host_result))
+
+        if limit != previous:
+            self.logger.debug("scheduler.done: Concurrency limit now %s", limit)
+
+        if succeeded:
+            self.breaker.success(host)
+            return None
+
+        # Failures after connecting (authentication, the command) are not worth a retry
+        if not host_result.get("retryable", False):
+            return None
+
+        if self.breaker.failure(host):
+            self.logger.debug("scheduler.done: Circuit breaker open for %s", host)
+            return None
+
+        if attempt > self.retries:
+            return None
+
+        return self._delay(attempt)
@@ -0,0 +1,201 @@
+import atexit
+import threading
+import time
+
+import constants as c
+
+_MANAGER = None
+_MANAGER_LOCK = threading.Lock()
+
+def session_key(kwargs, kind=c.SESSION_POOL):
+    """Sessions are shared between connections to the same server, port, user and auth. A
+    session is a RunspacePool (PowerShell) or a cmd shell (raw commands)"""
+    return (kwargs["server"], kwargs["port"], kwargs["username"], kwargs["auth"], kind)
+
+def get_session_manager(logger, args=None):
+    """Return the session manager shared by every transport in this process"""
+    global _MANAGER
+
+    with _MANAGER_LOCK:
+        if _MANAGER is None:
+            idle_timeout = getattr(args, "session_idle_timeout", c.DEFAULT_SESSION_IDLE_TIMEOUT)
+            max_sessions = getattr(args, "max_sessions", c.DEFAULT_MAX_SESSIONS)
+            _MANAGER = SessionManager(logger, idle_timeout, max_sessions)
+            # Make sure remote shells are removed when we exit, not when WinRM times them out
+            atexit.register(_MANAGER.close_all)
+
+    return _MANAGER
+
+
+class SessionManager:
+    def __init__(self, logger, idle_timeout, max_sessions, clock=time.monotonic):
+        self.logger = logger
+        # Gives the time in seconds
+        self.clock = clock
+        self.idle_timeout = idle_timeout if idle_timeout is not None and idle_timeout > 0 else \
+            c.DEFAULT_SESSION_IDLE_TIMEOUT
+        self.max_sessions = max_sessions if max_sessions is not None and max_sessions > 0 else \
+            c.DEFAULT_MAX_SESSIONS
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def _set_session(self, key, pool):
+        """Use a dictionary for each session"""
+        return {
+            "key": key,
+            "pool": pool,
+            "in_use": True,
+            "opened": self.clock(),
+            "last_used": self.clock(),
+            "uses": 1
+        }
+
+    def _close_pool(self, session):
+        """Close the remote shell of a session"""
+        try:
+            session["pool"].close()
+            self.logger.debug("session._close_pool: Closed session for %s", session["key"][0])
+        except Exception as e:
+            self.logger.debug(
+                "session._close_pool: Error %s closing session for %s: %s",
+                type(e), session["key"][0], str(e)
+            )
+
+    def _find(self, pool):
+        """Find the session holding a pool"""
+        for session in self.sessions:
+            if session["pool"] is pool:
+                return session
+
+        return None
+
+    def _expired(self):
+        """Remove sessions that have not been used for a while, return them for closing"""
+        now = self.clock()
+        expired = [
+            s for s in self.sessions
+            if not s["in_use"] and now - s["last_used"] > self.idle_timeout
+        ]
+
+        for session in expired:
+            self.sessions.remove(session)
+
+        return expired
+
+    def _make_room(self):
+        """At the limit, remove the least recently used idle session, return it for closing"""
+        if len(self.sessions) < self.max_sessions:
+            return []
+
+        idle = [s for s in self.sessions if not s["in_use"]]
+
+        if len(idle) == 0:
+            return []
+
+        oldest = min(idle, key=lambda s: s["last_used"])
+        self.sessions.remove(oldest)
+
+        return [oldest]
+
+    def acquire(self, kwargs, open_func, kind=c.SESSION_POOL):
+        """Get an open pool (or shell) for the connection, open_func is called to open a new
+        one"""
+        key = session_key(kwargs, kind)
+
+        with self.lock:
+            to_close = self._expired()
+            session = None
+
+            for s in self.sessions:
+                if s["key"] == key and not s["in_use"]:
+                    session = s
+                    break
+
+            if session is not None:
+                session["in_use"] = True
+                session["last_used"] = self.clock()
+                session["uses"] += 1
+
+        for s in to_close:
+            self._close_pool(s)
+
+        if session is not None:
+            self.logger.debug(
+                "session.acquire: Reusing session for %s (use %s)", key[0], session["uses"]
+            )
+            return session["pool"]
+
+        # Opening can take a while (auth, shell creation), so do it outside the lock
+        pool = open_func()
+
+        with self.lock:
+            to_close = self._make_room()
+
+            if len(self.sessions) < self.max_sessions:
+                self.sessions.append(self._set_session(key, pool))
+            else:
+                self.logger.debug(
+                    "session.acquire: Maximum of %s sessions reached, session for %s will not "
+                    "be kept", self.max_sessions, key[0]
+                )
+
+        for s in to_close:
+            self._close_pool(s)
+
+        return pool
+
+    def release(self, pool, close=False):
+        """Give back a pool when done with it, closing it if asked to or if it is not kept"""
+        with self.lock:
+            session = self._find(pool)
+
+            if session is not None:
+                if close:
+                    self.sessions.remove(session)
+                else:
+                    session["in_use"] = False
+                    session["last_used"] = self.clock()
+
+            to_close = self._expired()
+
+        if session is None:
+            # Not kept by the manager, so nobody else will close it
+            to_close.append({"key": ("unmanaged",), "pool": pool})
+        elif close:
+            to_close.append(session)
+
+        for s in to_close:
+            self._close_pool(s)
+
+    def close_idle(self):
+        """Close sessions that have been idle for longer than the idle timeout"""
+        with self.lock:
+            to_close = self._expired()
+
+        for s in to_close:
+            self._close_pool(s)
+
+        return len(to_close)
+
+    def close_server(self, names):
+        """Close the idle sessions to a server, any of names (its name, FQDN or IP) - e.g.
+        once it has restarted and they are dead"""
+        with self.lock:
+            to_close = [s for s in self.sessions if not s["in_use"] and s["key"][0] in names]
+
+            for session in to_close:
+                self.sessions.remove(session)
+
+        for s in to_close:
+            self._close_pool(s)
+
+        return len(to_close)
+
+    def close_all(self):
+        """Close every session - used on exit"""
+        with self.lock:
+            to_close = self.sessions
+            self.sessions = []
+
+        for s in to_close:
+            self._close_pool(s)
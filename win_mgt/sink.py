@@ -0,0 +1,106 @@
+import threading
+import json
+import csv
+import os
+
+import constants as c
+
+def get_format(file_name, results_format=None):
+    """The format asked for, or the one matching the file extension (JSONL if unknown)"""
+    if results_format is not None:
+        return results_format
+
+    extension = os.path.splitext(file_name)[1].lower().lstrip(".")
+    return c.SINK_CSV if extension == c.SINK_CSV else c.SINK_JSONL
+
+def get_sink(logger, file_name, results_format=None):
+    """Open the right sink for the results file"""
+    if get_format(file_name, results_format) == c.SINK_CSV:
+        return CsvSink(logger, file_name)
+
+    return JsonlSink(logger, file_name)
+
+
+class ResultSink:
+    """Appends each host result to a file as soon as it is written, nothing is kept in memory"""
+    fields = c.SINK_FIELDS
+
+    def __init__(self, logger, file_name):
+        self.logger = logger
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.fh = self._open()
+
+    def _open(self):
+        """Open the file for appending, buffered"""
+        return open(
+            self.file_name, "a", buffering=c.SINK_BUFFER_SIZE, newline="", encoding="utf-8"
+        )
+
+    def _set_record(self, host_result):
+        """Only the fields we write, in a fixed order"""
+        return {k: host_result.get(k, None) for k in self.fields}
+
+    def _write(self, record):
+        """Write one record - done by each format"""
+        raise NotImplementedError
+
+    def write(self, host_result):
+        """Write the result of one host, can be called from any thread"""
+        with self.lock:
+            self._write(self._set_record(host_result))
+            self.count += 1
+
+    def close(self):
+        """Flush and close the file"""
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+        self.logger.debug("sink.close: Wrote %s results to %s", self.count, self.file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class JsonlSink(ResultSink):
+    """One JSON object per line, including the attempts made and the stage timings"""
+    fields = c.SINK_FIELDS + ["attempts", "timings"]
+
+    def _set_record(self, host_result):
+        """Whether the output changed, and how, if the digest store was used, and whether it
+        came from the result cache"""
+        record = super()._set_record(host_result)
+
+        if host_result.get("changed", None) is not None:
+            record.update({k: host_result[k] for k in c.SINK_DIGEST_FIELDS})
+
+        if host_result.get("cached", False):
+            record.update({k: host_result[k] for k in c.SINK_CACHE_FIELDS})
+
+        return record
+
+    def _write(self, record):
+        self.fh.write(json.dumps(record))
+        self.fh.write("\n")
+
+
+class CsvSink(ResultSink):
+    """CSV with a header row, the header is only written to a new (empty) file"""
+
+    def _open(self):
+        fh = super()._open()
+        self.writer = csv.DictWriter(fh, fieldnames=c.SINK_FIELDS)
+
+        if fh.tell() == 0:
+            self.writer.writeheader()
+
+        return fh
+
+    def _write(self, record):
+        self.writer.writerow(record)
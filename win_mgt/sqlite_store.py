@@ -0,0 +1,119 @@
+import os
+import atexit
+import sqlite3
+import threading
+
+# The store of each class, shared by everything in this process
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+def get_store(logger, store_class, path, *params):
+    """Return the store of store_class shared by everything in this process, opening it on
+    path (with params) the first time. None if there is no path or it can't be opened"""
+    with _STORES_LOCK:
+        store = _STORES.get(store_class, None)
+
+        if store is None and path:
+            try:
+                store = store_class(logger, path, *params)
+            except (sqlite3.Error, OSError) as e:
+                logger.warning("Unable to open the %s %s: %s", store_class.NAME, path, str(e))
+                return None
+
+            _STORES[store_class] = store
+            # What is not yet written goes out when we exit
+            atexit.register(store.close)
+
+    return store
+
+def flush_stores():
+    """Write what every open store holds, for processes that don't exit through atexit"""
+    with _STORES_LOCK:
+        stores = list(_STORES.values())
+
+    for store in stores:
+        store.flush()
+
+
+class SqliteStore:
+    """A SQLite file shared by the jobs and worker processes on the machine. Writes are held in
+    pending and written in one transaction by flush
+
+    Subclasses give the NAME used in messages, the SCHEMA statements and the DB_TIMEOUT to wait
+    for other processes' writes, and write what they hold in _write"""
+
+    NAME = "store"
+    SCHEMA = []
+    DB_TIMEOUT = 30
+
+    def __init__(self, logger, path):
+        self.logger = logger
+        self.path = os.path.expanduser(path)
+        folder = os.path.dirname(self.path)
+
+        if len(folder) > 0:
+            os.makedirs(folder, exist_ok=True)
+
+        # Other processes open the same file, so wait for each other's writes
+        self.db = sqlite3.connect(self.path, timeout=self.DB_TIMEOUT, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+
+        self.db.commit()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def _select_servers(self, sql, params, servers, batch_size):
+        """Run a SELECT whose "server IN (%s)" is filled in batch_size servers at a time, returns
+        the rows. Called with the lock held"""
+        rows = []
+
+        try:
+            for i in range(0, len(servers), batch_size):
+                batch = servers[i:i + batch_size]
+                rows.extend(self.db.execute(
+                    sql % ", ".join("?" * len(batch)), list(params) + batch
+                ).fetchall())
+        except sqlite3.Error as e:
+            self.logger.warning("Unable to read the %s: %s", self.NAME, str(e))
+
+        return rows
+
+    def _take_pending(self):
+        """Hand over what is to be written, None if there is nothing. Called with the lock held"""
+        pending = self.pending
+        self.pending = {}
+
+        return pending if len(pending) > 0 else None
+
+    def _write(self, pending):
+        """Write what _take_pending handed over, inside the transaction. Returns what was done,
+        for the debug log"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Write what is pending in one transaction"""
+        with self.lock:
+            pending = self._take_pending()
+
+            if pending is None:
+                return True
+
+            try:
+                with self.db:
+                    done = self._write(pending)
+            except sqlite3.Error as e:
+                self.logger.warning("Unable to write the %s: %s", self.NAME, str(e))
+                return False
+
+        self.logger.debug("%s.flush: %s", type(self).__module__, done)
+        return True
+
+    def close(self):
+        """Write anything pending and close the file"""
+        self.flush()
+
+        with self.lock:
+            self.db.close()
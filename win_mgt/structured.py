@@ -0,0 +1,33 @@
+import json
+
+from utilities import ps_quote
+
+# Each object becomes one line of compact JSON. Enums are sent by name rather than number
+# and nested objects are not expanded, which keeps the lines short.
+_TO_JSON = (
+    "ForEach-Object { $o = [ordered]@{}; foreach ($p in $_.PSObject.Properties) { "
+    "$v = $p.Value; if ($v -is [System.Enum]) { $v = $v.ToString() }; $o[$p.Name] = $v }; "
+    "ConvertTo-Json -InputObject $o -Compress -Depth 1 }"
+)
+
+def build_script(command, properties=None):
+    """Build a script returning the objects of the command as JSON, one object per line"""
+    script = "Invoke-Expression -Command %s" % ps_quote(command)
+
+    if properties:
+        script += " | Select-Object -Property %s" % ",".join(ps_quote(p) for p in properties)
+
+    return "%s | %s" % (script, _TO_JSON)
+
+def parse_lines(lines):
+    """Turn the JSON lines back into dictionaries, one at a time"""
+    for line in lines:
+        if line is None:
+            continue
+
+        line = str(line).strip()
+
+        if len(line) == 0:
+            continue
+
+        yield json.loads(line)
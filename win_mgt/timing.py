@@ -0,0 +1,140 @@
+import os
+import json
+import math
+import time
+import contextlib
+
+import constants as c
+
+def get_format(file_name, metrics_format=None):
+    """The format asked for, or the one matching the file extension (JSON if unknown)"""
+    if metrics_format is not None:
+        return metrics_format
+
+    extension = os.path.splitext(file_name)[1].lower()
+    return c.METRICS_PROMETHEUS if extension == c.METRICS_PROMETHEUS_EXTENSION else \
+        c.METRICS_JSON
+
+def percentile(values, pct):
+    """Nearest rank percentile of a list of numbers - the smallest value with at least pct
+    percent of the values at or below it"""
+    ordered = sorted(values)
+    rank = int(math.ceil(pct * len(ordered) / 100.0))
+    return ordered[max(1, min(len(ordered), rank)) - 1]
+
+def aggregate(host_timings):
+    """Percentiles per stage across hosts, host_timings is a list of {stage: seconds}"""
+    stages = {}
+
+    for timings in host_timings:
+        for stage, seconds in timings.items():
+            stages.setdefault(stage, []).append(seconds)
+
+    report = {}
+    for stage in sorted(stages, key=_stage_order):
+        values = stages[stage]
+        report[stage] = {"count": len(values), "sum": sum(values), "max": max(values)}
+
+        for pct in c.METRICS_PERCENTILES:
+            report[stage]["p%s" % pct] = percentile(values, pct)
+
+    return report
+
+def _stage_order(stage):
+    """Stages in the order they happen, any others after"""
+    if stage in c.STAGES:
+        return (c.STAGES.index(stage), stage)
+
+    return (len(c.STAGES), stage)
+
+def build_report(host_timings, counts=None):
+    """The metrics report for a run"""
+    return {
+        "timestamp": time.time(),
+        "hosts": len(host_timings),
+        "counts": counts or {},
+        "stages": aggregate(host_timings)
+    }
+
+def _format_json(report):
+    """Report as JSON"""
+    return json.dumps(report, indent=2) + "\n"
+
+def _format_prometheus(report):
+    """Report in the Prometheus text format, for the node exporter textfile collector"""
+    name = "%s_stage_seconds" % c.METRICS_PREFIX
+    lines = [
+        "# HELP %s Time spent in each stage of connecting to and running on a host" % name,
+        "# TYPE %s summary" % name
+    ]
+
+    for stage, values in report["stages"].items():
+        for pct in c.METRICS_PERCENTILES:
+            lines.append('%s{stage="%s",quantile="%s"} %.6f' % (
+                name, stage, pct / 100.0, values["p%s" % pct]
+            ))
+
+        lines.append('%s_sum{stage="%s"} %.6f' % (name, stage, values["sum"]))
+        lines.append('%s_count{stage="%s"} %d' % (name, stage, values["count"]))
+
+    if len(report["counts"]) > 0:
+        lines.append("# HELP %s_hosts Hosts by result of the last run" % c.METRICS_PREFIX)
+        lines.append("# TYPE %s_hosts gauge" % c.METRICS_PREFIX)
+
+        for status, count in report["counts"].items():
+            lines.append('%s_hosts{status="%s"} %d' % (c.METRICS_PREFIX, status, count))
+
+    lines.append("# HELP %s_last_run_timestamp_seconds When the last run finished"
+                 % c.METRICS_PREFIX)
+    lines.append("# TYPE %s_last_run_timestamp_seconds gauge" % c.METRICS_PREFIX)
+    lines.append("%s_last_run_timestamp_seconds %.3f" % (c.METRICS_PREFIX, report["timestamp"]))
+
+    return "\n".join(lines) + "\n"
+
+def write_report(logger, report, file_name, metrics_format=None):
+    """Write the report, via a temporary file so a collector never reads half a file"""
+    if get_format(file_name, metrics_format) == c.METRICS_PROMETHEUS:
+        data = _format_prometheus(report)
+    else:
+        data = _format_json(report)
+
+    temp_name = "%s.%s.tmp" % (file_name, os.getpid())
+
+    try:
+        with open(temp_name, "w", encoding="utf-8") as fh:
+            fh.write(data)
+
+        os.replace(temp_name, file_name)
+    except OSError as e:
+        logger.warning("timing.write_report: Unable to write metrics to %s: %s", file_name, str(e))
+        return False
+
+    return True
+
+def show_timings(logger, timings):
+    """Debug log of the stage timings of one host"""
+    if len(timings) == 0:
+        return
+
+    _msg = "Stage timings\n\n"
+    for stage in sorted(timings, key=_stage_order):
+        _msg += "  %-10s %8.1fms\n" % (stage, timings[stage] * 1000)
+
+    logger.debug(_msg)
+
+
+class StageTimer:
+    """Monotonic time spent in each stage, a stage run more than once is added up"""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the block of code as stage name"""
+        _start = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.monotonic() - _start
@@ -0,0 +1,553 @@
+import os
+import json
+import time
+import ntpath
+import hashlib
+import collections
+
+from pypsrp.powershell import PowerShell
+
+import constants as c
+
+# Scripts run on the host. Offsets and lengths are passed as strings, pypsrp sends a Python int
+# as an Int32 which is too small for offsets past 2 GB
+_HASH = "[System.BitConverter]::ToString($sha.ComputeHash($buf, 0, $read)).Replace('-', '')"
+
+# A destination that is an existing folder gets the name of the file added, and the path to
+# copy to is given back first. Make sure the folder exists, then give back the offsets of the
+# ranges the partly copied file still holds with the same checksum
+PUSH_PREPARE_SCRIPT = """param([string]$Path, [string]$Name, [string]$Suffix, [string]$Ranges)
+if (Test-Path -LiteralPath $Path -PathType Container) {
+    $Path = [System.IO.Path]::Combine($Path, $Name)
+}
+$Path
+$Part = $Path + $Suffix
+$dir = [System.IO.Path]::GetDirectoryName($Part)
+if ($dir -and -not (Test-Path -LiteralPath $dir)) {
+    New-Item -ItemType Directory -Path $dir -Force | Out-Null
+}
+if (-not (Test-Path -LiteralPath $Part)) { return }
+$sha = [System.Security.Cryptography.SHA256]::Create()
+$fs = [System.IO.File]::Open($Part, 'Open', 'Read', 'ReadWrite')
+try {
+    foreach ($range in ($Ranges | ConvertFrom-Json)) {
+        $length = [int]$range.l
+        if ([long]$range.o + $length -gt $fs.Length) { continue }
+        $buf = New-Object byte[] $length
+        [void]$fs.Seek([long]$range.o, 'Begin')
+        $read = 0
+        while ($read -lt $length) {
+            $n = $fs.Read($buf, $read, $length - $read)
+            if ($n -le 0) { break }
+            $read += $n
+        }
+        if (%s -eq $range.h) { [string]$range.o }
+    }
+} finally {
+    $fs.Dispose()
+}
+""" % _HASH
+
+# Check the chunk arrived intact before writing it at its offset - the file is shared so the
+# other runspaces can write their chunks at the same time
+PUSH_CHUNK_SCRIPT = """param([string]$Part, [string]$Offset, [byte[]]$Data, [string]$Hash)
+$sha = [System.Security.Cryptography.SHA256]::Create()
+$buf = $Data
+$read = $Data.Length
+if (%s -ne $Hash) { throw "Checksum mismatch for the chunk at $Offset" }
+$fs = [System.IO.File]::Open($Part, 'OpenOrCreate', 'Write', 'ReadWrite')
+try {
+    [void]$fs.Seek([long]$Offset, 'Begin')
+    $fs.Write($Data, 0, $Data.Length)
+} finally {
+    $fs.Dispose()
+}
+""" % _HASH
+
+PUSH_FINISH_SCRIPT = """param([string]$Part, [string]$Path, [string]$Length)
+if (Test-Path -LiteralPath $Path -PathType Container) { throw "$Path is a folder" }
+$fs = [System.IO.File]::Open($Part, 'OpenOrCreate', 'Write', 'ReadWrite')
+try {
+    $fs.SetLength([long]$Length)
+} finally {
+    $fs.Dispose()
+}
+Move-Item -LiteralPath $Part -Destination $Path -Force
+"""
+
+# The size and last write time of the file, which tell whether a journal is for this version
+PULL_PREPARE_SCRIPT = """param([string]$Path)
+$item = Get-Item -LiteralPath $Path -Force -ErrorAction Stop
+if ($item.PSIsContainer) { throw "$Path is a folder, only files can be pulled" }
+[string]$item.Length
+[string]$item.LastWriteTimeUtc.Ticks
+"""
+
+# The checksum then the data, the comma keeps PowerShell from sending the bytes one by one
+PULL_CHUNK_SCRIPT = """param([string]$Path, [string]$Offset, [int]$Length)
+$buf = New-Object byte[] $Length
+$fs = [System.IO.File]::Open($Path, 'Open', 'Read', 'ReadWrite')
+try {
+    [void]$fs.Seek([long]$Offset, 'Begin')
+    $read = 0
+    while ($read -lt $Length) {
+        $n = $fs.Read($buf, $read, $Length - $read)
+        if ($n -le 0) { break }
+        $read += $n
+    }
+} finally {
+    $fs.Dispose()
+}
+if ($read -ne $Length) { throw "Only $read of $Length bytes could be read at $Offset" }
+$sha = [System.Security.Cryptography.SHA256]::Create()
+%s
+,$buf
+""" % _HASH
+
+
+class TransferError(Exception):
+    """A transfer that could not be finished, what was copied is kept so it can be resumed"""
+
+
+def checksum(data):
+    """SHA256 of a chunk, in the form PowerShell gives it"""
+    return hashlib.sha256(data).hexdigest().upper()
+
+def get_gaps(size, done):
+    """The (start, end) byte ranges of a file of size not covered by the done chunks"""
+    gaps = []
+    position = 0
+
+    for offset, length in sorted((chunk[0], chunk[1]) for chunk in done):
+        if offset > position:
+            gaps.append((position, offset))
+
+        position = max(position, offset + length)
+
+    if position < size:
+        gaps.append((position, size))
+
+    return gaps
+
+
+class ChunkTuner:
+    """Picks the chunk size from the throughput of the chunks as they complete
+
+    The size is doubled while each doubling is faster, then goes back to the best size and
+    stays there. A large drop in throughput after that starts the search again"""
+
+    def __init__(self, size, sample_chunks):
+        self.size = max(c.TRANSFER_CHUNK_MIN, min(size, c.TRANSFER_CHUNK_MAX))
+        self.sample_chunks = sample_chunks
+        # Chunks handed out at the current size, those of an earlier size are not measured
+        self.generation = 0
+        self.rate = 0.0
+        self.settled = False
+        self._start = None
+        self._bytes = 0
+        self._chunks = 0
+
+    def chunk_done(self, length, generation):
+        """Count a completed chunk, the size is looked at again after sample_chunks of them"""
+        if generation != self.generation:
+            return
+
+        now = time.monotonic()
+
+        # Chunks complete one after the other, so timing runs from the first completion
+        if self._start is None:
+            self._start = now
+            return
+
+        self._bytes += length
+        self._chunks += 1
+
+        if self._chunks >= self.sample_chunks:
+            self._resize(self._bytes / max(now - self._start, 1e-6))
+
+    def _resize(self, rate):
+        """Move to the next size to try, or stay put"""
+        previous = self.size
+
+        if self.settled:
+            if rate < self.rate * (1 - c.TRANSFER_TUNE_RESET):
+                self.settled = False
+                self.rate = rate
+        elif rate > self.rate * (1 + c.TRANSFER_TUNE_MARGIN):
+            self.rate = rate
+            self.size = min(self.size * 2, c.TRANSFER_CHUNK_MAX)
+            self.settled = self.size == previous
+        else:
+            # No better than the size before, which is the one to keep
+            self.size = max(self.size // 2, c.TRANSFER_CHUNK_MIN)
+            self.settled = True
+
+        self._start = None
+        self._bytes = 0
+        self._chunks = 0
+
+        if self.size != previous:
+            self.generation += 1
+
+
+class FileTransfer:
+    """Copies a file to (push) or from (pull) a host in chunks over an open RunspacePool
+
+    Up to streams chunks are in flight at once, each in its own pipeline, so the host works
+    on one chunk while the next is being sent. Every chunk is checked against its SHA256 on
+    arrival and progress is kept in a journal, so an interrupted transfer only sends what is
+    missing when run again"""
+
+    def __init__(self, logger, args, runspacepool, server):
+        self.logger = logger
+        self.runspacepool = runspacepool
+        self.server = server
+        self.streams = self._set_streams(
+            getattr(args, "transfer_streams", c.DEFAULT_TRANSFER_STREAMS)
+        )
+        chunk_kb = getattr(args, "transfer_chunk_kb", None) or c.DEFAULT_TRANSFER_CHUNK_KB
+        self.tuner = ChunkTuner(chunk_kb * 1024, self.streams * 2)
+        self.journal_path = None
+        self.identity = None
+        # (offset, length, checksum) of each chunk copied
+        self.done = []
+        self.resumed = 0
+        # The destination once a folder has been turned into a file path
+        self.destination = None
+        # Set if the pool could not be given back as it was, so it should not be reused
+        self.pool_changed = False
+
+    def _set_streams(self, streams):
+        """Keep the number of chunks in flight within sensible limits"""
+        if streams is None or streams < 1:
+            return c.DEFAULT_TRANSFER_STREAMS
+
+        return min(streams, c.MAX_TRANSFER_STREAMS)
+
+    def _load_journal(self, identity):
+        """Chunks copied by an earlier run of the same transfer, if there was one"""
+        key = hashlib.sha1(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+        self.identity = identity
+        self.journal_path = os.path.join(
+            os.path.expanduser(c.TRANSFER_STATE_DIR), "%s.json" % key
+        )
+
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as fh:
+                journal = json.load(fh)
+        except (OSError, ValueError):
+            return []
+
+        if journal.get("identity", None) != identity:
+            return []
+
+        return [tuple(chunk) for chunk in journal.get("chunks", [])]
+
+    def save_journal(self):
+        """Write out the chunks copied so far"""
+        if self.journal_path is None:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.journal_path), mode=0o700, exist_ok=True)
+            temp_path = "%s.tmp" % self.journal_path
+
+            with open(temp_path, "w", encoding="utf-8") as fh:
+                json.dump({"identity": self.identity, "chunks": self.done}, fh)
+
+            os.replace(temp_path, self.journal_path)
+        except OSError as e:
+            self.logger.warning(
+                "transfer.save_journal: Unable to save the progress to %s: %s",
+                self.journal_path, str(e)
+            )
+
+    def _clear_journal(self):
+        """The transfer is complete, nothing to resume"""
+        try:
+            os.unlink(self.journal_path)
+        except OSError:
+            pass
+
+    def _restore_runspaces(self, max_runspaces):
+        """Give the pool back the number of runspaces it had, pool_changed is set if that
+        could not be done"""
+        if self.runspacepool.max_runspaces == max_runspaces:
+            return
+
+        try:
+            self.runspacepool.max_runspaces = max_runspaces
+        except Exception as e:
+            self.pool_changed = True
+            self.logger.warning(
+                "transfer._restore_runspaces: Unable to set the runspaces of the pool on %s "
+                "back to %s: %s", self.server, max_runspaces, str(e)
+            )
+
+    def _run_script(self, script, parameters):
+        """Run a script and wait for it, returns its output"""
+        ps = PowerShell(self.runspacepool)
+        ps.add_script(script).add_parameters(parameters)
+        output = ps.invoke()
+
+        if ps.had_errors:
+            error = ps.streams.error[0] if len(ps.streams.error) > 0 else "unknown error"
+            raise TransferError(str(error))
+
+        return output
+
+    def _begin_script(self, script, parameters):
+        """Start a script without waiting for it"""
+        ps = PowerShell(self.runspacepool)
+        ps.add_script(script).add_parameters(parameters)
+        ps.begin_invoke()
+
+        return ps
+
+    def _chunks(self, gaps):
+        """(offset, length) of each chunk to copy, the size is asked for as each is handed out"""
+        for start, end in gaps:
+            offset = start
+
+            while offset < end:
+                length = min(self.tuner.size, end - offset)
+                yield offset, length
+                offset += length
+
+    def _chunk_done(self, offset, length, chunk_hash, generation):
+        """Keep track of a copied chunk"""
+        self.done.append((offset, length, chunk_hash))
+        self.tuner.chunk_done(length, generation)
+
+        if len(self.done) % c.TRANSFER_JOURNAL_EVERY == 0:
+            self.save_journal()
+
+    def _copy(self, size, start_chunk, finish_chunk):
+        """Copy whatever is not done yet, keeping up to streams chunks in flight
+
+        start_chunk(offset, length) starts the pipeline for a chunk and returns it, and
+        finish_chunk(started, offset, length) waits for it, returning the checksum of the chunk
+        or None if it has to be copied again"""
+        chunks = self._chunks(get_gaps(size, self.done))
+        in_flight = collections.deque()
+        again = collections.deque()
+        failures = collections.Counter()
+
+        while True:
+            while len(in_flight) < self.streams:
+                chunk = again.popleft() if len(again) > 0 else next(chunks, None)
+
+                if chunk is None:
+                    break
+
+                offset, length = chunk
+                in_flight.append(
+                    (start_chunk(offset, length), offset, length, self.tuner.generation)
+                )
+
+            if len(in_flight) == 0:
+                return
+
+            started, offset, length, generation = in_flight.popleft()
+            chunk_hash = finish_chunk(started, offset, length)
+
+            if chunk_hash is not None:
+                self._chunk_done(offset, length, chunk_hash, generation)
+                continue
+
+            failures[offset] += 1
+
+            if failures[offset] > c.TRANSFER_CHUNK_RETRIES:
+                raise TransferError(
+                    "The chunk at %s failed %s times, giving up" % (offset, failures[offset])
+                )
+
+            again.append((offset, length))
+
+    def _pipeline_error(self, ps, offset):
+        """Log why a chunk failed, returns True if it did"""
+        if not ps.had_errors:
+            return False
+
+        error = ps.streams.error[0] if len(ps.streams.error) > 0 else "unknown error"
+        self.logger.warning(
+            "transfer._pipeline_error: The chunk at %s failed on %s, it will be copied again: %s",
+            offset, self.server, str(error)
+        )
+        return True
+
+    def _verify_remote(self, destination, name, chunks):
+        """Create the destination folder and keep only the chunks the host still has. Returns
+        the path to copy to, which has the file name added if destination is a folder"""
+        ranges = json.dumps([{"o": str(o), "l": l, "h": h} for o, l, h in chunks])
+        output = self._run_script(PUSH_PREPARE_SCRIPT, {
+            "Path": destination, "Name": name, "Suffix": c.TRANSFER_PART_SUFFIX,
+            "Ranges": ranges
+        })
+
+        if len(output) == 0:
+            raise TransferError("%s did not say where to copy %s" % (self.server, destination))
+
+        verified = set(int(o) for o in output[1:])
+
+        return str(output[0]), [chunk for chunk in chunks if chunk[0] in verified]
+
+    def _verify_local(self, fh, chunks):
+        """Keep only the chunks the partly copied local file still has"""
+        verified = []
+
+        for offset, length, chunk_hash in chunks:
+            fh.seek(offset)
+
+            if checksum(fh.read(length)) == chunk_hash:
+                verified.append((offset, length, chunk_hash))
+
+        return verified
+
+    def push(self, source, destination):
+        """Copy a local file to the host, returns the number of bytes sent"""
+        try:
+            stat = os.stat(source)
+        except OSError as e:
+            raise TransferError("Unable to read %s: %s" % (source, str(e))) from e
+
+        # A folder on the host keeps the name of the file, one given without a trailing slash
+        # is found by the prepare script
+        if destination.endswith(("\\", "/")):
+            destination += os.path.basename(source)
+
+        journal = self._load_journal({
+            "server": self.server, "direction": c.TRANSFER_PUSH,
+            "source": os.path.abspath(source), "destination": destination,
+            "size": stat.st_size, "modified": stat.st_mtime
+        })
+        destination, self.done = self._verify_remote(
+            destination, os.path.basename(source), journal
+        )
+        self.destination = destination
+        part = destination + c.TRANSFER_PART_SUFFIX
+        self.resumed = sum(chunk[1] for chunk in self.done)
+
+        with open(source, "rb") as fh:
+            def start_chunk(offset, length):
+                """Read the chunk from disk and send it"""
+                fh.seek(offset)
+                data = fh.read(length)
+
+                if len(data) != length:
+                    raise TransferError("%s changed while it was being copied" % source)
+
+                chunk_hash = checksum(data)
+                ps = self._begin_script(PUSH_CHUNK_SCRIPT, {
+                    "Part": part, "Offset": str(offset), "Data": data, "Hash": chunk_hash
+                })
+                return ps, chunk_hash
+
+            def finish_chunk(started, offset, _length):
+                """Wait for the host to write the chunk"""
+                ps, chunk_hash = started
+                ps.end_invoke()
+
+                return None if self._pipeline_error(ps, offset) else chunk_hash
+
+            self._copy(stat.st_size, start_chunk, finish_chunk)
+
+        self._run_script(PUSH_FINISH_SCRIPT, {
+            "Part": part, "Path": destination, "Length": str(stat.st_size)
+        })
+        self._clear_journal()
+
+        return stat.st_size - self.resumed
+
+    def pull(self, source, destination):
+        """Copy a file from the host, returns the number of bytes received"""
+        size, modified = self._run_script(PULL_PREPARE_SCRIPT, {"Path": source})[:2]
+        size = int(size)
+
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, ntpath.basename(source))
+
+        self.destination = destination
+        part = destination + c.TRANSFER_PART_SUFFIX
+        journal = self._load_journal({
+            "server": self.server, "direction": c.TRANSFER_PULL, "source": source,
+            "destination": os.path.abspath(destination), "size": size, "modified": modified
+        })
+
+        try:
+            fh = open(part, "r+b" if os.path.exists(part) else "w+b")
+        except OSError as e:
+            raise TransferError("Unable to write %s: %s" % (part, str(e))) from e
+
+        with fh:
+            self.done = self._verify_local(fh, journal)
+            self.resumed = sum(chunk[1] for chunk in self.done)
+
+            def start_chunk(offset, length):
+                """Ask the host for the chunk"""
+                return self._begin_script(PULL_CHUNK_SCRIPT, {
+                    "Path": source, "Offset": str(offset), "Length": length
+                })
+
+            def finish_chunk(ps, offset, length):
+                """Check the chunk against its checksum and write it at its offset"""
+                output = ps.end_invoke()
+
+                if self._pipeline_error(ps, offset):
+                    return None
+
+                if len(output) != 2 or not isinstance(output[1], bytes) or \
+                        len(output[1]) != length or checksum(output[1]) != output[0]:
+                    self.logger.warning(
+                        "transfer.finish_chunk: The chunk at %s from %s does not match its "
+                        "checksum, it will be asked for again", offset, self.server
+                    )
+                    return None
+
+                fh.seek(offset)
+                fh.write(output[1])
+                return output[0]
+
+            self._copy(size, start_chunk, finish_chunk)
+            fh.truncate(size)
+
+        os.replace(part, destination)
+        self._clear_journal()
+
+        return size - self.resumed
+
+    def run(self, transfer):
+        """Run the transfer, returns a summary of what was done
+
+        Raises TransferError if it could not be finished, the progress is saved first"""
+        # Each chunk in flight needs a runspace of its own on the host. The pool can be a
+        # shared one from the session manager, so it is put back the way it was afterwards
+        max_runspaces = self.runspacepool.max_runspaces
+
+        if max_runspaces < self.streams:
+            self.runspacepool.max_runspaces = self.streams
+
+        _start = time.monotonic()
+
+        try:
+            if transfer["direction"] == c.TRANSFER_PUSH:
+                copied = self.push(transfer["source"], transfer["destination"])
+            else:
+                copied = self.pull(transfer["source"], transfer["destination"])
+        except Exception:
+            self.save_journal()
+            raise
+        finally:
+            self._restore_runspaces(max_runspaces)
+
+        elapsed = max(time.monotonic() - _start, 1e-6)
+        summary = "%s %s to %s: %s bytes in %.1f seconds (%.1f MB/s), chunk size %s KB" % (
+            "Pushed" if transfer["direction"] == c.TRANSFER_PUSH else "Pulled",
+            transfer["source"], self.destination, copied, elapsed,
+            copied / elapsed / 1048576, self.tuner.size // 1024
+        )
+
+        if self.resumed > 0:
+            summary += ", resumed with %s bytes already copied" % self.resumed
+
+        return summary
@@ -1,38 +1,106 @@
 
 import os
+import time
+import threading
+
+import requests
+from urllib3.exceptions import NewConnectionError
 
-from pypsrp import exceptions as pypsrp_exceptions
 from pypsrp.client import Client
+from pypsrp.complex_objects import PSInvocationState
 from pypsrp.powershell import PowerShell, RunspacePool
+from pypsrp.shell import Process, SignalCode, WinRS
 from pypsrp.wsman import WSMan
-from pypsrp.exceptions import AuthenticationError
+from pypsrp.exceptions import AuthenticationError, WSManFaultError
 from spnego.exceptions import SpnegoError, BadMechanismError, CredentialsExpiredError
 
 import constants as c
 from utilities import pad_string
-from network import Network
-from kerberos import Kerberos
+from network import Network, known_host
+from session import get_session_manager
+from profiles import get_profile_store, is_fresh
+from digests import get_digest_store
+from timing import StageTimer
+import batch
+import digests
+import structured
+from transfer import FileTransfer, TransferError
+
+# The envelope size to use for each (server, port) - the largest the server allows, or the
+# default if it won't say or rejected a larger one
+_ENVELOPE_SIZES = {}
+_ENVELOPE_LOCK = threading.Lock()
+
+def is_connect_error(err):
+    """True if the connection could not be made at all, so nothing reached the server"""
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+
+    if isinstance(err, requests.exceptions.ConnectionError) and len(err.args) > 0:
+        return isinstance(getattr(err.args[0], "reason", None), NewConnectionError)
+
+    return False
 
 class Transport:
-    def __init__(self, logger, args, password):
+    def __init__(self, logger, args, password, server=None, save_profile=True):
         self.logger = logger
         self.network = Network(self.logger)
-        self.kerberos = Kerberos(self.logger, args)
+        self.args = args
+        # Only set up for Active Directory users, see _prepare_connection
+        self.kerberos = None
+        self.sessions = get_session_manager(self.logger, args)
+        self.profiles = get_profile_store(self.logger, args)
+        # Off for checks on a host that is not itself yet (e.g. restarting), whose profile is
+        # still used but left as it is
+        self.save_profile = save_profile
+        # What last worked for the host (see _load_profile), and the host as it was given
+        self.profile = None
+        self.host = None
+        # Round trip time from the ping, or passed in by a fleet that pinged the host itself
+        self.rtt = None
+        self.attempted = False
         self.password = password
-        self.kwargs = c.DEFAULT_PYPSRP_ARGS
+        # Take a copy - several transports can be active at once when managing a fleet
+        self.kwargs = dict(c.DEFAULT_PYPSRP_ARGS)
         self.connected = False
+        self.unreachable = False
+        # Set when connecting failed in a way worth trying again (the command never started)
+        self.retryable = False
         self.principal = None
         self.domain = None
         self.ping = args.ping
+        self.probe_timeout = getattr(args, "probe_timeout", c.DEFAULT_PROBE_TIMEOUT)
         self.wsman = None
         self.runspacepool = None
+        self.pool_broken = False
+        # A command started with begin_command, and the marker if it is a batch (or the output
+        # is hashed on the host, see digests.py)
+        self.pipeline = None
+        self.marker = None
+        self.digests = get_digest_store(self.logger, args)
+        # Set for a command whose output is hashed on the host (digests.use_digest), with the
+        # (digest, saved) of its output from the last run
+        self.use_digest = False
+        self.known_digest = None
         self.client = None
+        # The cmd shell raw commands run in, kept open for reuse by the session manager.
+        # shell_opened is set when this transport opened it rather than reusing one
+        self.shell = None
+        self.shell_opened = False
+        self.shell_broken = False
         self.ok_continue = True
         self.command = ""
+        self.commands = []
         self.is_raw = False
+        # Kept for the life of the transport, result_dict["timings"] refers to it
+        self.timer = StageTimer()
         self.result_dict = self._set_result_dict()
         self._process_args(args)
 
+        # A server passed in overrides the one from the inputs (e.g. one host of a fleet)
+        if server is not None:
+            self.kwargs["server"] = server
+
     def _set_result_dict(self):
         """Use a dictionary for the results"""
         return {
@@ -41,13 +109,16 @@ class Transport:
             "raw_result": "",
             "stdout": "",
             "stderr": "",
-            "raw_result": ""
+            "batch": [],
+            # Only set when the digest store is used - True if the output differs from the
+            # last run, with a diff if there is the last output to compare with
+            "changed": None,
+            "diff": "",
+            "timings": self.timer.timings
         }
 
     def _process_args(self, args):
         """Update kwargs with values in args (ie inputs)"""
-        args_dict = {}
-
         for arg in vars(args):
             if arg in self.kwargs:
                 self.kwargs[arg] = getattr(args, arg)
@@ -79,10 +150,35 @@ class Transport:
             self.kwargs["encryption"] = c.MSG_ENCRYPTION_NEVER
             self.kwargs["password"] = self.password
             
+    def _load_profile(self):
+        """Use what last worked for the host, as long as it is being connected to the same way"""
+        if self.profiles is None:
+            return
+
+        profile = self.profiles.get(self.host, self.args.username)
+
+        if profile is None:
+            return
+
+        if any(profile[k] != self.kwargs[k] for k in ("auth", "port", "ssl", "encryption")):
+            self.logger.debug(
+                "transport_pypsrp._load_profile: The profile of %s is for other connection "
+                "settings, not using it", self.host
+            )
+            return
+
+        self.profile = profile
+
     def _prepare_host(self):
         """Try and get the host name plus IP etc"""
-        host_info = self.network.resolve_host(self.kwargs["server"])
-        
+        if self.profile is not None and self.profile["ip"]:
+            # Resolved on an earlier run that worked
+            host_info = known_host(self.host, self.profile["fqdn"], self.profile["ip"])
+            self.network.host_info = host_info
+        else:
+            with self.timer.stage(c.STAGE_RESOLVE):
+                host_info = self.network.resolve_host(self.kwargs["server"])
+
         if host_info["is_resolved"]:
             self.kwargs["server"] = host_info["fqdn"] if len(host_info["fqdn"]) > 0 else \
                 host_info["host"]
@@ -94,10 +190,15 @@ class Transport:
                     "to connect, but is likely to fail."
                 )
 
-        if self.ping:
-            self.ok_continue = self.network.ping_host(self.kwargs["port"])
+        # No need to ping a host that answered a short while ago
+        if self.ping and not is_fresh(self.profile, c.PROFILE_SKIP_PING_AGE):
+            with self.timer.stage(c.STAGE_PING):
+                self.ok_continue = self.network.ping_host(self.kwargs["port"], self.probe_timeout)
+
+            self.rtt = self.timer.timings[c.STAGE_PING] if self.ok_continue else None
 
         if not self.ok_continue:
+            self.unreachable = True
             self.logger.error(
                 "transport_pypsrp._prepare_host: Unable to ping server %s on port %s, quitting",
                 self.kwargs["server"], self.kwargs["port"]
@@ -138,23 +239,138 @@ class Transport:
 
     def _prepare_connection(self):
         """Check some of the inputs"""
-        self._prepare_user()
-        self._prepare_port()
+        with self.timer.stage(c.STAGE_PREPARE):
+            self._prepare_user()
+            self._prepare_port()
+            self._set_timeouts()
+
+        self.host = self.kwargs["server"]
+        self._load_profile()
         self._prepare_host()
-        self._set_timeouts()
 
-        if self.ok_continue and self.kwargs["auth"] == c.PYPSRP_KERBEROS:
-            # Get a ticket
-            self.ok_continue = self.kerberos.get_ticket(self.principal, self.domain, self.password)
-        
+        if self.ok_continue:
+            self.ok_continue = self._get_ticket()
+
+    def _get_ticket(self):
+        """Get a Kerberos ticket for Active Directory users, nothing to do for local users"""
+        if self.kwargs["auth"] != c.PYPSRP_KERBEROS:
+            return True
+
+        # Kerberos support is only loaded when the user needs it
+        from kerberos import Kerberos
+        self.kerberos = Kerberos(self.logger, self.args)
+
+        # kinit only worked with the cache file last time, so don't try without it first
+        if self.profile is not None and self.profile["kinit_cache"]:
+            self.kerberos.force_cache = True
+
+        with self.timer.stage(c.STAGE_KERBEROS):
+            return self.kerberos.get_ticket(self.principal, self.domain, self.password)
+
+    def prepare_credentials(self):
+        """Sort out the user and any Kerberos ticket without connecting, so the ticket cache
+        is ready before other processes need it. Returns False if no ticket could be had"""
+        self._prepare_user()
+        return self._get_ticket()
+
+
+    def _envelope_key(self):
+        """Envelope sizes are kept per server and port"""
+        return (self.kwargs["server"], self.kwargs["port"])
+
+    def _negotiate_envelope(self, wsman):
+        """Use the largest envelope the server allows, so large outputs need fewer Receive
+        round trips. The server is only asked once per host"""
+        ceiling = getattr(self.args, "max_envelope_kb", c.MAX_ENVELOPE_KB)
+
+        if ceiling is None or ceiling <= 0:
+            return
+
+        with _ENVELOPE_LOCK:
+            size = _ENVELOPE_SIZES.get(self._envelope_key(), None)
+
+            # Negotiated on an earlier run
+            if size is None and self.profile is not None and self.profile["max_envelope_size"]:
+                size = min(self.profile["max_envelope_size"], ceiling * 1024)
+                _ENVELOPE_SIZES[self._envelope_key()] = size
+
+        if size is None:
+            try:
+                # A Get of the WinRM config, which needs admin rights on the server
+                wsman.update_max_payload_size()
+                size = min(wsman.max_envelope_size, ceiling * 1024)
+            except WSManFaultError as e:
+                self.logger.debug(
+                    "transport_pypsrp._negotiate_envelope: %s would not give its "
+                    "MaxEnvelopeSizekb, using the default: %s", self.kwargs["server"], str(e)
+                )
+                size = 0
+            except Exception as e:
+                # Not an answer from the server, try again next time
+                self.logger.debug(
+                    "transport_pypsrp._negotiate_envelope: Unable to ask %s for its "
+                    "MaxEnvelopeSizekb: %s", self.kwargs["server"], str(e)
+                )
+                wsman.update_max_payload_size(self.kwargs["max_envelope_size"])
+                return
+
+            if size <= 0:
+                size = self.kwargs["max_envelope_size"]
+
+            with _ENVELOPE_LOCK:
+                _ENVELOPE_SIZES[self._envelope_key()] = size
+
+            self.logger.debug(
+                "transport_pypsrp._negotiate_envelope: Envelope size for %s is %s",
+                self.kwargs["server"], size
+            )
+
+        wsman.update_max_payload_size(size)
+
+    def _envelope_rejected(self, wsman, err):
+        """The server failed a request sent with a negotiated envelope size, so go back to the
+        default for this host. Returns True if there is a smaller size to retry with"""
+        if wsman.max_envelope_size == self.kwargs["max_envelope_size"]:
+            return False
+
+        self.logger.warning(
+            "transport_pypsrp._envelope_rejected: %s rejected an envelope size of %s, using %s: "
+            "%s", self.kwargs["server"], wsman.max_envelope_size, self.kwargs["max_envelope_size"],
+            str(err)
+        )
+
+        with _ENVELOPE_LOCK:
+            _ENVELOPE_SIZES[self._envelope_key()] = self.kwargs["max_envelope_size"]
+
+        wsman.update_max_payload_size(self.kwargs["max_envelope_size"])
+        return True
+
+    def _open_pool(self):
+        """Open a new RunspacePool - used by the session manager when none can be reused"""
+        self.wsman = WSMan(**self.kwargs)
+
+        # Larger envelopes slow pypsrp down for PowerShell output, so only when asked to
+        if getattr(self.args, "pool_envelope", False):
+            self._negotiate_envelope(self.wsman)
+        runspacepool = RunspacePool(self.wsman)
+
+        try:
+            runspacepool.open()
+        except WSManFaultError as e:
+            if not self._envelope_rejected(self.wsman, e):
+                raise
+
+            runspacepool = RunspacePool(self.wsman)
+            runspacepool.open()
+
+        return runspacepool
 
     def _connect_pool(self):
-        """Create a RunspacePool connection (PowerShell only)"""
+        """Get a RunspacePool connection (PowerShell only), reusing an open one if possible"""
         self.logger.info("Connecting for PowerShell execution")
         try:
-            self.wsman = WSMan(**self.kwargs)
-            self.runspacepool = RunspacePool(self.wsman)
-            self.runspacepool.open()
+            self.runspacepool = self.sessions.acquire(self.kwargs, self._open_pool)
+            self.pool_broken = False
             self.connected = True
         except (CredentialsExpiredError, BadMechanismError, SpnegoError) as e:
             self.logger.error("transport_pypsrp._connect_pool: Connection error: %s", str(e))
@@ -164,6 +380,8 @@ class Transport:
                 self.kwargs["username"], str(e)
             )
         except Exception as e:
+            # Refused, timed out, or the server is too busy to open a shell
+            self.retryable = True
             type_err = type(e)
             str_err = str(e)
             self.logger.error(
@@ -182,9 +400,7 @@ class Transport:
     def _run_pool(self):
         """Run command in RunspacePool"""
         try:
-            ps = PowerShell(self.runspacepool)
-            ps.add_cmdlet("Invoke-Expression").add_parameter("Command", self.command)
-            ps.add_cmdlet("Out-String").add_parameter("Stream")
+            ps = self._new_pipeline()
             ps.invoke()
 
             # Let the "read" function determine if there was an issue
@@ -193,17 +409,76 @@ class Transport:
         except Exception as e:
             err_type = type(e)
             err_str = str(e)
-            err_msg = "Error %s running command: %s" % err_type, err_str
+            err_msg = "Error %s running command: %s" % (err_type, err_str)
+            # Don't hand this pool out again, it may no longer be usable
+            self.pool_broken = True
             self.result_dict["is_error"] = True
             self.result_dict["stderr"] = err_msg
             
+    def _open_shell(self):
+        """Open a new cmd shell - used by the session manager when none can be reused"""
+        wsman = self.client.wsman
+        self._negotiate_envelope(wsman)
+        shell = WinRS(wsman)
+
+        try:
+            shell.open()
+        except WSManFaultError as e:
+            if not self._envelope_rejected(wsman, e):
+                raise
+
+            shell = WinRS(wsman)
+            shell.open()
+
+        self.shell_opened = True
+        return shell
+
+    def _execute_cmd(self):
+        """Run the command as a process in the host's cmd shell, opening one if there isn't
+        one to reuse. Returns stdout, stderr and the return code like Client.execute_cmd"""
+        if self.shell is None:
+            self.shell_opened = False
+            self.shell = self.sessions.acquire(self.kwargs, self._open_shell, c.SESSION_SHELL)
+
+        process = Process(self.shell, self.command)
+        process.invoke()
+        process.signal(SignalCode.CTRL_C)
+
+        return (
+            process.stdout.decode(c.RAW_ENCODING, errors="replace"),
+            process.stderr.decode(c.RAW_ENCODING, errors="replace"),
+            process.rc if process.rc is not None else -1
+        )
+
+    def _retry_cmd(self, err):
+        """The server failed the command, returns True if it can be run again - the reused
+        shell had expired on the server, or a smaller envelope size can be used"""
+        if not self.shell_opened and err.code == c.WINRS_SHELL_NOT_FOUND:
+            self.logger.debug(
+                "transport_pypsrp._retry_cmd: The shell on %s has expired, opening a new one",
+                self.kwargs["server"]
+            )
+        elif not self._envelope_rejected(self.shell.wsman, err):
+            return False
+
+        self.sessions.release(self.shell, close=True)
+        self.shell = None
+        return True
+
     def _run_nonpool(self):
-        """Use Client"""
+        """Run a raw command in a cmd shell, kept open so later commands can reuse it"""
         # This is where the connection is made for Client so assume no connection
         self.connected = False
 
         try:
-            self.result_dict["raw_result"] = self.client.execute_cmd(self.command)
+            try:
+                self.result_dict["raw_result"] = self._execute_cmd()
+            except WSManFaultError as e:
+                if self.shell is None or not self._retry_cmd(e):
+                    raise
+
+                self.result_dict["raw_result"] = self._execute_cmd()
+
             self.connected = True
         except (CredentialsExpiredError, BadMechanismError, SpnegoError) as e:
             self.logger.error("transport_pypsrp._run_nonpool: Connection error: %s", str(e))
@@ -213,6 +488,10 @@ class Transport:
                 self.kwargs["username"], str(e)
             )            
         except Exception as e:
+            # The command may have been started unless the connection was never made
+            self.retryable = is_connect_error(e)
+            # The shell may be left part way through a command, so don't hand it out again
+            self.shell_broken = True
             type_err = type(e)
             str_err = str(e)
             self.logger.error(
@@ -220,6 +499,105 @@ class Transport:
                 type_err, str_err
             )
 
+    def _stream_pool(self, script=None):
+        """Run command (or script) in RunspacePool, yielding output and errors as they arrive"""
+        ps = PowerShell(self.runspacepool)
+
+        if script is not None:
+            ps.add_script(script)
+        else:
+            ps.add_cmdlet("Invoke-Expression").add_parameter("Command", self.command)
+            ps.add_cmdlet("Out-String").add_parameter("Stream")
+
+        ps.begin_invoke()
+        errors_seen = 0
+
+        while True:
+            ps.poll_invoke()
+
+            # Hand over what has arrived and drop it, so memory use stays flat
+            output = ps.output[:]
+            del ps.output[:len(output)]
+
+            for line in output:
+                yield c.STREAM_OUTPUT, line
+
+            for record in ps.streams.error[errors_seen:]:
+                yield c.STREAM_ERROR, record
+            errors_seen = len(ps.streams.error)
+
+            if ps.state != PSInvocationState.RUNNING:
+                break
+
+        self.result_dict["is_error"] = ps.had_errors
+
+    def _run_pool_batch(self):
+        """Run several commands in one pipeline, so only one round trip is needed"""
+        try:
+            ps = self._new_pipeline()
+            ps.invoke()
+
+            self.result_dict["ps_result"] = ps.output, ps.streams, ps.had_errors, self.marker
+            self.result_dict["is_error"] = False
+        except Exception as e:
+            err_msg = "Error %s running batch: %s" % (type(e), str(e))
+            self.pool_broken = True
+            self.result_dict["is_error"] = True
+            self.result_dict["stderr"] = err_msg
+
+    def _run_nonpool_batch(self):
+        """Raw commands have no pipeline to share, so run them one after the other"""
+        raw_results = []
+
+        for command in self.commands:
+            self.command = command
+            self._run_nonpool()
+
+            if not self.connected:
+                self.result_dict["is_error"] = True
+                return
+
+            raw_results.append(self.result_dict["raw_result"])
+
+        self.result_dict["raw_result"] = raw_results
+
+    def _read_pool_batch(self):
+        """Split the batch output back out to each command"""
+        output, streams, had_errors, marker = self.result_dict["ps_result"]
+        self.result_dict["batch"] = batch.split_output(output, self.commands, marker)
+
+        if had_errors and len(streams.error) > 0:
+            self.result_dict["stderr"] = str(streams.error[0])
+
+    def _read_nonpool_batch(self):
+        """Put each raw command result into the batch results"""
+        for command, raw_result in zip(self.commands, self.result_dict["raw_result"]):
+            command_result = batch.set_command_result(command)
+            command_result["stdout"], command_result["stderr"], rc = raw_result
+            command_result["is_error"] = rc != 0
+            self.result_dict["batch"].append(command_result)
+
+    def _read_batch(self):
+        """Read batch results, combining the output of each command into stdout/stderr"""
+        if self.is_raw:
+            self._read_nonpool_batch()
+        else:
+            self._read_pool_batch()
+
+        stdout = []
+        stderr = []
+
+        for command_result in self.result_dict["batch"]:
+            stdout.append("> %s\n%s" % (command_result["command"], command_result["stdout"]))
+
+            if command_result["is_error"]:
+                stderr.append("> %s\n%s" % (command_result["command"], command_result["stderr"]))
+
+        self.result_dict["stdout"] = "\n".join(stdout)
+        self.result_dict["stderr"] = "\n".join(stderr) if len(stderr) > 0 else \
+            self.result_dict["stderr"]
+        self.result_dict["is_error"] = len(stderr) > 0
+
     def _read_pool(self):
         """Read result of runnibng in RunspacePool"""
         self.result_dict["stdout"] = self.result_dict["ps_result"][0]
@@ -228,14 +606,44 @@ class Transport:
         if self.result_dict["is_error"]:
             self.result_dict["stderr"] = self.result_dict["ps_result"][1].error[0]
 
+        if self.marker is not None:
+            self._read_digest()
+
+    def _read_digest(self):
+        """Use the last output if the host says it is unchanged, otherwise keep the new output
+        and work out what changed"""
+        digest, changed, output = digests.split_output(self.result_dict["stdout"], self.marker)
+        self.result_dict["stdout"] = output
+
+        # Output from a failed run is not kept, the next run sends it in full
+        if digest is None or self.result_dict["is_error"]:
+            return
+
+        self.result_dict["changed"] = changed
+
+        if not changed:
+            self.result_dict["stdout"] = self.digests.get_output(
+                self.host, self.args.username, self.command
+            ) or ""
+            self.logger.debug(
+                "transport_pypsrp._read_digest: %s unchanged since %s", self.host,
+                time.ctime(self.known_digest[1])
+            )
+            return
+
+        if self.known_digest is not None:
+            previous = self.digests.get_output(self.host, self.args.username, self.command)
+            self.result_dict["diff"] = digests.diff_output(previous or "", output)
+
+        self.digests.put(self.host, self.args.username, self.command, digest, output)
 
     def _read_nonpool(self):
-        """Read raw command result"""
+        """Read raw command result - this is stdout, stderr and the return code"""
         self.result_dict["stdout"] = self.result_dict["raw_result"][0]
-        self.result_dict["is_error"] = self.result_dict["raw_result"][2]
+        self.result_dict["is_error"] = self.result_dict["raw_result"][2] != 0
 
         if self.result_dict["is_error"]:
-            self.result_dict["stderr"] = self.result_dict["raw_result"][1].error[0]
+            self.result_dict["stderr"] = self.result_dict["raw_result"][1]
 
 
     def connect(self, is_raw=False):
@@ -265,38 +673,290 @@ class Transport:
                 _msg += "  %s: %s\n" % (pad_string("krb5 cache", _pad_len), "Not used")
 
         self.logger.debug(_msg)
-        if self.is_raw:
-            self._connect_nonpool()
-        else:
-            self._connect_pool()
+        self.attempted = True
 
-    def run_command(self, command):
-        """Run a command"""
+        with self.timer.stage(c.STAGE_CONNECT):
+            if self.is_raw:
+                self._connect_nonpool()
+            else:
+                self._connect_pool()
+
+    def run_command(self, command, use_digest=False):
+        """Run a command, use_digest hashes its output on the host if there is a digest store"""
         # We could run multiple commands, so clear things up first
         self.result_dict = self._set_result_dict()
         self.command = command
+        self.use_digest = use_digest
+        self.commands = []
+        self.result_dict["is_raw"] = self.is_raw
+
+        with self.timer.stage(c.STAGE_RUN):
+            if self.is_raw:
+                self._run_nonpool()
+            else:
+                self._run_pool()
+
+        return not self.result_dict["is_error"]
+
+    def stream_command(self, command, callback):
+        """Run a command, passing each output line / error record to callback(kind, item)
+
+        Nothing is kept in result_dict["stdout"], only the first error goes into stderr"""
+        self.result_dict = self._set_result_dict()
+        self.command = command
+        self.commands = []
         self.result_dict["is_raw"] = self.is_raw
 
         if self.is_raw:
-            self._run_nonpool()
+            # execute_cmd only gives back the output at the end, so pass it on in one go
+            with self.timer.stage(c.STAGE_RUN):
+                self._run_nonpool()
+
+            if not self.connected:
+                self.result_dict["is_error"] = True
+                return False
+
+            self._read_nonpool()
+            for line in self.result_dict["stdout"].splitlines():
+                callback(c.STREAM_OUTPUT, line)
+            self.result_dict["stdout"] = ""
+
+            return not self.result_dict["is_error"]
+
+        # Output is passed on as it arrives, so run takes in the time of the callbacks too
+        try:
+            with self.timer.stage(c.STAGE_RUN):
+                for kind, item in self._stream_pool():
+                    if kind == c.STREAM_ERROR and len(self.result_dict["stderr"]) == 0:
+                        self.result_dict["stderr"] = str(item)
+
+                    callback(kind, item)
+        except Exception as e:
+            self.pool_broken = True
+            self.result_dict["is_error"] = True
+            self.result_dict["stderr"] = "Error %s running command: %s" % (type(e), str(e))
+
+        return not self.result_dict["is_error"]
+
+    def run_structured(self, command, properties=None, callback=None):
+        """Run a command, getting its output as objects (dictionaries) rather than text
+
+        Objects go to callback(obj) if given, otherwise they are kept in result_dict["objects"]"""
+        self.result_dict = self._set_result_dict()
+        self.command = command
+        self.commands = []
+        self.result_dict["objects"] = []
+
+        if self.is_raw:
+            self.result_dict["is_error"] = True
+            self.result_dict["stderr"] = "Structured output is only available for PowerShell"
+            return False
+
+        script = structured.build_script(command, properties)
+        errors = []
+
+        def output_lines():
+            """Pass on output lines, keeping hold of errors"""
+            for kind, item in self._stream_pool(script):
+                if kind == c.STREAM_ERROR:
+                    errors.append(str(item))
+                else:
+                    yield item
+
+        try:
+            with self.timer.stage(c.STAGE_RUN):
+                for obj in structured.parse_lines(output_lines()):
+                    if callback is not None:
+                        callback(obj)
+                    else:
+                        self.result_dict["objects"].append(obj)
+        except ValueError as e:
+            self.result_dict["is_error"] = True
+            self.result_dict["stderr"] = "Unable to read the structured output: %s" % str(e)
+        except Exception as e:
+            self.pool_broken = True
+            self.result_dict["is_error"] = True
+            self.result_dict["stderr"] = "Error %s running command: %s" % (type(e), str(e))
+
+        if len(errors) > 0 and len(self.result_dict["stderr"]) == 0:
+            self.result_dict["stderr"] = errors[0]
+
+        return not self.result_dict["is_error"]
+
+    def run_transfer(self, transfer):
+        """Copy a file to or from the host (see transfer.py), the summary goes in stdout"""
+        self.result_dict = self._set_result_dict()
+        self.command = ""
+        self.commands = []
+
+        if self.is_raw:
+            self.result_dict["is_error"] = True
+            self.result_dict["stderr"] = "File transfers are only available for PowerShell"
+            return False
+
+        file_transfer = FileTransfer(self.logger, self.args, self.runspacepool,
+                                     self.kwargs["server"])
+
+        try:
+            with self.timer.stage(c.STAGE_RUN):
+                self.result_dict["stdout"] = file_transfer.run(transfer)
+        except TransferError as e:
+            self.result_dict["is_error"] = True
+            self.result_dict["stderr"] = "Transfer failed, run it again to resume: %s" % str(e)
+        except Exception as e:
+            # Chunks may still be running on the host, so don't hand this pool out again
+            self.pool_broken = True
+            self.result_dict["is_error"] = True
+            self.result_dict["stderr"] = "Error %s during transfer, run it again to resume: " \
+                "%s" % (type(e), str(e))
+
+        if file_transfer.pool_changed:
+            self.pool_broken = True
+
+        return not self.result_dict["is_error"]
+
+    def _new_pipeline(self):
+        """The pipeline for the command, or for every command of a batch"""
+        ps = PowerShell(self.runspacepool)
+
+        if len(self.commands) > 0:
+            self.marker = batch.new_marker()
+            ps.add_script(batch.build_script(self.commands, self.marker))
+        elif self.use_digest and self.digests is not None:
+            self.marker = digests.new_marker()
+            self.known_digest = self.digests.get(self.host, self.args.username, self.command)
+            ps.add_script(digests.build_script(
+                self.command, self.known_digest[0] if self.known_digest else None, self.marker
+            ))
         else:
-            self._run_pool()
+            self.marker = None
+            ps.add_cmdlet("Invoke-Expression").add_parameter("Command", self.command)
+            ps.add_cmdlet("Out-String").add_parameter("Stream")
+
+        return ps
+
+    def _pipeline_failed(self, err):
+        """A started command could not be run or followed, the pool may not be usable"""
+        self.pipeline = None
+        self.pool_broken = True
+        self.result_dict["is_error"] = True
+        self.result_dict["stderr"] = "Error %s running command: %s" % (type(err), str(err))
+
+    def begin_command(self, command="", commands=None, use_digest=False):
+        """Start a command (or the commands of a batch) without waiting for it to finish, then
+        call poll_command until it has. PowerShell only, get_results reads the output"""
+        self.result_dict = self._set_result_dict()
+        self.command = command
+        self.use_digest = use_digest
+        self.commands = list(commands or [])
+
+        try:
+            with self.timer.stage(c.STAGE_RUN):
+                self.pipeline = self._new_pipeline()
+                self.pipeline.begin_invoke()
+        except Exception as e:
+            self._pipeline_failed(e)
+            return False
+
+        return True
+
+    def poll_command(self, timeout):
+        """Take what output the host has for the started command, waiting at most timeout
+        seconds (fractions allowed, 0 is taken as the default) for some. Returns True once the
+        command has finished"""
+        ps = self.pipeline
+
+        try:
+            with self.timer.stage(c.STAGE_RUN):
+                ps.poll_invoke(timeout)
+        except Exception as e:
+            self._pipeline_failed(e)
+            return True
+
+        if ps.state == PSInvocationState.RUNNING:
+            return False
+
+        if len(self.commands) > 0:
+            self.result_dict["ps_result"] = ps.output, ps.streams, ps.had_errors, self.marker
+        else:
+            self.result_dict["ps_result"] = "\n".join(ps.output), ps.streams, ps.had_errors
+
+        self.pipeline = None
+        return True
+
+    def run_commands(self, commands):
+        """Run several commands in one go, the results are split out per command"""
+        self.result_dict = self._set_result_dict()
+        self.commands = list(commands)
+        self.command = ""
+        self.result_dict["is_raw"] = self.is_raw
+
+        with self.timer.stage(c.STAGE_RUN):
+            if self.is_raw:
+                self._run_nonpool_batch()
+            else:
+                self._run_pool_batch()
 
         return not self.result_dict["is_error"]
     
     def get_results(self):
         """Get the results from running the command"""
-        if self.is_raw:
-            self._read_nonpool()
-        else:
-            self._read_pool()
+        with self.timer.stage(c.STAGE_READ):
+            if len(self.commands) > 0:
+                self._read_batch()
+            elif self.is_raw:
+                self._read_nonpool()
+            else:
+                self._read_pool()
 
         return not self.result_dict["is_error"]
     
-    def disconnect(self):
-        """Close connections"""
+    def _save_profile(self):
+        """Record what worked for the host, or drop its profile if it could not be reached"""
+        if self.profiles is None or self.host is None or not self.save_profile:
+            return
+
+        if self.unreachable or (self.attempted and not self.connected):
+            # A profile for other settings may still be right, only drop the one that failed
+            if self.profile is not None:
+                self.profiles.invalidate(self.host, self.args.username)
+            return
+
+        if not self.connected:
+            return
+
+        with _ENVELOPE_LOCK:
+            max_envelope_size = _ENVELOPE_SIZES.get(self._envelope_key(), None)
+
+        rtt = self.rtt
+        if rtt is None and self.profile is not None:
+            rtt = self.profile["rtt"]
+
+        self.profiles.put({
+            "server": self.host,
+            "username": self.args.username,
+            "auth": self.kwargs["auth"],
+            "port": self.kwargs["port"],
+            "ssl": self.kwargs["ssl"],
+            "encryption": self.kwargs["encryption"],
+            "fqdn": self.network.host_info["fqdn"],
+            "ip": self.network.host_info["ip"],
+            "rtt": rtt,
+            "max_envelope_size": max_envelope_size,
+            "kinit_cache": self.kerberos is not None and len(self.kerberos.cache) > 0 and
+                           os.environ.get("KRB5CCNAME", "") == self.kerberos.cache,
+            "last_success": None
+        })
+
+    def disconnect(self, close=False):
+        """Finished with the connections - pools are kept open for reuse unless close is set"""
+        self._save_profile()
 
         if self.runspacepool:
+            self.sessions.release(self.runspacepool, close or self.pool_broken)
             self.runspacepool = None
+        if self.shell:
+            self.sessions.release(self.shell, close or self.shell_broken)
+            self.shell = None
         if self.client:
             self.client = None
@@ -2,6 +2,8 @@
 import logging
 import getpass
 
+import constants as c
+
 class CustomFormatter(logging.Formatter):
     """Logging colored formatter, adapted from https://stackoverflow.com/a/56944256/3638629"""
 
@@ -61,3 +63,41 @@ def show_inputs(logger, args):
 
     logger.debug(_msg)
 
+
+def ps_quote(value):
+    """Quote a value as a PowerShell single quoted (literal) string. PowerShell also ends the
+    string on the curly and low-9 single quotes, so every one of them is doubled"""
+    return "'%s'" % "".join(
+        ch * 2 if ch in c.PS_SINGLE_QUOTES else ch for ch in str(value)
+    )
+
+def _read_inventory(file_name):
+    """Read the hosts from an inventory file - one per line, # for comments"""
+    hosts = []
+
+    with open(file_name, "r") as fh:
+        for line in fh:
+            line = line.split(c.INVENTORY_COMMENT, 1)[0].strip()
+
+            if len(line) > 0:
+                hosts.append(line)
+
+    return hosts
+
+def load_hosts(server):
+    """Turn the server input into a list of hosts (comma separated and/or inventory files)"""
+    hosts = []
+
+    for entry in server.split(","):
+        entry = entry.strip()
+
+        if len(entry) == 0:
+            continue
+
+        if entry.startswith(c.INVENTORY_PREFIX):
+            hosts.extend(_read_inventory(entry[len(c.INVENTORY_PREFIX):]))
+        else:
+            hosts.append(entry)
+
+    # Remove duplicates but keep the order given
+    return list(dict.fromkeys(hosts))